@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк observe-пути: headers.parse_syn против scapy IPv6(payload).
+
+    PYTHONPATH=services/handler python services/handler/bench/bench_headers.py [-n 200000]
+"""
+from __future__ import annotations
+
+import argparse
+import socket
+import struct
+import time
+
+from weaver_handler.headers import parse_syn
+
+
+def make_syn6(copy_range: int = 128) -> bytes:
+    src = socket.inet_pton(socket.AF_INET6, "2001:db8::2")
+    dst = socket.inet_pton(socket.AF_INET6, "2001:db8:1::1")
+    # MSS, SACK_PERM, TS, NOP, WS — типичные 20 байт опций SYN
+    opts = bytes.fromhex("020405a00402080a0000000100000000" "01030307")
+    tcp = struct.pack(">HHIIBBHHH", 40000, 30000, 1, 0, (20 + len(opts)) // 4 << 4, 0x02, 65535, 0, 0) + opts
+    ip6 = struct.pack(">IHBB", 6 << 28, len(tcp), 6, 64) + src + dst
+    return (ip6 + tcp)[:copy_range]
+
+
+def bench(name: str, fn, payload: bytes, n: int) -> float:
+    view = memoryview(payload)
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn(view)
+    dt = time.perf_counter() - t0
+    print(f"{name:<24} {n / dt:>12,.0f} pkt/s  {dt / n * 1e6:8.2f} us/pkt")
+    return dt
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("-n", type=int, default=200_000)
+    args = ap.parse_args()
+
+    payload = make_syn6()
+    h = parse_syn(payload)
+    assert h is not None and h.dport == 30000 and h.syn_only
+
+    fast = bench("headers.parse_syn", parse_syn, payload, args.n)
+
+    try:
+        from scapy.all import IPv6, TCP  # type: ignore[import-not-found]
+    except ImportError:
+        print("scapy not installed — skipping IPv6(payload) baseline")
+        return
+
+    def scapy_path(buf):
+        pkt = IPv6(bytes(buf))
+        tcp = pkt.getlayer(TCP)
+        return (tcp.flags & 0x02) and not (tcp.flags & 0x10), pkt.src, pkt.dst, tcp.sport, tcp.dport
+
+    slow = bench("scapy IPv6(payload)", scapy_path, payload, max(1, args.n // 20))
+    slow *= 20
+    print(f"speedup: x{slow / fast:.0f}")
+
+
+if __name__ == "__main__":
+    main()
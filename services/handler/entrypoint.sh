@@ -5,6 +5,7 @@ export PYTHONPATH=/app
 
 CFG="${WEAVER_CONFIG:-/app/config/config.yaml}"
 
-# запускаем как пакет, чтобы относительные импорты работали
-exec python -m weaver_handler.weaver_handler.main --config "$CFG"
+# запускаем как пакет, чтобы относительные импорты работали;
+# супервизор поднимает по воркеру на каждую NFQUEUE из конфига
+exec python -m weaver_handler.weaver_handler.supervisor --config "$CFG"
 
@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import socket
+import struct
+from typing import NamedTuple, Optional, Union
+
+# Разбор IPv4/IPv6 + TCP прямо по буферу (memoryview/bytes) без scapy.
+# Достаём только то, что нужно observe-пути: 5-tuple и флаги TCP.
+
+IPPROTO_TCP = 6
+
+# IPv6 extension headers, которые можно пропустить по длине
+_IP6_EXT = {0, 43, 60}      # hop-by-hop, routing, destination options
+_IP6_FRAG = 44
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+
+_PORTS = struct.Struct(">HH")
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+class TcpHeader(NamedTuple):
+    family: int          # 4 | 6
+    src: bytes           # 4 или 16 байт, в сетевом порядке
+    dst: bytes
+    sport: int
+    dport: int
+    flags: int
+    ttl: int             # TTL / hop limit
+
+    @property
+    def syn_only(self) -> bool:
+        return self.flags & (TCP_SYN | TCP_ACK) == TCP_SYN
+
+    def src_str(self) -> str:
+        return socket.inet_ntop(socket.AF_INET6 if self.family == 6 else socket.AF_INET, self.src)
+
+    def dst_str(self) -> str:
+        return socket.inet_ntop(socket.AF_INET6 if self.family == 6 else socket.AF_INET, self.dst)
+
+
+def parse_tcp(buf: Buffer) -> Optional[TcpHeader]:
+    """
+    None — не TCP, фрагмент без TCP-заголовка или обрезанный пакет.
+    Адреса копируются (bytes), сам буфер после вызова можно переиспользовать.
+    """
+    n = len(buf)
+    if n < 20:
+        return None
+    ver = buf[0] >> 4
+    if ver == 4:
+        ihl = (buf[0] & 0x0F) * 4
+        if buf[9] != IPPROTO_TCP or ihl < 20:
+            return None
+        # не первый фрагмент — TCP-заголовка в нём нет
+        if (buf[6] & 0x1F) or buf[7]:
+            return None
+        off = ihl
+        family, ttl = 4, buf[8]
+        src, dst = bytes(buf[12:16]), bytes(buf[16:20])
+    elif ver == 6:
+        if n < 40:
+            return None
+        nh = buf[6]
+        ttl = buf[7]
+        off = 40
+        while nh != IPPROTO_TCP:
+            if off + 8 > n:
+                return None
+            if nh in _IP6_EXT:
+                nh, off = buf[off], off + (buf[off + 1] + 1) * 8
+            elif nh == _IP6_FRAG:
+                # offset != 0 — не первый фрагмент
+                if (buf[off + 2] << 8 | buf[off + 3]) & 0xFFF8:
+                    return None
+                nh, off = buf[off], off + 8
+            else:
+                return None
+        family = 6
+        src, dst = bytes(buf[8:24]), bytes(buf[24:40])
+    else:
+        return None
+    if off + 14 > n:
+        return None
+    sport, dport = _PORTS.unpack_from(buf, off)
+    return TcpHeader(family, src, dst, sport, dport, buf[off + 13], ttl)
+
+
+def parse_syn(buf: Buffer) -> Optional[TcpHeader]:
+    """Только первичный SYN (без ACK), иначе None."""
+    h = parse_tcp(buf)
+    if h is None or h.flags & (TCP_SYN | TCP_ACK) != TCP_SYN:
+        return None
+    return h
+
+
+def debug_decode(buf: Buffer) -> str:
+    """
+    Полный разбор через scapy — только для отладки (scapy опционален).
+    """
+    try:
+        from scapy.all import IP, IPv6  # type: ignore[import-not-found]
+    except ImportError:
+        return "<scapy not installed>"
+    data = bytes(buf)
+    pkt = IPv6(data) if data and data[0] >> 4 == 6 else IP(data)
+    return pkt.summary()
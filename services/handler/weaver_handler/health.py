@@ -1,54 +1,210 @@
 from __future__ import annotations
 
+import asyncio
 import json
+import multiprocessing as mp
 import socket
 import threading
 import time
-from typing import Dict, Iterable, List, Tuple
+from array import array
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
 
 class HealthRegistry:
-    def __init__(self, expected_queues: Iterable[int]) -> None:
-        self._last: Dict[int, float] = {q: 0.0 for q in expected_queues}
-        self._lock = threading.RLock()
+    """
+    last-seen по очередям без lock: у каждой очереди свой слот double в
+    заранее выделенном массиве, пишет в слот только её воркер (одна
+    выровненная 8-байтная запись — читатель не увидит половину значения).
+    shared=True — массив в shared memory (mp.RawArray): создать до fork,
+    воркеры пишут, супервизор читает тот же буфер.
+    """
 
-    def mark(self, q: int) -> None:
-        with self._lock:
-            self._last[q] = time.time()
+    def __init__(self, expected_queues: Iterable[int], shared: bool = False) -> None:
+        self._queues: Tuple[int, ...] = tuple(expected_queues)
+        self._index: Dict[int, int] = {q: i for i, q in enumerate(self._queues)}
+        n = len(self._queues)
+        self._slots: Any = mp.RawArray("d", n) if shared else array("d", bytes(8 * n))
+
+    def mark(self, q: int, ts: Optional[float] = None) -> None:
+        self._slots[self._index[q]] = time.time() if ts is None else ts
+
+    def writer(self, q: int) -> Callable[[], None]:
+        """mark(q) для горячего пути: индекс и массив связаны заранее."""
+        slots, i, now = self._slots, self._index[q], time.time
+
+        def seen() -> None:
+            slots[i] = now()
+
+        return seen
 
     def snapshot(self) -> Dict[int, float]:
-        with self._lock:
-            return dict(self._last)
+        # один memcpy всего буфера: срез на один момент, без lock у писателей
+        vals = array("d")
+        vals.frombytes(bytes(self._slots))
+        return dict(zip(self._queues, vals))
+
+
+# Health/metrics сервер на asyncio: соединения обслуживаются параллельно,
+# keep-alive, таймаут на чтение запроса. Тела /health и /ready
+# пересчитываются раз в interval фоновой задачей, запрос только отдаёт
+# готовые байты; /metrics рендерится не чаще раза в interval. В пакетный
+# путь сервер не ходит: читает registry.snapshot() и shared-memory.
+
+MAX_REQUEST = 8192
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 408: "Request Timeout",
+            500: "Internal Server Error", 503: "Service Unavailable"}
+
+JSON = "application/json; charset=utf-8"
+PROM = "text/plain; version=0.0.4; charset=utf-8"
+
+Response = Tuple[int, str, bytes]
+
+
+def _response(status: int, ctype: str, body: bytes, keep_alive: bool) -> bytes:
+    head = (
+        f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+        f"Content-Type: {ctype}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n"
+        "\r\n"
+    )
+    return head.encode("latin-1") + body
 
 
-def serve(bind: str, registry: HealthRegistry, interval: float = 1.0) -> None:
-    host, port = bind.split(":")
-    addr = (host, int(port))
-    fam = socket.AF_INET6 if ":" in host else socket.AF_INET
+class HealthServer:
+    def __init__(
+        self,
+        bind: str,
+        registry: HealthRegistry,
+        interval: float = 1.0,
+        metrics: Optional[Callable[[], str]] = None,
+        ready: Optional[Callable[[], bool]] = None,
+        stale_after: float = 60.0,
+        timeout: float = 5.0,
+    ) -> None:
+        host, _, port = bind.rpartition(":")
+        self.host = host.strip("[]") or "127.0.0.1"
+        self.port = int(port)
+        self.registry = registry
+        self.interval = interval
+        self.metrics = metrics
+        self.ready = ready
+        self.stale_after = stale_after
+        self.timeout = timeout
+        self._health: Response = (503, JSON, b'{"status": "starting"}')
+        self._ready: Response = (503, JSON, b'{"ready": false}')
+        self._metrics: Optional[Response] = None
+        self._metrics_at = 0.0
 
-    with socket.socket(fam, socket.SOCK_STREAM) as s:
-        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        s.bind(addr)
-        s.listen(5)
+    # ---- precompute ----
+
+    def refresh(self) -> None:
+        last = self.registry.snapshot()
+        now = time.time()
+        stale: List[int] = [q for q, ts in last.items() if now - ts > self.stale_after]
+        status = 200 if not stale else 503
+        body = {
+            "status": "ok" if status == 200 else "stale",
+            "stale_queues": stale,
+            "last_seen": last,
+        }
+        self._health = (status, JSON, json.dumps(body, ensure_ascii=False).encode("utf-8"))
+
+        try:
+            ok = self.ready() if self.ready is not None else True
+        except Exception:
+            ok = False
+        self._ready = (200 if ok else 503, JSON, json.dumps({"ready": bool(ok)}).encode("utf-8"))
+
+    def _render_metrics(self) -> Response:
+        now = time.monotonic()
+        if self._metrics is None or now - self._metrics_at >= self.interval:
+            assert self.metrics is not None
+            try:
+                self._metrics = (200, PROM, self.metrics().encode("utf-8"))
+            except Exception as e:
+                self._metrics = (500, PROM, f"# metrics error: {e}\n".encode("utf-8"))
+            self._metrics_at = now
+        return self._metrics
+
+    def route(self, path: str) -> Response:
+        if path in ("/", "/health", "/healthz"):
+            return self._health
+        if path in ("/ready", "/readyz"):
+            return self._ready
+        if path == "/metrics" and self.metrics is not None:
+            return self._render_metrics()
+        return (404, JSON, b'{"error": "not found"}')
+
+    # ---- asyncio ----
+
+    async def _refresher(self) -> None:
         while True:
-            conn, _ = s.accept()
-            with conn:
-                last = registry.snapshot()
-                now = time.time()
-                stale: List[int] = [q for q, ts in last.items() if now - ts > 60.0]
-                status = 200 if not stale else 503
-                body = {
-                    "status": "ok" if status == 200 else "stale",
-                    "stale_queues": stale,
-                    "last_seen": last,
-                }
-                payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
-                headers = [
-                    f"HTTP/1.1 {status} {'OK' if status==200 else 'Service Unavailable'}",
-                    "Content-Type: application/json; charset=utf-8",
-                    f"Content-Length: {len(payload)}",
-                    "Connection: close",
-                    "",
-                    "",
-                ]
-                conn.sendall("\r\n".join(headers).encode("utf-8") + payload)
+            self.refresh()
+            await asyncio.sleep(self.interval)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    raw = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.timeout)
+                except asyncio.TimeoutError:
+                    writer.write(_response(408, JSON, b"", False))
+                    break
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = raw.decode("latin-1").split("\r\n")
+                parts = lines[0].split()
+                if len(parts) != 3:
+                    writer.write(_response(400, JSON, b"", False))
+                    break
+                method, target, version = parts
+                conn_hdr = ""
+                for line in lines[1:]:
+                    name, _, value = line.partition(":")
+                    if name.strip().lower() == "connection":
+                        conn_hdr = value.strip().lower()
+                keep = conn_hdr == "keep-alive" if version == "HTTP/1.0" else conn_hdr != "close"
+                status, ctype, body = self.route(target.split("?", 1)[0])
+                resp = _response(status, ctype, body, keep)
+                # HEAD: заголовки с настоящим Content-Length, без тела
+                writer.write(resp[: len(resp) - len(body)] if method == "HEAD" else resp)
+                await writer.drain()
+                if not keep:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def run(self) -> None:
+        fam = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+        server = await asyncio.start_server(
+            self._handle, self.host, self.port, family=fam, reuse_address=True, limit=MAX_REQUEST,
+        )
+        refresher = asyncio.ensure_future(self._refresher())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            refresher.cancel()
+
+
+def serve(
+    bind: str,
+    registry: HealthRegistry,
+    interval: float = 1.0,
+    metrics: Optional[Callable[[], str]] = None,
+    ready: Optional[Callable[[], bool]] = None,
+    stale_after: float = 60.0,
+) -> None:
+    """Блокирует: запускать в отдельном потоке, у него свой event loop."""
+    srv = HealthServer(bind, registry, interval, metrics=metrics, ready=ready, stale_after=stale_after)
+    asyncio.run(srv.run())
+
+
+def start(bind: str, registry: HealthRegistry, **kw) -> threading.Thread:
+    t = threading.Thread(target=serve, args=(bind, registry), kwargs=kw, name="weaver-health", daemon=True)
+    t.start()
+    return t
@@ -0,0 +1,176 @@
+from __future__ import annotations
+
+import atexit
+import collections
+import json
+import sys
+import threading
+import time
+from typing import Any, Deque, Dict, IO, Mapping, Optional, Tuple
+
+from .util import _json_safe
+
+# Неблокирующий структурный лог для пакетного пути.
+# Горячий путь только кладёт кортеж в ограниченное кольцо (deque.append
+# атомарен под GIL, без lock); JSON форматирует и пишет пачками фоновый
+# поток. Кольцо полно — запись отбрасывается и считается, поток пакетов
+# на stdout не ждёт никогда.
+
+# (ts, level, key, name, fields); key — "event" | "msg"
+Record = Tuple[float, str, str, str, Mapping[str, Any]]
+
+
+class _Bucket:
+    __slots__ = ("rate", "tokens", "last")
+
+    def __init__(self, rate: float) -> None:
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+
+class LogPipe:
+    def __init__(
+        self,
+        capacity: int = 8192,
+        batch: int = 512,
+        flush_interval: float = 0.2,
+        sample: Optional[Mapping[str, int]] = None,
+        rate_limit: Optional[Mapping[str, float]] = None,
+        stream: Optional[IO[str]] = None,
+    ) -> None:
+        self.capacity = max(1, capacity)
+        self.batch = max(1, batch)
+        self.flush_interval = flush_interval
+        # sample: {"syn_seen": 10} — пишем каждую 10-ю запись события
+        self._sample: Dict[str, int] = {k: max(1, int(v)) for k, v in (sample or {}).items()}
+        self._sample_n: Dict[str, int] = {k: 0 for k in self._sample}
+        # rate_limit: {"syn_seen": 1000} — не больше 1000 записей/с
+        self._buckets: Dict[str, _Bucket] = {k: _Bucket(float(v)) for k, v in (rate_limit or {}).items()}
+        self._stream = stream
+        self._q: Deque[Record] = collections.deque()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats: Dict[str, int] = {
+            "written": 0,
+            "dropped_full": 0,
+            "sampled_out": 0,
+            "rate_limited": 0,
+            "write_errors": 0,
+        }
+
+    # ---- hot path ----
+
+    def emit(self, name: str, level: str = "info", key: str = "event", **fields: Any) -> bool:
+        every = self._sample.get(name)
+        if every is not None:
+            n = self._sample_n[name] + 1
+            self._sample_n[name] = n
+            if n % every:
+                self.stats["sampled_out"] += 1
+                return False
+        bucket = self._buckets.get(name)
+        if bucket is not None and not bucket.take():
+            self.stats["rate_limited"] += 1
+            return False
+        q = self._q
+        if len(q) >= self.capacity:
+            self.stats["dropped_full"] += 1
+            return False
+        q.append((time.time(), level, key, name, fields))
+        if len(q) >= self.batch:
+            self._wake.set()
+        if self._thread is None:
+            self.start()
+        return True
+
+    # ---- writer ----
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="weaver-logpipe", daemon=True)
+        self._thread.start()
+
+    def _format(self, rec: Record) -> str:
+        ts, level, key, name, fields = rec
+        doc = {"ts": ts, "level": level, key: name}
+        doc.update(fields)
+        try:
+            return json.dumps(doc, ensure_ascii=False, default=_json_safe)
+        except (TypeError, ValueError):
+            return json.dumps({k: _json_safe(v) for k, v in doc.items()}, ensure_ascii=False)
+
+    def flush(self) -> None:
+        q = self._q
+        out = sys.stdout if self._stream is None else self._stream
+        while q:
+            lines = []
+            for _ in range(min(self.batch, len(q))):
+                lines.append(self._format(q.popleft()))
+            try:
+                out.write("\n".join(lines) + "\n")
+                out.flush()
+                self.stats["written"] += len(lines)
+            except (OSError, ValueError):
+                self.stats["write_errors"] += 1
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+        self.flush()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2.0)
+        self.flush()
+
+
+_pipe: Optional[LogPipe] = None
+
+
+def configure(cfg: Optional[Mapping[str, Any]] = None) -> LogPipe:
+    """
+    cfg — секция `logging` конфига handler'а. Вызывать в том процессе,
+    который будет логировать (после fork у воркера — свой поток-писатель).
+    """
+    global _pipe
+    cfg = cfg or {}
+    if _pipe is not None:
+        _pipe.close()
+    _pipe = LogPipe(
+        capacity=int(cfg.get("capacity", 8192)),
+        batch=int(cfg.get("batch", 512)),
+        flush_interval=float(cfg.get("flush_interval", 0.2)),
+        sample=cfg.get("sample"),
+        rate_limit=cfg.get("rate_limit"),
+    )
+    return _pipe
+
+
+def get_pipe() -> LogPipe:
+    return _pipe if _pipe is not None else configure()
+
+
+def log_event(event: str, **fields: Any) -> bool:
+    return get_pipe().emit(event, **fields)
+
+
+@atexit.register
+def _flush_at_exit() -> None:
+    if _pipe is not None:
+        _pipe.close()
@@ -1,41 +1,50 @@
 from __future__ import annotations
-import os, time, json, random, hashlib, threading
+import os, time, random, hashlib
 import yaml
-from http.server import BaseHTTPRequestHandler, HTTPServer
 
 from netfilterqueue import NetfilterQueue
-from scapy.all import IPv6, TCP
+
+from . import health, logpipe
+from .headers import debug_decode, parse_syn
+from .health import HealthRegistry
+from .logpipe import log_event
+from .nflog import NflogConsumer
+from .nfq import NfqConsumer
+from .telemetry import Shard, queue_backends, render_local
+
+# scapy нужен только пути, который переписывает SYN (callback/apply_persona),
+# и как отладочный декодер; observe обходится headers.parse_syn
+try:
+    from scapy.all import IPv6, TCP
+except ImportError:  # pragma: no cover
+    IPv6 = TCP = None
 
 CFG_PATH = os.environ.get("WEAVER_CONFIG", "/app/config/config.yaml")
 NFQ_NUM = int(os.environ.get("NFQUEUE_NUM", "0"))
 
-# ---- health ----
-_last_seen = 0.0
-_health_lock = threading.Lock()
-
-def _health_ok(within=60.0):
-    with _health_lock:
-        return (time.time() - _last_seen) <= within
-
-def _mark_seen():
-    global _last_seen
-    with _health_lock:
-        _last_seen = time.time()
-
-class HealthHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        ok = _health_ok()
-        body = json.dumps({"ok": ok, "last_seen": _last_seen}).encode()
-        self.send_response(200 if ok else 500)
-        self.send_header("content-type", "application/json")
-        self.end_headers()
-        self.wfile.write(body)
-    def log_message(self, *a):  # quiet
-        pass
+PERSONAS = {}
+SELECTION = {}
+NFQ_DROP_ON_ERR = False
+NFQ_CFG = {}
 
-def start_health_server(port=9090):
-    t = threading.Thread(target=lambda: HTTPServer(('127.0.0.1', port), HealthHandler).serve_forever(), daemon=True)
-    t.start()
+# ---- health ----
+HEALTH = HealthRegistry([NFQ_NUM])
+_ready = False
+
+# воркер супервизора подменяет на запись в свой слот общего реестра
+_on_seen = HEALTH.writer(NFQ_NUM)
+# счётчики SYN/вердиктов/латентности; у воркера — shard в shared memory
+TELEMETRY = Shard()
+
+def start_health_server(port=9090, stale_after=60.0, backend="nfqueue"):
+    health.start(
+        f"127.0.0.1:{port}",
+        HEALTH,
+        metrics=lambda: render_local({NFQ_NUM: TELEMETRY}, last_seen=HEALTH.snapshot(),
+                                     backends={NFQ_NUM: backend}),
+        ready=lambda: _ready,
+        stale_after=stale_after,
+    )
 
 # ---- personas ----
 class Persona:
@@ -55,7 +64,7 @@ def load_config(path):
         )
     sel = cfg.get('selection', {"mode":"weighted","weighted":[{"persona":list(personas)[0],"weight":1}]})
     nfq = cfg.get('nfqueue', {"number": NFQ_NUM, "drop_on_error": False, "health_port": 9090})
-    return personas, sel, nfq
+    return personas, sel, nfq, cfg.get('logging') or {}
 
 def stable_choice_weighted(personas, sel, key_bytes: bytes):
     # deterministic pick by hashing key -> [0,1)
@@ -102,56 +111,144 @@ def apply_persona(pkt: IPv6, persona: Persona):
     return pkt
 
 def callback(packet):
+    t0 = time.perf_counter()
     try:
         payload = packet.get_payload()
-        pkt = IPv6(payload)
-        if not pkt.haslayer(TCP):
-            packet.accept(); return
-        tcp = pkt.getlayer(TCP)
-        # только первичный SYN (без ACK)
-        if not (tcp.flags & 0x02) or (tcp.flags & 0x10):
+        # классификация по сырому буферу: не-TCP, не первичный SYN и IPv4
+        # уходят сразу, scapy собирается только для SYN, который переписываем
+        h = parse_syn(payload)
+        if h is None or h.family != 6:
             packet.accept(); return
 
-        key = f"{pkt.src}|{pkt.dst}|{tcp.sport}|{tcp.dport}|6".encode()
+        key = f"{h.src_str()}|{h.dst_str()}|{h.sport}|{h.dport}|6".encode()
         persona = stable_choice_weighted(PERSONAS, SELECTION, key)
-        new_pkt = apply_persona(pkt, persona)
+        new_pkt = apply_persona(IPv6(payload), persona)
 
         packet.set_payload(bytes(new_pkt))
         packet.accept()
-        _mark_seen()
-        print(json.dumps({
-            "ts": time.time(),
-            "event": "syn_modified",
-            "persona": persona.name,
-            "dst": pkt.dst,
-            "dport": tcp.dport
-        }), flush=True)
+        TELEMETRY.verdict(True)
+        TELEMETRY.syn(6, h.dport, time.perf_counter() - t0)
+        _on_seen()
+        log_event("syn_modified", persona=persona.name, dst=h.dst_str(), dport=h.dport)
     except Exception as e:
-        print(json.dumps({"ts": time.time(), "event": "error", "err": str(e)}), flush=True)
+        TELEMETRY.error()
+        log_event("error", level="error", err=str(e))
         if NFQ_DROP_ON_ERR:
             packet.drop()
         else:
             packet.accept()
+        TELEMETRY.verdict(not NFQ_DROP_ON_ERR)
 
-if __name__ == "__main__":
-    PERSONAS, SELECTION, nfq = load_config(CFG_PATH)
-    NFQ_NUM = int(nfq.get("number", NFQ_NUM))
-    NFQ_DROP_ON_ERR = bool(nfq.get("drop_on_error", False))
-    start_health_server(int(nfq.get("health_port", 9090)))
-
-    print(json.dumps({
-        "ts": time.time(),
-        "event": "handler_start",
-        "nfqueue": NFQ_NUM,
-        "personas": list(PERSONAS.keys()),
-        "selection": SELECTION
-    }), flush=True)
+def observe(payload, hw_proto=0):
+    # batch-консьюмер: пакет уже ACCEPT, тут только смотрим заголовки
+    TELEMETRY.verdict(True)
+    observe_log(payload, hw_proto)
 
+def observe_log(payload, hw_proto=0):
+    # NFLOG: копия заголовков, пакет ядро уже пропустило — вердикта нет
+    t0 = time.perf_counter()
+    try:
+        h = parse_syn(payload)
+    except Exception:
+        TELEMETRY.error()
+        raise
+    if h is None:
+        return
+    TELEMETRY.syn(h.family, h.dport, time.perf_counter() - t0)
+    _on_seen()
+    if NFQ_CFG.get("debug_decode"):
+        log_event("syn_seen", src=h.src_str(), dst=h.dst_str(), dport=h.dport,
+                  decoded=debug_decode(payload))
+    else:
+        log_event("syn_seen", src=h.src_str(), dst=h.dst_str(), dport=h.dport)
+
+def _log_nfq_stats(consumer):
+    pipe = logpipe.get_pipe()
+    log_event(
+        "nfq_stats",
+        nfqueue=consumer.queue_num,
+        **consumer.stats,
+        **consumer.kernel_stats(),
+        **{f"log_{k}": v for k, v in pipe.stats.items()}
+    )
+
+def setup(path=CFG_PATH):
+    global PERSONAS, SELECTION, NFQ_DROP_ON_ERR, NFQ_CFG
+    PERSONAS, SELECTION, nfq, log_cfg = load_config(path)
+    logpipe.configure(log_cfg)
+    NFQ_DROP_ON_ERR = bool(nfq.get("drop_on_error", False))
+    NFQ_CFG = nfq
+    return nfq
+
+def run_batch_queue(num):
+    # observe-only: копируем только заголовки, вердикты пачкой, fail-open
+    global _ready
+    c = NfqConsumer(
+        num,
+        copy_range=int(NFQ_CFG.get("copy_range", 128)),
+        max_len=int(NFQ_CFG.get("max_len", 0xffff)),
+        rcvbuf=int(NFQ_CFG.get("rcvbuf", 8 * 1024 * 1024)),
+        fail_open=bool(NFQ_CFG.get("fail_open", True)),
+        batch=int(NFQ_CFG.get("batch", 64)),
+    )
+    _ready = True
+    try:
+        c.run(observe, on_tick=_log_nfq_stats, tick=float(NFQ_CFG.get("stats_interval", 10.0)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        c.close()
+
+def run_log_group(num):
+    # observe без удержания пакетов: `log group N snaplen 128` в nft
+    global _ready
+    c = NflogConsumer(
+        num,
+        snaplen=int(NFQ_CFG.get("copy_range", 128)),
+        rcvbuf=int(NFQ_CFG.get("rcvbuf", 8 * 1024 * 1024)),
+        qthresh=int(NFQ_CFG.get("nflog_qthresh", 32)),
+        timeout=float(NFQ_CFG.get("nflog_timeout", 0.1)),
+        batch=int(NFQ_CFG.get("batch", 64)),
+    )
+    _ready = True
+    try:
+        c.run(observe_log, on_tick=_log_nfq_stats, tick=float(NFQ_CFG.get("stats_interval", 10.0)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        c.close()
+
+def run_queue(num, on_seen=None, telemetry=None, backend="nfqueue"):
+    global _on_seen, TELEMETRY, _ready
+    if on_seen is not None:
+        _on_seen = on_seen
+    if telemetry is not None:
+        TELEMETRY = telemetry
+    if backend == "nflog":
+        run_log_group(num)
+        return
+    if NFQ_CFG.get("consumer", "netfilterqueue") == "batch":
+        run_batch_queue(num)
+        return
     q = NetfilterQueue()
-    q.bind(NFQ_NUM, callback, 0xffff)
+    q.bind(num, callback, 0xffff)
+    _ready = True
     try:
         q.run()
     except KeyboardInterrupt:
         pass
     finally:
         q.unbind()
+
+if __name__ == "__main__":
+    nfq = setup(CFG_PATH)
+    NFQ_NUM = int(nfq.get("number", NFQ_NUM))
+    HEALTH = HealthRegistry([NFQ_NUM])
+    _on_seen = HEALTH.writer(NFQ_NUM)
+    with open(CFG_PATH, 'r') as f:
+        backend = queue_backends(yaml.safe_load(f) or {}).get(NFQ_NUM, "nfqueue")
+    start_health_server(int(nfq.get("health_port", 9090)), backend=backend)
+
+    log_event("handler_start", nfqueue=NFQ_NUM, personas=list(PERSONAS.keys()), selection=SELECTION)
+
+    run_queue(NFQ_NUM, backend=backend)
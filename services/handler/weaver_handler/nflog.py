@@ -0,0 +1,191 @@
+from __future__ import annotations
+
+import errno
+import select
+import socket
+import struct
+import time
+from typing import Callable, Dict, Optional
+
+from .nfq import NETLINK_NETFILTER, PacketHandler, _align, _attr
+
+# Потребитель nfnetlink_log (NFLOG) без libnetfilter_log (только stdlib).
+# В отличие от NFQUEUE пакет в ядре не задерживается: правило
+# `log group N snaplen 128` отдаёт копию заголовков и сразу пропускает
+# пакет дальше. Не успеваем читать — ядро теряет копии (ENOBUFS),
+# а не пакеты: наблюдение никогда не тормозит соединения.
+
+NFNL_SUBSYS_ULOG = 4
+NFULNL_MSG_PACKET = 0
+NFULNL_MSG_CONFIG = 1
+
+NFULNL_CFG_CMD_BIND = 1
+NFULNL_CFG_CMD_UNBIND = 2
+
+NFULNL_COPY_PACKET = 2
+
+NFULA_CFG_CMD = 1
+NFULA_CFG_MODE = 2
+NFULA_CFG_NLBUFSIZ = 3
+NFULA_CFG_TIMEOUT = 4       # сотые секунды
+NFULA_CFG_QTHRESH = 5
+
+NFULA_PACKET_HDR = 1
+NFULA_PAYLOAD = 9
+
+NLM_F_REQUEST = 0x001
+NLM_F_ACK = 0x004
+NLMSG_ERROR = 2
+
+_NLMSGHDR = struct.Struct("=IHHII")
+_NFGENMSG = struct.Struct("=BBH")       # family, version, res_id (big-endian!)
+_NLMSGERR = struct.Struct("=i")
+_NLATTR = struct.Struct("=HH")
+_PKT_HDR = struct.Struct(">HB")         # hw_protocol, hook
+
+NFLOG_PROC = "/proc/net/netfilter/nfnetlink_log"
+
+
+class NflogConsumer:
+    """
+    Тот же интерфейс, что у nfq.NfqConsumer (run/on_packet/on_tick/stats),
+    но без вердиктов. qthresh/timeout — ядро копит до qthresh пакетов
+    (или timeout) в одно netlink-сообщение: меньше recv на пакет;
+    batch — сколько сообщений читать за один select, как у NfqConsumer.
+    """
+
+    def __init__(
+        self,
+        group: int,
+        snaplen: int = 128,
+        rcvbuf: int = 8 * 1024 * 1024,
+        qthresh: int = 32,
+        timeout: float = 0.1,
+        nlbufsiz: int = 128 * 1024,
+        batch: int = 64,
+    ) -> None:
+        self.queue_num = group
+        self.snaplen = snaplen
+        self.batch = max(1, batch)
+        self.stats: Dict[str, int] = {
+            "packets": 0,
+            "enobufs": 0,
+            "errors": 0,
+        }
+        self._seq = 0
+        self._buf = bytearray(max(nlbufsiz, 64 * 1024) + 4096)
+        self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_NETFILTER)
+        self._set_rcvbuf(rcvbuf)
+        self._sock.bind((0, 0))
+        self._configure(qthresh, timeout, nlbufsiz)
+
+    def _set_rcvbuf(self, size: int) -> None:
+        force = getattr(socket, "SO_RCVBUFFORCE", 33)
+        try:
+            self._sock.setsockopt(socket.SOL_SOCKET, force, size)
+        except OSError:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+
+    def _request(self, attrs: bytes) -> None:
+        self._seq += 1
+        body = _NFGENMSG.pack(socket.AF_UNSPEC, 0, socket.htons(self.queue_num)) + attrs
+        mtype = (NFNL_SUBSYS_ULOG << 8) | NFULNL_MSG_CONFIG
+        self._sock.send(_NLMSGHDR.pack(_NLMSGHDR.size + len(body), mtype, NLM_F_REQUEST | NLM_F_ACK, self._seq, 0) + body)
+        while True:
+            data = self._sock.recv(8192)
+            _ln, mtype, _fl, seq, _pid = _NLMSGHDR.unpack_from(data, 0)
+            if mtype == NLMSG_ERROR and seq == self._seq:
+                (err,) = _NLMSGERR.unpack_from(data, _NLMSGHDR.size)
+                if err:
+                    raise OSError(-err, f"nflog group {self.queue_num}: config failed")
+                return
+
+    def _configure(self, qthresh: int, timeout: float, nlbufsiz: int) -> None:
+        self._request(_attr(NFULA_CFG_CMD, struct.pack("B", NFULNL_CFG_CMD_BIND)))
+        self._request(_attr(NFULA_CFG_MODE, struct.pack(">IBx", self.snaplen, NFULNL_COPY_PACKET)))
+        self._request(_attr(NFULA_CFG_NLBUFSIZ, struct.pack(">I", nlbufsiz)))
+        self._request(_attr(NFULA_CFG_QTHRESH, struct.pack(">I", max(1, qthresh))))
+        self._request(_attr(NFULA_CFG_TIMEOUT, struct.pack(">I", max(1, int(timeout * 100)))))
+
+    def _parse(self, view: memoryview, n: int, on_packet: PacketHandler) -> None:
+        off = 0
+        while off + _NLMSGHDR.size <= n:
+            ln, mtype, _fl, _seq, _pid = _NLMSGHDR.unpack_from(view, off)
+            if ln < _NLMSGHDR.size:
+                break
+            if mtype == (NFNL_SUBSYS_ULOG << 8) | NFULNL_MSG_PACKET:
+                proto = 0
+                payload: Optional[memoryview] = None
+                a = off + _NLMSGHDR.size + _NFGENMSG.size
+                end = off + ln
+                while a + _NLATTR.size <= end:
+                    alen, kind = _NLATTR.unpack_from(view, a)
+                    if alen < _NLATTR.size:
+                        break
+                    kind &= 0x7FFF
+                    if kind == NFULA_PACKET_HDR:
+                        proto, _hook = _PKT_HDR.unpack_from(view, a + _NLATTR.size)
+                    elif kind == NFULA_PAYLOAD:
+                        payload = view[a + _NLATTR.size: a + alen]
+                    a += _align(alen)
+                self.stats["packets"] += 1
+                if payload is not None:
+                    try:
+                        on_packet(payload, proto)
+                    except Exception:
+                        self.stats["errors"] += 1
+            off += _align(ln)
+
+    def run(
+        self,
+        on_packet: PacketHandler,
+        on_tick: Optional[Callable[["NflogConsumer"], None]] = None,
+        tick: float = 10.0,
+    ) -> None:
+        view = memoryview(self._buf)
+        sock = self._sock
+        next_tick = time.monotonic() + tick
+        while True:
+            r, _, _ = select.select([sock], [], [], tick)
+            if r:
+                # не больше batch сообщений за проход: под постоянной нагрузкой
+                # сокет не пустеет, а on_tick (статистика) должен выполняться
+                for _ in range(self.batch):
+                    try:
+                        n = sock.recv_into(view, len(view), socket.MSG_DONTWAIT)
+                    except BlockingIOError:
+                        break
+                    except OSError as e:
+                        if e.errno == errno.ENOBUFS:
+                            # потеряны копии, не пакеты — ядро их уже пропустило
+                            self.stats["enobufs"] += 1
+                            continue
+                        raise
+                    self._parse(view, n, on_packet)
+            now = time.monotonic()
+            if on_tick is not None and now >= next_tick:
+                next_tick = now + tick
+                on_tick(self)
+
+    def kernel_stats(self) -> Dict[str, int]:
+        return read_kernel_stats(self.queue_num)
+
+    def close(self) -> None:
+        try:
+            self._request(_attr(NFULA_CFG_CMD, struct.pack("B", NFULNL_CFG_CMD_UNBIND)))
+        except OSError:
+            pass
+        self._sock.close()
+
+
+def read_kernel_stats(group: int) -> Dict[str, int]:
+    """nfnetlink_log: счётчиков потерь у ядра нет, только длина очереди."""
+    try:
+        with open(NFLOG_PROC, "r", encoding="ascii") as f:
+            for line in f:
+                cols = line.split()
+                if len(cols) >= 3 and int(cols[0]) == group:
+                    return {"log_qlen": int(cols[2])}
+    except (OSError, ValueError):
+        pass
+    return {}
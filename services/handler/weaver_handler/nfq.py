@@ -0,0 +1,231 @@
+from __future__ import annotations
+
+import errno
+import select
+import socket
+import struct
+import time
+from typing import Callable, Dict, Optional
+
+# Потребитель nfnetlink_queue без libnetfilter_queue (только stdlib).
+# Только observe: пакет всегда ACCEPT, поэтому ядру достаточно
+# скопировать заголовки (copy_range), а вердикты отдаются пачкой —
+# один NFQNL_MSG_VERDICT_BATCH на все id <= последнего прочитанного.
+
+NETLINK_NETFILTER = 12
+
+NFNL_SUBSYS_QUEUE = 3
+NFQNL_MSG_PACKET = 0
+NFQNL_MSG_VERDICT = 1
+NFQNL_MSG_CONFIG = 2
+NFQNL_MSG_VERDICT_BATCH = 3
+
+NFQNL_CFG_CMD_BIND = 1
+NFQNL_CFG_CMD_UNBIND = 2
+
+NFQNL_COPY_PACKET = 2
+
+NFQA_CFG_CMD = 1
+NFQA_CFG_PARAMS = 2
+NFQA_CFG_QUEUE_MAXLEN = 3
+NFQA_CFG_MASK = 4
+NFQA_CFG_FLAGS = 5
+NFQA_CFG_F_FAIL_OPEN = 0x1
+
+NFQA_PACKET_HDR = 1
+NFQA_VERDICT_HDR = 2
+NFQA_PAYLOAD = 10
+
+NF_ACCEPT = 1
+
+NLM_F_REQUEST = 0x001
+NLM_F_ACK = 0x004
+NLMSG_ERROR = 2
+
+_NLMSGHDR = struct.Struct("=IHHII")
+_NFGENMSG = struct.Struct("=BBH")       # family, version, res_id (big-endian!)
+_NLATTR = struct.Struct("=HH")
+_NLMSGERR = struct.Struct("=i")
+_PKT_HDR = struct.Struct(">IHB")        # packet_id, hw_protocol, hook
+_VERDICT_HDR = struct.Struct(">II")     # verdict, id
+
+NFQ_PROC = "/proc/net/netfilter/nfnetlink_queue"
+
+# on_packet(payload, hw_protocol); payload — memoryview, валиден только внутри вызова
+PacketHandler = Callable[[memoryview, int], None]
+
+
+def _align(n: int) -> int:
+    return (n + 3) & ~3
+
+
+def _attr(kind: int, payload: bytes) -> bytes:
+    ln = _NLATTR.size + len(payload)
+    return _NLATTR.pack(ln, kind) + payload + b"\0" * (_align(ln) - ln)
+
+
+def read_kernel_stats(queue_num: int) -> Dict[str, int]:
+    """
+    Счётчики ядра по очереди: queue_total, queue_dropped (переполнение
+    очереди), user_dropped (netlink не смог доставить — мал rcvbuf).
+    """
+    try:
+        with open(NFQ_PROC, "r", encoding="ascii") as f:
+            for line in f:
+                cols = line.split()
+                if len(cols) >= 7 and int(cols[0]) == queue_num:
+                    return {
+                        "queue_total": int(cols[2]),
+                        "queue_dropped": int(cols[5]),
+                        "user_dropped": int(cols[6]),
+                    }
+    except (OSError, ValueError):
+        pass
+    return {}
+
+
+class NfqConsumer:
+    def __init__(
+        self,
+        queue_num: int,
+        copy_range: int = 128,
+        max_len: int = 0xFFFF,
+        rcvbuf: int = 8 * 1024 * 1024,
+        fail_open: bool = True,
+        batch: int = 64,
+    ) -> None:
+        self.queue_num = queue_num
+        self.copy_range = copy_range
+        self.batch = max(1, batch)
+        self.stats: Dict[str, int] = {
+            "packets": 0,
+            "verdicts": 0,
+            "enobufs": 0,
+            "errors": 0,
+        }
+        self._seq = 0
+        # copy_range 0 — ядро копирует пакет целиком (до 64К)
+        self._buf = bytearray((copy_range if copy_range > 0 else 0xFFFF) + 4096)
+        self._sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_NETFILTER)
+        self._set_rcvbuf(rcvbuf)
+        self._sock.bind((0, 0))
+        self._configure(max_len, fail_open)
+
+    def _set_rcvbuf(self, size: int) -> None:
+        # SO_RCVBUFFORCE обходит net.core.rmem_max (нужен CAP_NET_ADMIN)
+        force = getattr(socket, "SO_RCVBUFFORCE", 33)
+        try:
+            self._sock.setsockopt(socket.SOL_SOCKET, force, size)
+        except OSError:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, size)
+
+    def _msg(self, msg_type: int, flags: int, attrs: bytes) -> bytes:
+        self._seq += 1
+        body = _NFGENMSG.pack(socket.AF_UNSPEC, 0, socket.htons(self.queue_num)) + attrs
+        mtype = (NFNL_SUBSYS_QUEUE << 8) | msg_type
+        return _NLMSGHDR.pack(_NLMSGHDR.size + len(body), mtype, flags, self._seq, 0) + body
+
+    def _request(self, attrs: bytes) -> None:
+        self._sock.send(self._msg(NFQNL_MSG_CONFIG, NLM_F_REQUEST | NLM_F_ACK, attrs))
+        while True:
+            data = self._sock.recv(8192)
+            ln, mtype, _fl, seq, _pid = _NLMSGHDR.unpack_from(data, 0)
+            if mtype == NLMSG_ERROR and seq == self._seq:
+                (err,) = _NLMSGERR.unpack_from(data, _NLMSGHDR.size)
+                if err:
+                    raise OSError(-err, f"nfqueue {self.queue_num}: config failed")
+                return
+
+    def _configure(self, max_len: int, fail_open: bool) -> None:
+        self._request(_attr(NFQA_CFG_CMD, struct.pack(">BxH", NFQNL_CFG_CMD_BIND, 0)))
+        self._request(_attr(NFQA_CFG_PARAMS, struct.pack(">IB", self.copy_range, NFQNL_COPY_PACKET)))
+        self._request(_attr(NFQA_CFG_QUEUE_MAXLEN, struct.pack(">I", max_len)))
+        if fail_open:
+            # очередь переполнена — ядро пропускает пакет, а не дропает
+            flags = struct.pack(">I", NFQA_CFG_F_FAIL_OPEN)
+            self._request(_attr(NFQA_CFG_FLAGS, flags) + _attr(NFQA_CFG_MASK, flags))
+
+    def _verdict_batch(self, last_id: int) -> None:
+        hdr = _attr(NFQA_VERDICT_HDR, _VERDICT_HDR.pack(NF_ACCEPT, last_id))
+        self._sock.send(self._msg(NFQNL_MSG_VERDICT_BATCH, NLM_F_REQUEST, hdr))
+        self.stats["verdicts"] += 1
+
+    def _parse(self, view: memoryview, n: int, on_packet: PacketHandler) -> Optional[int]:
+        """Разбирает один recv; возвращает максимальный packet_id."""
+        last: Optional[int] = None
+        off = 0
+        while off + _NLMSGHDR.size <= n:
+            ln, mtype, _fl, _seq, _pid = _NLMSGHDR.unpack_from(view, off)
+            if ln < _NLMSGHDR.size:
+                break
+            if mtype == (NFNL_SUBSYS_QUEUE << 8) | NFQNL_MSG_PACKET:
+                pid = -1
+                proto = 0
+                payload: Optional[memoryview] = None
+                a = off + _NLMSGHDR.size + _NFGENMSG.size
+                end = off + ln
+                while a + _NLATTR.size <= end:
+                    alen, kind = _NLATTR.unpack_from(view, a)
+                    if alen < _NLATTR.size:
+                        break
+                    kind &= 0x7FFF
+                    if kind == NFQA_PACKET_HDR:
+                        pid, proto, _hook = _PKT_HDR.unpack_from(view, a + _NLATTR.size)
+                    elif kind == NFQA_PAYLOAD:
+                        payload = view[a + _NLATTR.size: a + alen]
+                    a += _align(alen)
+                if pid >= 0:
+                    self.stats["packets"] += 1
+                    if payload is not None:
+                        try:
+                            on_packet(payload, proto)
+                        except Exception:
+                            self.stats["errors"] += 1
+                    last = pid
+            off += _align(ln)
+        return last
+
+    def run(
+        self,
+        on_packet: PacketHandler,
+        on_tick: Optional[Callable[["NfqConsumer"], None]] = None,
+        tick: float = 10.0,
+    ) -> None:
+        view = memoryview(self._buf)
+        sock = self._sock
+        next_tick = time.monotonic() + tick
+        while True:
+            r, _, _ = select.select([sock], [], [], tick)
+            if r:
+                last: Optional[int] = None
+                # вычитываем всё, что накопилось (до batch), потом один вердикт
+                for _ in range(self.batch):
+                    try:
+                        n = sock.recv_into(view, len(view), socket.MSG_DONTWAIT)
+                    except BlockingIOError:
+                        break
+                    except OSError as e:
+                        if e.errno == errno.ENOBUFS:
+                            # ядро не смогло положить сообщения в rcvbuf — они потеряны
+                            self.stats["enobufs"] += 1
+                            continue
+                        raise
+                    pid = self._parse(view, n, on_packet)
+                    if pid is not None:
+                        last = pid
+                if last is not None:
+                    self._verdict_batch(last)
+            now = time.monotonic()
+            if on_tick is not None and now >= next_tick:
+                next_tick = now + tick
+                on_tick(self)
+
+    def kernel_stats(self) -> Dict[str, int]:
+        return read_kernel_stats(self.queue_num)
+
+    def close(self) -> None:
+        try:
+            self._request(_attr(NFQA_CFG_CMD, struct.pack(">BxH", NFQNL_CFG_CMD_UNBIND, 0)))
+        except OSError:
+            pass
+        self._sock.close()
@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import signal
+import threading
+import time
+from typing import Any, Dict, List, Optional, Sequence
+
+import yaml
+
+from . import health
+from .health import HealthRegistry
+from .telemetry import Shard, queue_backends, queue_groups, render_local
+
+# Супервизор: по воркеру (процессу) на каждую NFQUEUE из конфига.
+# Группа с `nfqueue_range: {start: A, end: B}` даёт A..B — nft раздаёт
+# потоки по ним через `queue num A-B fanout`, и каждое ядро обслуживает
+# свою очередь в своём процессе (без GIL на всех). Группа с
+# observe_backend: nflog — тот же номер, но это NFLOG log group: воркер
+# читает копии заголовков, пакеты в ядре не ждут.
+
+RESTART_BACKOFF_MAX = 30.0
+
+
+def queues_from_config(cfg: Dict[str, Any]) -> List[int]:
+    out: List[int] = []
+    for g in cfg.get("proxy_groups") or []:
+        qr = g.get("nfqueue_range") or {}
+        if qr:
+            out.extend(range(int(qr["start"]), int(qr["end"]) + 1))
+        elif g.get("nfqueue_num") is not None:
+            out.append(int(g["nfqueue_num"]))
+    if not out:
+        nfq = cfg.get("nfqueue") or {}
+        out.append(int(nfq.get("number", os.environ.get("NFQUEUE_NUM", "0"))))
+    return sorted(set(out))
+
+
+def health_bind(cfg: Dict[str, Any]) -> str:
+    obs = cfg.get("observability") or {}
+    if obs.get("health_bind"):
+        return str(obs["health_bind"])
+    nfq = cfg.get("nfqueue") or {}
+    return f"127.0.0.1:{int(nfq.get('health_port', 9090))}"
+
+
+def _log(event: str, **kw: Any) -> None:
+    print(json.dumps({"ts": time.time(), "event": event, **kw}), flush=True)
+
+
+def _worker(
+    cfg_path: str,
+    qnum: int,
+    cpu: Optional[int],
+    registry: HealthRegistry,
+    shard: Shard,
+    backend: str = "nfqueue",
+) -> None:
+    # импорт здесь: NetfilterQueue/scapy нужны только в воркере
+    from . import main as handler
+
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except OSError as e:
+            _log("worker_pin_failed", nfqueue=qnum, cpu=cpu, err=str(e))
+    handler.setup(cfg_path)
+
+    _log("worker_start", nfqueue=qnum, backend=backend, cpu=cpu, pid=os.getpid())
+    handler.run_queue(qnum, on_seen=registry.writer(qnum), telemetry=shard, backend=backend)
+
+
+class Supervisor:
+    def __init__(
+        self,
+        cfg_path: str,
+        queues: Sequence[int],
+        cpus: Sequence[int],
+        groups: Optional[Dict[int, str]] = None,
+        backends: Optional[Dict[int, str]] = None,
+    ) -> None:
+        self.cfg_path = cfg_path
+        self.queues = list(queues)
+        self.cpus = list(cpus)
+        # слоты last-seen в shared memory; пишет только свой воркер, lock не нужен
+        self.registry = HealthRegistry(self.queues, shared=True)
+        # телеметрия: shard на очередь, переживает рестарт воркера (счётчики монотонны)
+        self.shards: Dict[int, Shard] = {q: Shard.shared() for q in self.queues}
+        self.groups = dict(groups or {})
+        # очередь -> nfqueue | nflog; номер nflog — это log group
+        self.backends = dict(backends or {})
+        self.procs: Dict[int, mp.Process] = {}
+        self.backoff: Dict[int, float] = {q: 1.0 for q in self.queues}
+        self._stop = threading.Event()
+
+    def _cpu_for(self, i: int) -> Optional[int]:
+        return self.cpus[i % len(self.cpus)] if self.cpus else None
+
+    def _spawn(self, i: int) -> None:
+        q = self.queues[i]
+        p = mp.Process(
+            target=_worker,
+            args=(self.cfg_path, q, self._cpu_for(i), self.registry, self.shards[q],
+                  self.backends.get(q, "nfqueue")),
+            name=f"weaver-nfq-{q}",
+            daemon=True,
+        )
+        p.start()
+        self.procs[q] = p
+
+    def metrics(self) -> str:
+        return render_local(self.shards, self.groups, last_seen=self.registry.snapshot(), backends=self.backends)
+
+    def ready(self) -> bool:
+        return bool(self.procs) and all(p.is_alive() for p in self.procs.values())
+
+    def run(self, bind: str, stale_after: float = 60.0) -> None:
+        health.start(bind, self.registry, metrics=self.metrics, ready=self.ready, stale_after=stale_after)
+        for i in range(len(self.queues)):
+            self._spawn(i)
+        _log("supervisor_start", nfqueues=self.queues, cpus=self.cpus, health=bind)
+
+        while not self._stop.wait(1.0):
+            for i, q in enumerate(self.queues):
+                p = self.procs[q]
+                if p.is_alive():
+                    continue
+                delay = self.backoff[q]
+                _log("worker_exit", nfqueue=q, code=p.exitcode, restart_in=delay)
+                if self._stop.wait(delay):
+                    break
+                self.backoff[q] = min(delay * 2, RESTART_BACKOFF_MAX)
+                self._spawn(i)
+        self.shutdown()
+
+    def stop(self, *_: Any) -> None:
+        self._stop.set()
+
+    def shutdown(self) -> None:
+        for p in self.procs.values():
+            if p.is_alive():
+                p.terminate()
+        for p in self.procs.values():
+            p.join(timeout=5)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--config", default=os.environ.get("WEAVER_CONFIG", "/app/config/config.yaml"))
+    args = ap.parse_args()
+
+    with open(args.config, "r", encoding="utf-8") as f:
+        cfg = yaml.safe_load(f) or {}
+    nfq = cfg.get("nfqueue") or {}
+    queues = queues_from_config(cfg)
+    if nfq.get("pin_cpus", True):
+        cpus = [int(c) for c in nfq.get("cpus") or sorted(os.sched_getaffinity(0))]
+    else:
+        cpus = []
+
+    sup = Supervisor(args.config, queues, cpus, queue_groups(cfg), queue_backends(cfg))
+    signal.signal(signal.SIGTERM, sup.stop)
+    signal.signal(signal.SIGINT, sup.stop)
+    obs = cfg.get("observability") or {}
+    sup.run(health_bind(cfg), float(obs.get("health_interval_sec", 60)))
+
+
+if __name__ == "__main__":
+    main()
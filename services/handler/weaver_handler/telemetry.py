@@ -0,0 +1,256 @@
+from __future__ import annotations
+
+import bisect
+import multiprocessing as mp
+from array import array
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+# Телеметрия SYN по очередям. Один Shard — одна очередь и ровно один
+# писатель (её воркер), поэтому запись идёт без lock: обычные += по
+# массиву в shared memory (mp.RawArray). Супервизор только читает и
+# рендерит /metrics в текстовом формате Prometheus; метка group
+# берётся из конфига (очередь -> группа), в горячем пути её нет.
+
+# границы гистограммы времени обработки пакета, секунды
+LATENCY_BUCKETS: Tuple[float, ...] = (
+    5e-6, 10e-6, 25e-6, 50e-6, 100e-6, 250e-6, 500e-6,
+    1e-3, 2.5e-3, 5e-3, 10e-3, 25e-3, 100e-3,
+)
+
+# раскладка vals
+SYN_V4 = 0
+SYN_V6 = 1
+ACCEPT = 2
+DROP = 3
+ERRORS = 4
+LAT_SUM = 5
+PORT_OTHER = 6        # порты, не влезшие в таблицу
+_HIST = 7             # len(LATENCY_BUCKETS) + 1 (последний — +Inf)
+_NVALS = _HIST + len(LATENCY_BUCKETS) + 1
+
+# таблица портов: открытая адресация, ключ — dport + 1 (0 — пусто)
+PORT_SLOTS = 4096
+_PORT_PROBES = 8
+
+
+class Shard:
+    __slots__ = ("vals", "ports", "port_hits", "_bounds")
+
+    def __init__(self, vals: Any = None, ports: Any = None, port_hits: Any = None) -> None:
+        self.vals = vals if vals is not None else array("d", bytes(8 * _NVALS))
+        self.ports = ports if ports is not None else array("i", bytes(4 * PORT_SLOTS))
+        self.port_hits = port_hits if port_hits is not None else array("d", bytes(8 * PORT_SLOTS))
+        self._bounds = LATENCY_BUCKETS
+
+    @classmethod
+    def shared(cls) -> "Shard":
+        """Shard в shared memory — создать до fork и передать воркеру."""
+        return cls(
+            mp.RawArray("d", _NVALS),
+            mp.RawArray("i", PORT_SLOTS),
+            mp.RawArray("d", PORT_SLOTS),
+        )
+
+    # ---- hot path (один писатель) ----
+
+    def syn(self, family: int, dport: int, latency: float) -> None:
+        v = self.vals
+        v[SYN_V6 if family == 6 else SYN_V4] += 1
+        v[LAT_SUM] += latency
+        v[_HIST + bisect.bisect_left(self._bounds, latency)] += 1
+        self._port(dport)
+
+    def verdict(self, accept: bool) -> None:
+        self.vals[ACCEPT if accept else DROP] += 1
+
+    def error(self) -> None:
+        self.vals[ERRORS] += 1
+
+    def _port(self, dport: int) -> None:
+        key = dport + 1
+        keys = self.ports
+        i = (dport * 40503) & (PORT_SLOTS - 1)
+        for _ in range(_PORT_PROBES):
+            k = keys[i]
+            if k == key:
+                self.port_hits[i] += 1
+                return
+            if k == 0:
+                # порядок важен для читателя: сначала счётчик, потом ключ
+                self.port_hits[i] = 1
+                keys[i] = key
+                return
+            i = (i + 1) & (PORT_SLOTS - 1)
+        self.vals[PORT_OTHER] += 1
+
+    # ---- чтение (супервизор) ----
+
+    def snapshot(self) -> Dict[str, Any]:
+        v = list(self.vals)
+        keys = list(self.ports)
+        hits = list(self.port_hits)
+        return {
+            "syn": {4: v[SYN_V4], 6: v[SYN_V6]},
+            "accept": v[ACCEPT],
+            "drop": v[DROP],
+            "errors": v[ERRORS],
+            "latency_sum": v[LAT_SUM],
+            "latency_hist": v[_HIST:_NVALS],
+            "ports": {k - 1: hits[i] for i, k in enumerate(keys) if k},
+            "port_other": v[PORT_OTHER],
+        }
+
+
+def queue_groups(cfg: Mapping[str, Any]) -> Dict[int, str]:
+    """Очередь -> имя группы по proxy_groups (nfqueue_range или nfqueue_num)."""
+    out: Dict[int, str] = {}
+    for g in cfg.get("proxy_groups") or []:
+        name = str(g.get("name", ""))
+        qr = g.get("nfqueue_range") or {}
+        if qr:
+            for q in range(int(qr["start"]), int(qr["end"]) + 1):
+                out[q] = name
+        elif g.get("nfqueue_num") is not None:
+            out[int(g["nfqueue_num"])] = name
+    return out
+
+
+def queue_backends(cfg: Mapping[str, Any]) -> Dict[int, str]:
+    """Очередь -> observe_backend группы: "nfqueue" (по умолчанию) или "nflog"."""
+    out: Dict[int, str] = {}
+    for g in cfg.get("proxy_groups") or []:
+        backend = str(g.get("observe_backend") or "nfqueue").lower()
+        qr = g.get("nfqueue_range") or {}
+        if qr:
+            for q in range(int(qr["start"]), int(qr["end"]) + 1):
+                out[q] = backend
+        elif g.get("nfqueue_num") is not None:
+            out[int(g["nfqueue_num"])] = backend
+    return out
+
+
+# ---- Prometheus text exposition ----
+
+_LE = tuple(repr(b) for b in LATENCY_BUCKETS) + ("+Inf",)
+
+def _esc(v: Any) -> str:
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(**kw: Any) -> str:
+    return "{" + ",".join(f'{k}="{_esc(v)}"' for k, v in kw.items()) + "}"
+
+
+def _num(x: float) -> str:
+    return str(int(x)) if float(x).is_integer() else repr(float(x))
+
+
+class _Out:
+    # сэмплы одного семейства в выводе должны идти подряд, а цикл
+    # идёт по очередям — копим по семействам, склеиваем в конце
+    def __init__(self) -> None:
+        self.families: Dict[str, List[str]] = {}
+
+    def head(self, name: str, kind: str, help_: str) -> None:
+        if name not in self.families:
+            self.families[name] = [f"# HELP {name} {help_}", f"# TYPE {name} {kind}"]
+
+    def sample(self, name: str, labels: str, value: float, family: Optional[str] = None) -> None:
+        self.families[family or name].append(f"{name}{labels} {_num(value)}")
+
+    def text(self) -> str:
+        return "".join(line + "\n" for lines in self.families.values() for line in lines)
+
+
+def render(
+    shards: Mapping[int, Shard],
+    groups: Optional[Mapping[int, str]] = None,
+    kernel: Optional[Mapping[int, Mapping[str, int]]] = None,
+    last_seen: Optional[Mapping[int, float]] = None,
+) -> str:
+    """
+    kernel — счётчики /proc/net/netfilter/nfnetlink_queue по очереди
+    (nfq.read_kernel_stats): рост queue_dropped/user_dropped — очередь
+    не успевает, и при fail-open/bypass ядро уже пропускает пакеты мимо.
+    Для NFLOG-групп — log_qlen из nfnetlink_log (nflog.read_kernel_stats).
+    """
+    groups = groups or {}
+    o = _Out()
+    by_group_port: Dict[Tuple[str, int], float] = {}
+    by_group_other: Dict[str, float] = {}
+
+    for q in sorted(shards):
+        s = shards[q].snapshot()
+        g = groups.get(q, "")
+        base = dict(queue=q, group=g)
+
+        o.head("weaver_syn_total", "counter", "SYN packets seen by the handler")
+        for fam in (4, 6):
+            o.sample("weaver_syn_total", _labels(**base, family=f"ipv{fam}"), s["syn"][fam])
+
+        o.head("weaver_verdict_total", "counter", "Verdicts issued to the kernel")
+        o.sample("weaver_verdict_total", _labels(**base, verdict="accept"), s["accept"])
+        o.sample("weaver_verdict_total", _labels(**base, verdict="drop"), s["drop"])
+
+        o.head("weaver_errors_total", "counter", "Packets that failed processing")
+        o.sample("weaver_errors_total", _labels(**base), s["errors"])
+
+        h = "weaver_processing_seconds"
+        o.head(h, "histogram", "Per-packet processing time in the handler")
+        acc = 0.0
+        for le, n in zip(_LE, s["latency_hist"]):
+            acc += n
+            o.sample(h + "_bucket", _labels(**base, le=le), acc, family=h)
+        o.sample(h + "_sum", _labels(**base), s["latency_sum"], family=h)
+        o.sample(h + "_count", _labels(**base), acc, family=h)
+
+        for port, n in s["ports"].items():
+            by_group_port[(g, port)] = by_group_port.get((g, port), 0.0) + n
+        by_group_other[g] = by_group_other.get(g, 0.0) + s["port_other"]
+
+        if last_seen is not None and q in last_seen:
+            o.head("weaver_queue_last_seen_timestamp_seconds", "gauge", "Unix time of the last SYN on the queue")
+            o.sample("weaver_queue_last_seen_timestamp_seconds", _labels(queue=q, group=g), last_seen[q])
+
+    # порты агрегируем по группе, а не по очереди: иначе кардинальность x N очередей
+    if by_group_port or any(by_group_other.values()):
+        o.head("weaver_syn_port_total", "counter", "SYN packets by destination port")
+        for (g, port), n in sorted(by_group_port.items()):
+            o.sample("weaver_syn_port_total", _labels(group=g, dport=port), n)
+        for g, n in sorted(by_group_other.items()):
+            if n:
+                o.sample("weaver_syn_port_total", _labels(group=g, dport="other"), n)
+
+    for q, ks in sorted((kernel or {}).items()):
+        if not ks:
+            continue
+        g = groups.get(q, "")
+        for key, name, help_ in (
+            ("queue_total", "weaver_nfqueue_queued", "Packets currently waiting in the kernel queue"),
+            ("queue_dropped", "weaver_nfqueue_dropped_total", "Packets dropped (or bypassed) because the queue was full"),
+            ("user_dropped", "weaver_nfqueue_user_dropped_total", "Packets lost because the netlink socket buffer was full"),
+            ("log_qlen", "weaver_nflog_queued", "Packet copies buffered in the kernel for the NFLOG group"),
+        ):
+            if key in ks:
+                o.head(name, "gauge" if key in ("queue_total", "log_qlen") else "counter", help_)
+                o.sample(name, _labels(queue=q, group=g), ks[key])
+
+    return o.text()
+
+
+def kernel_stats(queues: Iterable[int], backends: Optional[Mapping[int, str]] = None) -> Dict[int, Dict[str, int]]:
+    """backends — очередь -> observe_backend (queue_backends): у NFLOG-групп своя таблица в /proc."""
+    from . import nflog, nfq
+
+    backends = backends or {}
+    return {
+        q: (nflog.read_kernel_stats if backends.get(q) == "nflog" else nfq.read_kernel_stats)(q)
+        for q in queues
+    }
+
+
+def render_local(shards: Mapping[int, Shard], groups: Optional[Mapping[int, str]] = None,
+                 last_seen: Optional[Mapping[int, float]] = None,
+                 backends: Optional[Mapping[int, str]] = None) -> str:
+    return render(shards, groups, kernel_stats(shards, backends), last_seen)
+
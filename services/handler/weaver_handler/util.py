@@ -1,8 +1,6 @@
 from __future__ import annotations
 
 import json
-import sys
-import time
 from typing import Any
 
 
@@ -24,12 +22,9 @@ def _json_safe(x: Any) -> Any:
 
 
 def json_log(level: str, msg: str, **kwargs: Any) -> None:
-    rec = {"ts": time.time(), "level": level, "msg": msg}
-    rec.update(kwargs)
-    try:
-        sys.stdout.write(json.dumps(rec, ensure_ascii=False, default=_json_safe) + "\n")
-    except Exception:
-        rec["__fallback__"] = {k: _json_safe(v) for k, v in kwargs.items()}
-        sys.stdout.write(json.dumps(rec, ensure_ascii=False) + "\n")
-    sys.stdout.flush()
+    """
+    Не пишет сам: кладёт запись в logpipe, JSON и I/O — в фоновом потоке.
+    """
+    from .logpipe import get_pipe  # logpipe импортирует util
 
+    get_pipe().emit(msg, level=level, key="msg", **kwargs)
@@ -3,6 +3,6 @@ set -euo pipefail
 
 ARGS=(--config /app/config/config.yaml --nft-mode auto --addr-mode manage)
 
-# Никаких проверок и подкоманд — просто запускаем корневую CLI
-exec python -m weaver_manager "${ARGS[@]}"
+# Никаких проверок — просто apply (подкоманда обязательна: есть и state-dump)
+exec python -m weaver_manager apply "${ARGS[@]}"
 
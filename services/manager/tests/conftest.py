@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# weaver_manager не ставится пакетом: импорт из дерева, как PYTHONPATH в образе
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,111 @@
+import ipaddress as ipa
+
+import pytest
+
+from weaver_manager.allocator import AllocationError, GroupSpec, PrefixSpec, allocate
+
+
+def group(name="g", subnet="2001:db8:1::/64", count=4, start=10000, end=10099, **kw):
+    return GroupSpec(
+        name=name, subnet=subnet, count=count, port_start=start, port_end=end,
+        proxy_type=kw.pop("proxy_type", "http"), listen_stack="ipv4", **kw,
+    )
+
+
+def test_fresh_allocation_is_sequential_and_skips_reserved_low():
+    rows, diff = allocate([group()], [])
+    assert [a.port for a in rows] == [10000, 10001, 10002, 10003]
+    # ::0 и ::1 не раздаются
+    assert [a.ipv6 for a in rows] == [f"2001:db8:1::{i}" for i in range(2, 6)]
+    assert len(diff.added) == 4 and not diff.removed and diff.kept == 0
+
+
+def test_reapply_keeps_everything():
+    rows, _ = allocate([group()], [])
+    again, diff = allocate([group()], rows)
+    assert again == rows
+    assert diff.empty and diff.kept == 4
+
+
+def test_shrink_releases_highest_ports():
+    rows, _ = allocate([group(count=4)], [])
+    smaller, diff = allocate([group(count=2)], rows)
+    assert smaller == rows[:2]
+    assert sorted(a.port for a in diff.removed) == [10002, 10003]
+
+
+def test_grow_keeps_existing_bindings():
+    rows, _ = allocate([group(count=2)], [])
+    bigger, diff = allocate([group(count=5)], rows)
+    assert bigger[:2] == rows
+    assert len(diff.added) == 3 and diff.kept == 2
+    assert len({a.ipv6 for a in bigger}) == 5
+
+
+def test_group_attribute_change_is_reported_as_changed():
+    rows, _ = allocate([group()], [])
+    socks, diff = allocate([group(proxy_type="socks5")], rows)
+    assert [(a.port, a.ipv6) for a in socks] == [(a.port, a.ipv6) for a in rows]
+    assert len(diff.changed) == 4 and not diff.added and not diff.removed
+
+
+def test_bindings_outside_new_subnet_are_replaced():
+    rows, _ = allocate([group()], [])
+    moved, diff = allocate([group(subnet="2001:db8:2::/64")], rows)
+    assert all(ipa.IPv6Address(a.ipv6) in ipa.IPv6Network("2001:db8:2::/64") for a in moved)
+    assert len(diff.removed) == 4 and len(diff.added) == 4
+
+
+def test_removed_group_is_dropped():
+    rows, _ = allocate([group("a"), group("b", subnet="2001:db8:2::/64", start=20000, end=20099)], [])
+    only_a, diff = allocate([group("a")], rows)
+    assert {a.group for a in only_a} == {"a"}
+    assert {a.group for a in diff.removed} == {"b"}
+
+
+def test_groups_never_share_ports():
+    a = group("a", start=10000, end=10009)
+    b = group("b", subnet="2001:db8:2::/64", start=10005, end=10020)
+    rows, _ = allocate([a, b], [])
+    ports = [r.port for r in rows]
+    assert len(ports) == len(set(ports))
+
+
+def test_reserved_is_not_handed_out_but_does_not_evict():
+    rows, _ = allocate([group(count=2)], [])
+    taken = rows[0].ipv6
+    more, _ = allocate([group(count=4)], rows, reserved=[taken, "2001:db8:1::4"])
+    assert more[0] == rows[0]
+    assert "2001:db8:1::4" not in {a.ipv6 for a in more}
+
+
+def test_invalid_reserved_raises_allocation_error():
+    with pytest.raises(AllocationError):
+        allocate([group()], [], reserved=["not-an-address"])
+
+
+def test_count_above_prefix_capacity_raises():
+    with pytest.raises(AllocationError):
+        allocate([group(subnet="2001:db8:1::/126", count=3)], [])
+
+
+def test_out_of_ports_raises():
+    with pytest.raises(AllocationError):
+        allocate([group(count=5, start=10000, end=10003)], [])
+
+
+def test_weighted_prefixes_split_count():
+    g = group(count=8, prefixes=(
+        PrefixSpec("2001:db8:a::/64", weight=3),
+        PrefixSpec("2001:db8:b::/64", weight=1),
+    ))
+    rows, _ = allocate([g], [])
+    in_a = sum(ipa.IPv6Address(r.ipv6) in ipa.IPv6Network("2001:db8:a::/64") for r in rows)
+    assert (in_a, len(rows) - in_a) == (6, 2)
+
+
+def test_split_spreads_over_subprefixes():
+    g = group(count=4, prefixes=(PrefixSpec("2001:db8::/62", split=64),))
+    rows, _ = allocate([g], [])
+    nets = {ipa.IPv6Network(f"{r.ipv6}/64", strict=False) for r in rows}
+    assert len(nets) == 4
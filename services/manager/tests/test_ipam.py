@@ -0,0 +1,98 @@
+import ipaddress as ipa
+
+import pytest
+
+from weaver_manager import ipam
+from weaver_manager.ipam import IntervalSet, IpamError, Pool, weighted_split
+
+
+def test_interval_set_add_merges_adjacent():
+    s = IntervalSet([(1, 3)])
+    s.add(4)
+    s.add(10, 12)
+    assert s.intervals() == [(1, 4), (10, 12)]
+    s.add(5, 9)
+    assert s.intervals() == [(1, 12)]
+    assert s.count() == 12
+
+
+def test_interval_set_discard_splits():
+    s = IntervalSet([(1, 5)])
+    assert s.discard(3)
+    assert not s.discard(3)
+    assert s.intervals() == [(1, 2), (4, 5)]
+    assert 2 in s and 3 not in s
+
+
+def test_interval_set_gaps():
+    s = IntervalSet([(2, 3), (6, 6)])
+    assert list(s.gaps(0, 8)) == [(0, 1), (4, 5), (7, 8)]
+    assert list(s.gaps(2, 3)) == []
+
+
+def test_sequential_take_skips_reserved_low_and_reserved():
+    pool = Pool("2001:db8::/120")
+    pool.reserve_strs(["2001:db8::3"])
+    got = list(pool.take(3).strs())
+    assert got == ["2001:db8::2", "2001:db8::4", "2001:db8::5"]
+    assert pool.free == 256 - 2 - 1 - 3
+
+
+@pytest.mark.parametrize("strategy", ipam.STRATEGIES)
+def test_strategies_give_unique_addresses_inside_the_pool(strategy):
+    net = ipa.IPv6Network("2001:db8::/116")
+    pool = Pool(net)
+    got = list(pool.take(500, strategy, stride=16, seed="g"))
+    assert len(set(got)) == 500
+    assert all(ipa.IPv6Address(a) in net and a - pool.base >= 2 for a in got)
+
+
+def test_hashed_is_deterministic_per_seed():
+    a = list(Pool("2001:db8::/64").take(10, "hashed", seed="g"))
+    b = list(Pool("2001:db8::/64").take(10, "hashed", seed="g"))
+    c = list(Pool("2001:db8::/64").take(10, "hashed", seed="h"))
+    assert a == b != c
+
+
+def test_strided_walks_whole_pool_even_with_even_stride():
+    pool = Pool("2001:db8::/124", reserve_low=0)
+    assert sorted(pool.take(16, "strided", stride=4).offsets()) == list(range(16))
+
+
+def test_wide_pool_offsets():
+    pool = Pool("2001:db8::/48")
+    arr = pool.take(2, "hashed", seed="x")
+    assert all(ipa.IPv6Address(a) in pool.net for a in arr)
+    assert arr.hi is not None
+
+
+def test_take_more_than_free_raises():
+    pool = Pool("2001:db8::/126")
+    with pytest.raises(IpamError):
+        pool.take(3)
+
+
+def test_unknown_strategy_raises():
+    with pytest.raises(IpamError):
+        Pool("2001:db8::/64").take(1, "random")
+
+
+def test_release_returns_addresses_to_the_pool():
+    pool = Pool("2001:db8::/120")
+    arr = pool.take(2)
+    assert pool.release(arr) == 2
+    assert list(pool.take(2)) == list(arr)
+
+
+def test_weighted_split_respects_weights_and_caps():
+    assert weighted_split(10, [1, 1], [100, 100]) == [5, 5]
+    # равные остатки (7.5 / 2.5) — по порядку
+    assert weighted_split(10, [3, 1], [100, 100]) == [8, 2]
+    assert weighted_split(10, [1, 1], [2, 100]) == [2, 8]
+    assert sum(weighted_split(7, [1, 2, 4], [100, 100, 100])) == 7
+    assert weighted_split(10, [1, 1], [3, 3]) == [3, 3]
+
+
+def test_generate_ipv6_hosts_excludes():
+    hosts = ipam.generate_ipv6_hosts("2001:db8::/120", 3, exclude=["2001:db8::2"])
+    assert hosts == ["2001:db8::1", "2001:db8::3", "2001:db8::4"]
@@ -0,0 +1,116 @@
+import ipaddress as ipa
+
+import pytest
+
+from weaver_manager import nft
+from weaver_manager.nft import LogGroup, build_ruleset, parse_live, render_diff, render_ruleset
+from weaver_manager.state_io import Assignment
+
+
+def row(port, ipv6, q=None, last=None):
+    return Assignment(group="g", port=port, ipv6=ipv6, proxy_type="http", listen_stack="ipv4",
+                      nfqueue_num=q, nfqueue_last=last)
+
+
+def test_addr_intervals_one_interval_per_run():
+    addrs = [f"2001:db8::{i:x}" for i in range(3, 300)] + ["2001:db8::1:0"]
+    ivs = nft.addr_intervals(addrs)
+    assert len(ivs) == 2
+    assert [nft._fmt("ipv6_addr", iv) for iv in ivs] == ["2001:db8::3-2001:db8::12b", "2001:db8::1:0"]
+
+
+def test_aligned_run_renders_as_prefix():
+    ivs = nft.addr_intervals(f"2001:db8::{i:x}" for i in range(256))
+    assert [nft._fmt("ipv6_addr", iv) for iv in ivs] == ["2001:db8::/120"]
+
+
+def test_build_ruleset_dispatches_ports_and_saddrs():
+    rs = build_ruleset([
+        row(10000, "2001:db8::2", q=1),
+        row(10001, "2001:db8::3", q=1),
+        row(20000, "2001:db8:1::2", q=4, last=7),
+        row(30000, "2001:db8:2::2"),
+    ])
+    ports = rs.sets["weaver_in_dispatch"].elements
+    assert ports == {((10000, 10001), "goto weaver_q_1"), ((20000, 20000), "goto weaver_q_4_7")}
+    assert len(rs.sets["weaver_out_dispatch"].elements) == 2
+    assert rs.chains["weaver_q_4_7"].rules[0].text == "queue num 4-7 fanout,bypass"
+    # строки без очереди в правила не попадают
+    assert all(iv != (30000, 30000) for iv, _ in ports)
+
+
+def test_build_ruleset_nflog_groups_log_instead_of_queue():
+    rs = build_ruleset([row(10000, "2001:db8::2", q=5)], nflog={5})
+    assert rs.chains[nft.queue_chain_name(LogGroup(5))].rules[0].text.startswith("log group 5 ")
+
+
+def test_build_ruleset_empty_without_queues():
+    rs = build_ruleset([row(10000, "2001:db8::2")])
+    assert not rs.sets
+
+
+def test_dispatch_map_rejects_overlaps():
+    with pytest.raises(ValueError):
+        nft.dispatch_map("m", "inet_service", {1: [(10, 20)], 2: [(15, 30)]})
+
+
+def test_render_ruleset_recreates_table_in_one_script():
+    text = render_ruleset(build_ruleset([row(10000, "2001:db8::2", q=1)]))
+    lines = text.splitlines()
+    assert lines[:2] == [f"table {nft.TABLE} {{}}", f"delete table {nft.TABLE}"]
+    assert "tcp dport vmap @weaver_in_dispatch" in text
+    assert "ip6 saddr vmap @weaver_out_dispatch" in text
+
+
+def _live_from(rs):
+    """Живая таблица как её вернул бы `nft -j list table`."""
+    items = []
+    for s in rs.sets.values():
+        elems = []
+        for (lo, hi), verdict in s.elements:
+            if s.type == "ipv6_addr":
+                key = str(ipa.IPv6Address(lo)) if lo == hi else {"range": [str(ipa.IPv6Address(lo)), str(ipa.IPv6Address(hi))]}
+            else:
+                key = lo if lo == hi else {"range": [lo, hi]}
+            kind, _, target = verdict.partition(" ")
+            elems.append([key, {kind: {"target": target}}] if s.map else key)
+        body = {"name": s.name, "type": s.type, "flags": list(s.flags), "elem": elems}
+        if s.map:
+            body["map"] = s.map
+        items.append({"map" if s.map else "set": body})
+    for c in rs.chains.values():
+        items.append({"chain": {"name": c.name}})
+        for r in c.rules:
+            items.append({"rule": {"chain": c.name, "expr": [{"x": f"@{ref}"} for ref in r.refs]}})
+    return parse_live({"nftables": items})
+
+
+def test_parse_live_matches_built_ruleset():
+    want = build_ruleset([row(10000, "2001:db8::2", q=1), row(10001, "2001:db8::3", q=2)])
+    live = _live_from(want)
+    assert live.signature() == want.signature()
+    assert render_diff(want, live) == ("", 0, 0)
+
+
+def test_parse_live_canonicalises_prefix_elements():
+    doc = {"nftables": [{"set": {
+        "name": "s", "type": "ipv6_addr", "flags": "interval",
+        "elem": [{"prefix": {"addr": "2001:db8::", "len": 120}}, "2001:db8::1:0"],
+    }}]}
+    elems = parse_live(doc).sets["s"].elements
+    assert {iv for iv, _ in elems} == {
+        (0x20010DB8 << 96, (0x20010DB8 << 96) + 255),
+        ((0x20010DB8 << 96) + 0x10000, (0x20010DB8 << 96) + 0x10000),
+    }
+
+
+def test_render_diff_only_touches_changed_elements():
+    old = build_ruleset([row(10000, "2001:db8::2", q=1), row(10005, "2001:db8::9", q=1)])
+    new = build_ruleset([row(10000, "2001:db8::2", q=1), row(10007, "2001:db8::b", q=1)])
+    script, added, removed = render_diff(new, _live_from(old))
+    lines = script.splitlines()
+    assert (added, removed) == (2, 2)
+    # удаления первыми, у мап — по ключу
+    assert lines[0].startswith("delete element") and "goto" not in lines[0]
+    assert all(l.startswith("add element") for l in lines[2:])
+    assert "10007 : goto weaver_q_1" in script
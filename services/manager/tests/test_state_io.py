@@ -0,0 +1,131 @@
+import json
+
+import pytest
+
+from weaver_manager import state_io
+from weaver_manager.state_io import (
+    Assignment,
+    State,
+    StateError,
+    StateStore,
+    StateView,
+    decode_binary,
+    encode_binary,
+    read_state,
+    write_state_atomic,
+)
+
+
+def sample(n=50) -> State:
+    rows = [
+        Assignment(
+            group=f"g{i % 3}", port=20000 + i, ipv6=f"2001:db8::{i + 2:x}",
+            proxy_type="socks5" if i % 2 else "http", listen_stack="ipv6" if i % 5 else "ipv4",
+            nfqueue_num=None if i % 4 == 0 else i % 4, nfqueue_last=7 if i % 4 == 3 else None,
+        )
+        for i in range(n)
+    ]
+    return State(assignments=rows, version=3, config_hash="ab" * 32, stages={"addrs": "f00", "dad_failed": "2001:db8::1"})
+
+
+def test_binary_round_trip():
+    st = sample()
+    back = decode_binary(encode_binary(st))
+    assert back.assignments == st.assignments
+    assert (back.version, back.config_hash, back.stages) == (st.version, st.config_hash, st.stages)
+
+
+def test_binary_round_trip_empty():
+    back = decode_binary(encode_binary(State(assignments=[])))
+    assert back.assignments == [] and back.stages == {}
+
+
+def test_corrupt_binary_is_rejected():
+    buf = bytearray(encode_binary(sample()))
+    buf[-5] ^= 0xFF
+    with pytest.raises(StateError):
+        decode_binary(bytes(buf))
+
+
+def test_truncated_binary_is_rejected():
+    buf = encode_binary(sample())
+    with pytest.raises(StateError):
+        decode_binary(buf[: len(buf) // 2])
+    with pytest.raises(StateError):
+        decode_binary(buf[:3])
+
+
+def test_json_round_trip_and_hash_check(tmp_path):
+    p = tmp_path / "state.json"
+    write_state_atomic(p, sample(), "json")
+    assert read_state(p).assignments == sample().assignments
+    doc = json.loads(p.read_text())
+    doc["assignments"][0]["port"] = 1
+    p.write_text(json.dumps(doc))
+    with pytest.raises(StateError):
+        read_state(p)
+
+
+def test_legacy_bindings_are_read(tmp_path):
+    p = tmp_path / "state.json"
+    p.write_text(json.dumps({"bindings": [{"group": "g", "port": 1000, "ipv6": "2001:db8::2"}]}))
+    (a,) = read_state(p).assignments
+    assert (a.port, a.proxy_type, a.listen_stack) == (1000, "http", "ipv4")
+
+
+@pytest.mark.parametrize("doc", [
+    {"assignments": [{"port": 1}]},
+    {"assignments": [{"group": "g", "port": "x", "ipv6": "::1", "proxy_type": "http"}]},
+    {"assignments": [1]},
+])
+def test_malformed_json_rows_raise_state_error(tmp_path, doc):
+    p = tmp_path / "state.json"
+    p.write_text(json.dumps(doc))
+    with pytest.raises(StateError):
+        read_state(p)
+
+
+def test_missing_file_is_empty_state(tmp_path):
+    assert read_state(tmp_path / "nope").assignments == []
+
+
+def test_json_state_migrates_to_binary_on_commit(tmp_path):
+    p = tmp_path / "state.json"
+    write_state_atomic(p, sample(), "json")
+    store = StateStore(p, format="binary")
+    with store.transaction() as txn:
+        txn.commit(State(assignments=txn.state.assignments, config_hash="cd" * 32))
+    assert state_io.is_binary(p)
+    assert read_state(p).assignments == sample().assignments
+
+
+def test_commits_in_one_transaction_take_consecutive_versions(tmp_path):
+    store = StateStore(tmp_path / "state.bin")
+    with store.transaction() as txn:
+        assert txn.commit(State(assignments=[])).version == 1
+        assert txn.commit(State(assignments=[])).version == 2
+    assert store.load().version == 2
+
+
+def test_state_view_lookups(tmp_path):
+    p = tmp_path / "state.bin"
+    st = sample()
+    write_state_atomic(p, st, "binary")
+    with StateView(p) as v:
+        assert len(v) == len(st.assignments)
+        assert list(v) == st.assignments
+        assert v.by_port(20007) == st.assignments[7]
+        assert v.by_addr("2001:db8:0::9") == st.assignments[7]
+        assert v.by_port(1) is None and v.by_addr("2001:db8::ffff") is None
+
+
+@pytest.mark.parametrize("fmt", ["binary", "json"])
+def test_lookup_both_formats(tmp_path, fmt):
+    p = tmp_path / "state"
+    st = sample()
+    write_state_atomic(p, st, fmt)
+    assert state_io.lookup(p, port=20010) == st.assignments[10]
+    assert state_io.lookup(p, addr="2001:DB8::C") == st.assignments[10]
+    assert state_io.lookup(p, port=1) is None
+    with pytest.raises(ValueError):
+        state_io.lookup(p, port=1, addr="::1")
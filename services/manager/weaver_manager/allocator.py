@@ -0,0 +1,309 @@
+from __future__ import annotations
+
+import bisect
+import ipaddress as ipa
+from dataclasses import dataclass, field, replace
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple
+
+from weaver_manager import ipam
+from weaver_manager.prefixes import PrefixIndex
+from weaver_manager.state_io import Assignment
+
+# Липкий аллокатор: привязки port -> ipv6 из прошлого state сохраняются,
+# пока порт в port_range группы, адрес в её подсети и не занят другой
+# группой. Новые берутся из свободных (битмап портов, ipam.Pool для адресов),
+# при уменьшении count освобождаются самые старшие порты. Результат —
+# новый набор и дифф к прошлому: дальше по дифф работают стадии apply.
+# Группа может жить в нескольких префиксах (PrefixSpec): count делится
+# по весам с потолком capacity, префикс с split — ещё и поровну по
+# под-префиксам (делегированный /48 -> /64).
+
+FIRST_HOST_OFFSET = ipam.DEFAULT_RESERVE_LOW
+
+
+@dataclass(frozen=True)
+class PrefixSpec:
+    prefix: str
+    weight: int = 1
+    capacity: Optional[int] = None     # потолок адресов группы из этого префикса
+    split: Optional[int] = None        # резать на под-префиксы этой длины (/48 -> /64)
+
+
+@dataclass(frozen=True)
+class GroupSpec:
+    name: str
+    subnet: str                        # один префикс; prefixes — если их несколько
+    count: int
+    port_start: int
+    port_end: int
+    proxy_type: str
+    listen_stack: str
+    nfqueue_num: Optional[int] = None
+    nfqueue_last: Optional[int] = None
+    addr_strategy: str = "sequential"    # ipam.STRATEGIES
+    addr_stride: int = 1
+    prefixes: Tuple[PrefixSpec, ...] = ()
+
+    def prefix_specs(self) -> Tuple[PrefixSpec, ...]:
+        return self.prefixes or (PrefixSpec(self.subnet),)
+
+    def attrs(self) -> Dict[str, object]:
+        return {
+            "proxy_type": self.proxy_type,
+            "listen_stack": self.listen_stack,
+            "nfqueue_num": self.nfqueue_num,
+            "nfqueue_last": self.nfqueue_last,
+        }
+
+
+@dataclass
+class AssignDiff:
+    added: List[Assignment] = field(default_factory=list)
+    removed: List[Assignment] = field(default_factory=list)
+    changed: List[Assignment] = field(default_factory=list)   # та же привязка, другие атрибуты группы
+    kept: int = 0
+
+    @property
+    def empty(self) -> bool:
+        return not (self.added or self.removed or self.changed)
+
+    def addrs(self) -> Tuple[List[str], List[str]]:
+        """(добавить, удалить) по адресам: адрес мог перейти от одной строки к другой."""
+        old = {a.ipv6 for a in self.removed}
+        new = {a.ipv6 for a in self.added}
+        return sorted(new - old), sorted(old - new)
+
+    def summary(self) -> str:
+        return f"+{len(self.added)} -{len(self.removed)} ~{len(self.changed)} ={self.kept}"
+
+
+class AllocationError(ValueError):
+    pass
+
+
+class _PortMap:
+    """Битмап занятых портов 0..65535."""
+
+    def __init__(self) -> None:
+        self._bits = bytearray(65536 // 8)
+
+    def __contains__(self, p: int) -> bool:
+        return bool(self._bits[p >> 3] & (1 << (p & 7)))
+
+    def take(self, p: int) -> None:
+        self._bits[p >> 3] |= 1 << (p & 7)
+
+    def free_in(self, lo: int, hi: int) -> Iterator[int]:
+        bits = self._bits
+        p = lo
+        while p <= hi:
+            b = bits[p >> 3]
+            if b == 0xFF and p & 7 == 0 and p + 7 <= hi:
+                p += 8
+                continue
+            if not b & (1 << (p & 7)):
+                yield p
+            p += 1
+
+
+class _Layout:
+    """
+    Префиксы группы после split. Под-префикс — пара (вход, номер):
+    сеть считается из номера, сами под-префиксы не перечисляются,
+    поэтому /48 -> 65536 x /64 ничего не стоит, пока там нет адресов.
+    """
+
+    def __init__(self, group: str, specs: Sequence[PrefixSpec]) -> None:
+        self.group = group
+        self.specs = list(specs)
+        self.nets: List[ipa.IPv6Network] = []
+        self.sublen: List[int] = []
+        self.caps: List[int] = []
+        self.index: PrefixIndex[int] = PrefixIndex()
+        for i, p in enumerate(self.specs):
+            net = ipa.IPv6Network(p.prefix, strict=False)
+            sub = p.split if p.split is not None else net.prefixlen
+            if not net.prefixlen <= sub <= 128:
+                raise AllocationError(f"group '{group}': cannot split {net} into /{sub}")
+            for other in self.nets:
+                if net.overlaps(other):
+                    raise AllocationError(f"group '{group}': prefixes {other} and {net} overlap")
+            per_sub = max(0, (1 << (128 - sub)) - FIRST_HOST_OFFSET)
+            cap = (1 << (sub - net.prefixlen)) * per_sub
+            if p.capacity is not None:
+                cap = min(cap, p.capacity)
+            self.nets.append(net)
+            self.sublen.append(sub)
+            self.caps.append(cap)
+            self.index.add(net, i)
+
+    @property
+    def capacity(self) -> int:
+        return sum(self.caps)
+
+    def locate(self, h: int) -> Optional[Tuple[int, int]]:
+        """(вход, под-префикс) адреса или None — чужой или из служебных ::0/::1."""
+        i = self.index.lookup(h)
+        if i is None:
+            return None
+        off = h - int(self.nets[i].network_address)
+        shift = 128 - self.sublen[i]
+        if off & ((1 << shift) - 1) < FIRST_HOST_OFFSET:
+            return None
+        return i, off >> shift
+
+    def subnet(self, key: Tuple[int, int]) -> ipa.IPv6Network:
+        i, j = key
+        shift = 128 - self.sublen[i]
+        base = int(self.nets[i].network_address) + (j << shift)
+        return ipa.IPv6Network((base, self.sublen[i]))
+
+    def targets(self, count: int) -> Iterator[Tuple[Tuple[int, int], int]]:
+        """Сколько адресов должно быть в каждом под-префиксе при count всего."""
+        quotas = ipam.weighted_split(count, [p.weight for p in self.specs], self.caps)
+        for i, total in enumerate(quotas):
+            nsub = 1 << (self.sublen[i] - self.nets[i].prefixlen)
+            # поровну по под-префиксам: ND и маршруты размазаны по /64
+            q, r = divmod(total, nsub)
+            for j in range(min(total, nsub)):
+                yield (i, j), q + (j < r)
+
+
+def allocate(
+    groups: Sequence[GroupSpec],
+    prev: Iterable[Assignment],
+    reserved: Iterable[str] = (),
+) -> Tuple[List[Assignment], AssignDiff]:
+    """
+    reserved — адреса, которые нельзя раздавать новым привязкам (pinned и т.п.).
+    Порядок групп в конфиге на раздачу не влияет (только на порядок вывода).
+    """
+    by_group: Dict[str, List[Assignment]] = {}
+    for a in prev:
+        by_group.setdefault(a.group, []).append(a)
+
+    ports = _PortMap()
+    used_addrs: Set[int] = set()
+    kept_by_group: Dict[str, List[Assignment]] = {}
+    diff = AssignDiff()
+
+    names = {g.name for g in groups}
+    for name, rows in by_group.items():
+        if name not in names:
+            diff.removed.extend(rows)
+
+    # 1) сначала закрепляем выжившие привязки всех групп — чтобы новая
+    #    группа не заняла порт/адрес, который уже обслуживает другая
+    layouts = {g.name: _Layout(g.name, g.prefix_specs()) for g in groups}
+    for g in sorted(groups, key=lambda g: g.name):
+        lay = layouts[g.name]
+        if g.count > lay.capacity:
+            raise AllocationError(f"group '{g.name}': count {g.count} exceeds prefix capacity {lay.capacity}")
+        used_in = [0] * len(lay.nets)
+        keep: List[Assignment] = []
+        for a in sorted(by_group.get(g.name, ()), key=lambda a: a.port):
+            try:
+                h = int(ipa.IPv6Address(a.ipv6))
+            except ValueError:
+                diff.removed.append(a)
+                continue
+            where = lay.locate(h)
+            ok = (
+                g.port_start <= a.port <= g.port_end
+                and a.port not in ports
+                and where is not None
+                and used_in[where[0]] < lay.caps[where[0]]
+                and h not in used_addrs
+            )
+            if not ok:
+                diff.removed.append(a)
+                continue
+            ports.take(a.port)
+            used_addrs.add(h)
+            used_in[where[0]] += 1
+            keep.append(a)
+        # count уменьшили — отпускаем старшие порты
+        if len(keep) > g.count:
+            diff.removed.extend(keep[g.count:])
+            keep = keep[:g.count]
+        kept_by_group[g.name] = keep
+
+    # reserved не выселяет уже выданные привязки, только не раздаётся заново
+    for r in reserved:
+        try:
+            used_addrs.add(int(ipa.IPv6Address(r)))
+        except ValueError as e:
+            raise AllocationError(f"reserved address: {e}") from e
+
+    # 2) добираем недостающее из свободных портов и адресов
+    rows: Dict[str, List[Assignment]] = {}
+    for g in sorted(groups, key=lambda g: g.name):
+        attrs = g.attrs()
+        out = rows[g.name] = []
+        for a in kept_by_group[g.name]:
+            b = replace(a, **attrs)
+            if b != a:
+                diff.changed.append(b)
+            else:
+                diff.kept += 1
+            out.append(b)
+        need = g.count - len(kept_by_group[g.name])
+        if need <= 0:
+            continue
+        free_ports = ports.free_in(g.port_start, g.port_end)
+        for block in _take_group(g, layouts[g.name], kept_by_group[g.name], need, used_addrs):
+            used_addrs.update(block)
+            for ipv6 in block.strs():
+                port = next(free_ports, None)
+                if port is None:
+                    raise AllocationError(f"group '{g.name}': no free ports left in {g.port_start}-{g.port_end}")
+                ports.take(port)
+                a = Assignment(group=g.name, port=port, ipv6=ipv6, **attrs)
+                diff.added.append(a)
+                out.append(a)
+
+    # вывод — в порядке групп конфига, внутри группы по порту
+    result: List[Assignment] = []
+    for g in groups:
+        result.extend(sorted(rows[g.name], key=lambda a: a.port))
+    return result, diff
+
+
+def _take_group(
+    g: GroupSpec,
+    lay: _Layout,
+    kept: Sequence[Assignment],
+    need: int,
+    used_addrs: Set[int],
+) -> Iterator[ipam.AddrArray]:
+    """
+    need новых адресов: под-префиксам недодают до их целевой доли
+    (с учётом уже выданных), по порядку, пока не наберётся need.
+    """
+    have: Dict[Tuple[int, int], int] = {}
+    for a in kept:
+        where = lay.locate(int(ipa.IPv6Address(a.ipv6)))
+        if where is not None:
+            have[where] = have.get(where, 0) + 1
+    # занятые адреса — одним отсортированным списком, в пул под-префикса
+    # попадает только его срез (bisect), а не весь набор
+    used = sorted(used_addrs)
+    for key, target in lay.targets(g.count):
+        n = min(target - have.get(key, 0), need)
+        if n <= 0:
+            continue
+        pool = ipam.Pool(lay.subnet(key), FIRST_HOST_OFFSET)
+        lo, hi = pool.base, pool.base + pool.size
+        if used and used[0] < hi and used[-1] >= lo:
+            pool.reserve(used[bisect.bisect_left(used, lo):bisect.bisect_left(used, hi)])
+        # seed от имени группы: hashed-раскладка стабильна между запусками
+        seed = g.name if key == (0, 0) else f"{g.name}/{key[0]}/{key[1]}"
+        try:
+            yield pool.take(n, g.addr_strategy, g.addr_stride, seed=seed)
+        except ipam.IpamError as e:
+            raise AllocationError(f"group '{g.name}': {e}") from e
+        need -= n
+        if not need:
+            return
+    if need:
+        raise AllocationError(f"group '{g.name}': {need} addresses short of prefix capacity")
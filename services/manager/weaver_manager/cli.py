@@ -1,14 +1,22 @@
 from __future__ import annotations
 
+import hashlib
 import json
 import ipaddress as ipa
 import subprocess as sp
+import time
+from dataclasses import asdict
 from pathlib import Path
-from typing import Iterable, List, Optional, Set, Dict
+from typing import Callable, Iterable, List, Optional, Set, Dict, Tuple
 
 import typer
 import yaml
-from pydantic import BaseModel, Field, conint, field_validator
+from pydantic import BaseModel, Field, conint, field_validator, model_validator
+
+from weaver_manager import ipam, netlink, nft, proxy_config, state_io
+from weaver_manager.allocator import AllocationError, AssignDiff, GroupSpec, PrefixSpec, allocate
+from weaver_manager.prefixes import PrefixIndex
+from weaver_manager.state_io import Assignment, State
 
 app = typer.Typer(no_args_is_help=True)
 
@@ -30,15 +38,158 @@ class PortRange(BaseModel):
         return v
 
 
+class QueueRange(BaseModel):
+    start: conint(ge=0, le=65535)
+    end: conint(ge=0, le=65535)
+
+    @field_validator("end")
+    @classmethod
+    def _check_range(cls, v, info):
+        start = info.data.get("start", 0)
+        if v < start:
+            raise ValueError("nfqueue_range.end must be >= nfqueue_range.start")
+        return v
+
+
+class PrefixEntry(BaseModel):
+    prefix: str                          # e.g. "2a01:4f8:c0c::/48"
+    weight: conint(ge=0) = 1             # доля count относительно других префиксов
+    capacity: Optional[conint(ge=0)] = None   # не больше стольких адресов отсюда
+    split: Optional[conint(ge=1, le=128)] = None  # резать на /split (например 64)
+
+    @field_validator("prefix")
+    @classmethod
+    def _check_prefix(cls, v: str):
+        try:
+            ipa.IPv6Network(v, strict=False)
+        except ValueError as e:
+            raise ValueError(f"invalid prefix {v}: {e}") from e
+        return v
+
+    @model_validator(mode="after")
+    def _check_split(self):
+        plen = ipa.IPv6Network(self.prefix, strict=False).prefixlen
+        if self.split is not None and self.split < plen:
+            raise ValueError(f"prefix {self.prefix}: split /{self.split} is shorter than the prefix")
+        return self
+
+
 class ProxyGroup(BaseModel):
     name: str
-    ipv6_subnet: str                     # e.g. "2a01:4f8:c0c:1234::/64"
+    ipv6_subnet: Optional[str] = None    # e.g. "2a01:4f8:c0c:1234::/64"
+    ipv6_prefixes: List[PrefixEntry] = []   # вместо ipv6_subnet: несколько префиксов/split
     count: conint(ge=1)
     proxy_type: str                      # "http" or "socks5"
     port_range: PortRange
     listen_stack: str = "ipv6"           # "ipv6" | "ipv4"
     nfqueue_num: Optional[int] = None
+    nfqueue_range: Optional[QueueRange] = None   # queue num A-B fanout
     persona: Optional[str] = None
+    observe_backend: str = "nfqueue"     # nfqueue | nflog (nfqueue_num — номер log group)
+    addr_strategy: str = "sequential"    # sequential | strided | hashed
+    addr_stride: conint(ge=1) = 1        # для strided
+
+    @field_validator("addr_strategy")
+    @classmethod
+    def _check_addr_strategy(cls, v: str):
+        v = str(v).lower()
+        if v not in ipam.STRATEGIES:
+            raise ValueError(f"addr_strategy must be one of {', '.join(ipam.STRATEGIES)}")
+        return v
+
+    @field_validator("port_range")
+    @classmethod
+    def _check_port_capacity(cls, v: PortRange, info):
+        count = info.data.get("count")
+        size = v.end - v.start + 1
+        if count is not None and count > size:
+            raise ValueError(f"count {count} does not fit port_range {v.start}-{v.end} ({size} ports)")
+        return v
+
+    @model_validator(mode="after")
+    def _check_prefixes(self):
+        if bool(self.ipv6_subnet) == bool(self.ipv6_prefixes):
+            raise ValueError(f"group '{self.name}': set exactly one of ipv6_subnet or ipv6_prefixes")
+        nets = [ipa.IPv6Network(p.prefix, strict=False) for p in self.prefixes()]
+        for i, a in enumerate(nets):
+            for b in nets[i + 1:]:
+                if a.overlaps(b):
+                    raise ValueError(f"group '{self.name}': prefixes {a} and {b} overlap")
+        return self
+
+    def prefixes(self) -> List[PrefixEntry]:
+        if self.ipv6_prefixes:
+            return self.ipv6_prefixes
+        return [PrefixEntry(prefix=self.ipv6_subnet)]
+
+    @field_validator("observe_backend")
+    @classmethod
+    def _check_observe_backend(cls, v: str):
+        v = str(v).lower()
+        if v not in ("nfqueue", "nflog"):
+            raise ValueError("observe_backend must be 'nfqueue' or 'nflog'")
+        return v
+
+    @model_validator(mode="after")
+    def _check_queues(self):
+        if self.nfqueue_range is not None and self.observe_backend == "nflog":
+            raise ValueError(f"group '{self.name}': nfqueue_range (fanout) needs observe_backend nfqueue")
+        if self.nfqueue_range is None:
+            return self
+        if self.nfqueue_num is None:
+            self.nfqueue_num = self.nfqueue_range.start
+        elif self.nfqueue_num != self.nfqueue_range.start:
+            raise ValueError(f"group '{self.name}': nfqueue_num must equal nfqueue_range.start")
+        return self
+
+    @property
+    def nfqueue_last(self) -> Optional[int]:
+        return self.nfqueue_range.end if self.nfqueue_range is not None else None
+
+
+class LocalResolver(BaseModel):
+    """Кэширующий сайдкар (services/proxy/dnscache.py); 3proxy ходит только в него."""
+    enabled: bool = False
+    listen: str = "127.0.0.1:5353"       # он же nserver в 3proxy.cfg
+    cache_size: conint(ge=1) = 10000     # записей
+    min_ttl: conint(ge=0) = 0
+    max_ttl: conint(ge=1) = 3600
+    neg_ttl: conint(ge=0) = 300          # потолок NXDOMAIN/NODATA (по SOA, RFC 2308)
+    prefetch_hits: conint(ge=1) = 3      # горячее имя — столько попаданий за TTL
+    prefetch_ratio: float = Field(default=0.1, ge=0.0, le=1.0)   # обновлять в последней доле TTL
+    hosts: Optional[str] = None          # статические A/AAAA в hosts-формате
+    offline: bool = False                # без upstream: hosts или NXDOMAIN
+
+    @field_validator("listen")
+    @classmethod
+    def _check_listen(cls, v: str):
+        proxy_config.parse_nserver(v)
+        return v
+
+
+class ResolverConfig(BaseModel):
+    servers: List[str] = list(proxy_config.DEFAULT_RESOLVER.servers)   # upstream (3proxy или сайдкара)
+    cache: conint(ge=0) = proxy_config.DEFAULT_RESOLVER.cache           # nscache 3proxy
+    cache6: conint(ge=0) = proxy_config.DEFAULT_RESOLVER.cache6         # nscache6 3proxy
+    ipv6_first: bool = False             # -64 у IPv4-листенеров: сначала AAAA
+    local: LocalResolver = LocalResolver()
+
+    @field_validator("servers")
+    @classmethod
+    def _check_servers(cls, v: List[str]):
+        for s in v:
+            proxy_config.parse_nserver(s)
+        return v
+
+    @model_validator(mode="after")
+    def _check_any(self):
+        if not self.servers and not (self.local.enabled and self.local.offline):
+            raise ValueError("resolver.servers is empty and no offline local resolver is enabled")
+        return self
+
+    def for_3proxy(self) -> proxy_config.Resolver:
+        servers = (self.local.listen,) if self.local.enabled else tuple(self.servers)
+        return proxy_config.Resolver(servers, self.cache, self.cache6, self.ipv6_first)
 
 
 class GlobalConfig(BaseModel):
@@ -49,6 +200,70 @@ class GlobalConfig(BaseModel):
     egress_bind: str                     # "auto" | "off"
     pinned_ipv6: List[str] = []
     observe_enabled: bool = False
+    state_format: str = "binary"         # "binary" | "json"
+    proxy_shards: str = "none"           # "none" | "group": листенеры группы в своём include-файле
+    proxy_instances: int = 1             # >1 — столько процессов 3proxy, каждый со своим срезом портов
+    egress_mode: str = "addrs"           # "addrs" — /128 на интерфейс; "prefix" — local-маршрут на префикс
+    addr_dad: str = "wait"               # "wait" | "nodad" | "off": как ждать DAD новых /128
+    dad_timeout_sec: float = 10.0
+    resolver: ResolverConfig = ResolverConfig()
+
+    @field_validator("pinned_ipv6")
+    @classmethod
+    def _check_pinned_ipv6(cls, v: List[str]):
+        # канонический вид: сравнивается строками с адресами интерфейса
+        out = []
+        for a in v:
+            try:
+                out.append(str(ipa.IPv6Address(str(a).strip())))
+            except ValueError as e:
+                raise ValueError(f"pinned_ipv6: {e}") from e
+        return out
+
+    @field_validator("addr_dad")
+    @classmethod
+    def _check_addr_dad(cls, v: str):
+        v = str(v).lower()
+        if v not in ("wait", "nodad", "off"):
+            raise ValueError("addr_dad must be 'wait', 'nodad' or 'off'")
+        return v
+
+    @field_validator("egress_mode")
+    @classmethod
+    def _check_egress_mode(cls, v: str):
+        v = str(v).lower()
+        if v not in ("addrs", "prefix"):
+            raise ValueError("egress_mode must be 'addrs' or 'prefix'")
+        return v
+
+    @field_validator("proxy_shards")
+    @classmethod
+    def _check_proxy_shards(cls, v: str):
+        v = str(v).lower()
+        if v not in proxy_config.SHARD_MODES:
+            raise ValueError(f"proxy_shards must be one of {', '.join(proxy_config.SHARD_MODES)}")
+        return v
+
+    @field_validator("proxy_instances")
+    @classmethod
+    def _check_proxy_instances(cls, v: int):
+        if not 1 <= v <= 256:
+            raise ValueError("proxy_instances must be in 1..256")
+        return v
+
+    @model_validator(mode="after")
+    def _check_instances_shards(self):
+        if self.proxy_instances > 1 and self.proxy_shards != "none":
+            raise ValueError("proxy_shards must be 'none' when proxy_instances > 1")
+        return self
+
+    @field_validator("state_format")
+    @classmethod
+    def _check_state_format(cls, v: str):
+        v = str(v).lower()
+        if v not in ("binary", "json"):
+            raise ValueError("state_format must be 'binary' or 'json'")
+        return v
 
     @field_validator("egress_bind")
     @classmethod
@@ -63,18 +278,19 @@ class Config(BaseModel):
     global_: GlobalConfig = Field(alias="global")
     proxy_groups: List[ProxyGroup]
 
-
-class Assignment(BaseModel):
-    group: str
-    port: int
-    ipv6: str
-    proxy_type: str
-    listen_stack: str
-    nfqueue_num: Optional[int] = None
+    @model_validator(mode="after")
+    def _check_observe_numbers(self):
+        # у handler один воркер на номер: очередь и log group с одним номером не уживутся
+        queued = {q for g in self.proxy_groups if g.observe_backend == "nfqueue" and g.nfqueue_num is not None
+                  for q in range(g.nfqueue_num, (g.nfqueue_last or g.nfqueue_num) + 1)}
+        clash = sorted(queued & _nflog_groups(self))
+        if clash:
+            raise ValueError(f"numbers {clash} are used both as nfqueue and nflog group")
+        return self
 
 
-class State(BaseModel):
-    assignments: List[Assignment] = []
+def _nflog_groups(cfg: "Config") -> Set[int]:
+    return {g.nfqueue_num for g in cfg.proxy_groups if g.observe_backend == "nflog" and g.nfqueue_num is not None}
 
 
 # =========================
@@ -92,20 +308,41 @@ def _load_config(path: Path) -> Config:
         raise typer.BadParameter(f"invalid config: {e}") from e
 
 
-def read_state(path: Path) -> State:
-    if not path.exists():
-        return State(assignments=[])
+def _boot_id() -> str:
     try:
-        return State.model_validate_json(path.read_text(encoding="utf-8"))
-    except Exception:
-        # если state повреждён — начинаем с пустого
-        return State(assignments=[])
+        return Path("/proc/sys/kernel/random/boot_id").read_text(encoding="ascii").strip()
+    except OSError:
+        return ""
 
 
-def write_state(path: Path, st: State) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
-    text = json.dumps(st.model_dump(), indent=2, ensure_ascii=False)
-    path.write_text(text, encoding="utf-8")
+def _config_hash(cfg: Config, *modes: str) -> str:
+    """
+    Хэш нормализованного конфига (без комментариев/порядка ключей),
+    режимов apply и boot_id: адреса и nft не переживают перезагрузку,
+    поэтому после неё apply не пропускается.
+    """
+    doc = cfg.model_dump_json(by_alias=True)
+    h = hashlib.blake2b(digest_size=32)
+    for part in (doc, *modes, _boot_id()):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _fingerprint(*parts: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    for p in parts:
+        h.update(p.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def _state_store(cfg: Config, lock_timeout: float = 30.0) -> state_io.StateStore:
+    return state_io.StateStore(
+        Path(cfg.global_.state_file_path),
+        format=cfg.global_.state_format,
+        lock_timeout=lock_timeout,
+    )
 
 # =========================
 #   ADDR / NFT UTILS
@@ -125,7 +362,7 @@ def _iface_ipv6_addrs(iface: str) -> List[Dict]:
 def _weaver_subnets(cfg: Config) -> List[ipa.IPv6Network]:
     nets: List[ipa.IPv6Network] = []
     for g in cfg.proxy_groups:
-        nets.append(ipa.IPv6Network(g.ipv6_subnet, strict=False))
+        nets.extend(ipa.IPv6Network(p.prefix, strict=False) for p in g.prefixes())
     return nets
 
 
@@ -133,8 +370,20 @@ def _eligible_iface_managed_addrs(iface: str, nets: List[ipa.IPv6Network]) -> Se
     """
     Берём ТОЛЬКО глобальные /128 адреса на интерфейсе, попадающие в наши подсети.
     SLAAC/DHCPv6 (/64), link-local (fe80::/10) отбрасываем.
+    Инвентарь — один RTM_GETADDR dump, фильтр — PrefixIndex по подсетям групп.
     """
+    index = PrefixIndex.from_networks(nets)
     out: Set[str] = set()
+    try:
+        for ia in netlink.iter_ipv6_addrs(iface):
+            if ia.scope != netlink.RT_SCOPE_UNIVERSE or ia.prefixlen != 128:
+                continue
+            if ia.addr in index:
+                out.add(str(ipa.IPv6Address(ia.addr)))
+        return out
+    except OSError as e:
+        print(f"[manager] netlink dump unavailable ({e}), falling back to ip(8)")
+
     for ai in _iface_ipv6_addrs(iface):
         if ai.get("family") != "inet6":
             continue
@@ -148,16 +397,149 @@ def _eligible_iface_managed_addrs(iface: str, nets: List[ipa.IPv6Network]) -> Se
         if not addr:
             continue
         a = ipa.IPv6Address(addr)
-        if any(a in n for n in nets):
+        if a in index:
             out.add(str(a))
     return out
 
 
+def _change_iface_ipv6(
+    iface: str,
+    to_add: List[str],
+    to_del: List[str],
+    dad: str = "off",
+    dad_timeout: float = 10.0,
+) -> None:
+    """
+    dad="nodad" — новые адреса добавляются без DAD; "wait" — возврат
+    только когда все новые адреса вышли из tentative (3proxy.cfg пишется
+    после этой стадии, так что -e не попадёт на ещё не готовый адрес);
+    "off" — не ждать.
+    """
+    watcher: Optional[netlink.AddrWatcher] = None
+    try:
+        if dad == "wait" and to_add:
+            # подписка до add: иначе конец DAD можно пропустить
+            watcher = netlink.AddrWatcher()
+        res = netlink.batch_ipv6_addrs(iface, add=to_add, delete=to_del, nodad=dad == "nodad")
+    except netlink.NetlinkUnavailable as e:
+        if watcher is not None:
+            watcher.close()
+        # нет AF_NETLINK (или прав) — старый путь через iproute2; только
+        # когда сокет не поднялся: начатый пакет через ip(8) не переигрываем
+        print(f"[manager] netlink unavailable ({e}), falling back to ip(8)")
+        t0 = time.monotonic()
+        extra = ["nodad"] if dad == "nodad" else []
+        for a in to_add:
+            sp.run(["ip", "-6", "addr", "replace", f"{a}/128", "dev", iface, *extra], check=True)
+        for a in to_del:
+            sp.run(["ip", "-6", "addr", "del", f"{a}/128", "dev", iface], check=True)
+        print(
+            f"[manager] iface {iface}: +{len(to_add)} -{len(to_del)} IPv6 "
+            f"in {time.monotonic() - t0:.2f}s (ip)"
+        )
+        if dad == "wait" and to_add:
+            try:
+                _poll_dad(iface, to_add, dad_timeout, t0)
+            except DadError as e:
+                _drop_iface_ipv6(iface, e.failed + e.pending)
+                raise
+        return
+    except OSError as e:
+        if watcher is not None:
+            watcher.close()
+        raise RuntimeError(f"iface {iface}: netlink address batch failed: {e}") from e
+
+    print(
+        f"[manager] iface {iface}: +{res.added} -{res.deleted} IPv6 "
+        f"in {res.elapsed:.2f}s (netlink)"
+    )
+    if not res.ok:
+        if watcher is not None:
+            watcher.close()
+        for a, err in sorted(res.failed.items())[:20]:
+            print(f"[manager]   {a}: {err}")
+        raise RuntimeError(f"iface {iface}: {len(res.failed)} IPv6 address operations failed")
+    if watcher is not None:
+        with watcher:
+            dres = watcher.wait_usable(iface, to_add, dad_timeout)
+        try:
+            _report_dad(iface, dres.ready, dres.failed, dres.pending, dres.elapsed)
+        except DadError as e:
+            _drop_iface_ipv6(iface, e.failed + e.pending)
+            raise
+
+
+class DadError(RuntimeError):
+    def __init__(self, msg: str, failed: List[str], pending: List[str]) -> None:
+        super().__init__(msg)
+        self.failed = failed
+        self.pending = pending
+
+
+def _report_dad(iface: str, ready: int, failed: List[str], pending: List[str], elapsed: float) -> None:
+    if not failed and not pending:
+        print(f"[manager] iface {iface}: {ready} new IPv6 usable after DAD in {elapsed:.2f}s (time-to-ready)")
+        return
+    for a in failed[:20]:
+        print(f"[manager]   {a}: DAD failed (duplicate on link)")
+    for a in pending[:20]:
+        print(f"[manager]   {a}: still tentative")
+    raise DadError(
+        f"iface {iface}: {len(failed)} IPv6 failed DAD, {len(pending)} still tentative "
+        f"after {elapsed:.1f}s; 3proxy.cfg not published",
+        failed,
+        pending,
+    )
+
+
+def _drop_iface_ipv6(iface: str, addrs: List[str]) -> None:
+    """
+    Снять не прошедшие DAD адреса: replace по dadfailed-адресу DAD
+    заново не запускает, оставленный на интерфейсе он так и будет падать.
+    """
+    if not addrs:
+        return
+    try:
+        res = netlink.batch_ipv6_addrs(iface, add=[], delete=addrs)
+        ok = res.ok
+    except netlink.NetlinkUnavailable:
+        ok = all(
+            sp.run(["ip", "-6", "addr", "del", f"{a}/128", "dev", iface]).returncode == 0
+            for a in addrs
+        )
+    print(f"[manager] iface {iface}: removed {len(addrs)} IPv6 that did not pass DAD" + ("" if ok else " (partially)"))
+
+
+def _poll_dad(iface: str, addrs: List[str], timeout: float, t0: float) -> None:
+    """Без netlink: опрос `ip -6 addr show tentative/dadfailed`."""
+    want = {str(ipa.IPv6Address(a)) for a in addrs}
+
+    def flagged(flag: str) -> Set[str]:
+        out = sp.check_output(["ip", "-j", "-6", "addr", "show", "dev", iface, flag], text=True)
+        return {
+            str(ipa.IPv6Address(ai["local"]))
+            for link in json.loads(out or "[]")
+            for ai in link.get("addr_info", [])
+            if ai.get("local")
+        } & want
+
+    while True:
+        failed = flagged("dadfailed")
+        pending = flagged("tentative") - failed
+        elapsed = time.monotonic() - t0
+        if failed or not pending or elapsed >= timeout:
+            _report_dad(iface, len(want - failed - pending), sorted(failed), sorted(pending), elapsed)
+            return
+        time.sleep(0.1)
+
+
 def _reconcile_iface_ipv6(
     iface: str,
     want: Iterable[str],
     pinned: Iterable[str],
     nets: List[ipa.IPv6Network],
+    dad: str = "off",
+    dad_timeout: float = 10.0,
 ) -> None:
     want_set: Set[str] = set(want)
     pin: Set[str] = set(pinned)
@@ -167,125 +549,178 @@ def _reconcile_iface_ipv6(
     to_add = sorted(want_set - have)
     to_del = sorted(have - want_set - pin)
 
-    for a in to_add:
-        sp.run(["ip", "-6", "addr", "replace", f"{a}/128", "dev", iface], check=True)
-    for a in to_del:
-        sp.run(["ip", "-6", "addr", "del", f"{a}/128", "dev", iface], check=True)
+    if not to_add and not to_del:
+        print(f"[manager] iface {iface}: IPv6 up to date ({len(have)} addrs).")
+        return
+    _change_iface_ipv6(iface, to_add, to_del, dad, dad_timeout)
 
 
-def _build_assignments(cfg: Config, prev: State) -> List[Assignment]:
-    assigns: List[Assignment] = []
-    for g in cfg.proxy_groups:
-        net = ipa.IPv6Network(g.ipv6_subnet, strict=False)
-        needed = g.count
-        capacity = g.port_range.end - g.port_range.start + 1
-        if capacity < needed:
-            raise typer.BadParameter(
-                f"group '{g.name}': port_range capacity {capacity} < count {needed}"
-            )
-
-        for i in range(needed):
-            # начинаем с ::1, ::2, ...
-            host = int(net.network_address) + (i + 2)
-            ipv6 = str(ipa.IPv6Address(host))
-            port = g.port_range.start + i
-            assigns.append(
-                Assignment(
-                    group=g.name,
-                    port=port,
-                    ipv6=ipv6,
-                    proxy_type=g.proxy_type,
-                    listen_stack=g.listen_stack,
-                    nfqueue_num=g.nfqueue_num,
-                )
-            )
-    return assigns
-
-
-def _render_3proxy_cfg(cfg: Config, assigns: List[Assignment]) -> str:
-    lines: List[str] = [
-        "# auto-generated by weaver_manager",
-        "pidfile /run/3proxy/3proxy.pid",
-        "nserver 1.1.1.1",
-        "nserver 2606:4700:4700::1111",
-        "nscache 65536",
-        "",
-        "setgid 1337",
-        "setuid 1337",
-        'monitor "/run/3proxy/3proxy.ver"',
-        "log /run/3proxy/3proxy.log D",
-        "rotate 10",
-        "flush",
-        "",
-        "auth none",
-        "allow *",
-        "",
-    ]
+# local-маршруты (AnyIP) вешаются на loopback, как `ip route add local ... dev lo`
+LOCAL_ROUTE_DEV = "lo"
+NONLOCAL_BIND_SYSCTL = "net/ipv6/ip_nonlocal_bind"
 
-    for a in assigns:
-        family_flag = "-6" if a.listen_stack == "ipv6" else ""
-        listen_ip = "::" if a.listen_stack == "ipv6" else cfg.global_.inbound_ipv4_address
-        # ВАЖНО: без пробела и без скобок
-        egress = f"-e{a.ipv6}" if cfg.global_.egress_bind == "auto" else ""
-        cmd = "proxy" if a.proxy_type.lower() == "http" else "socks"
-        parts = [cmd, family_flag, f"-p{a.port}", f"-i{listen_ip}", "-n", "-a"]
-        if egress:
-            parts.append(egress)
-        line = " ".join(p for p in parts if p)
-        lines.append(line)
 
-    return "\n".join(lines) + "\n"
+def _require_sysctl(key: str, value: str) -> None:
+    """
+    Предусловие хоста. В контейнере без privileged /proc/sys только для
+    чтения: там его выставляют на хосте (sysctl.d), здесь — проверяем.
+    Если /proc/sys доступен на запись (privileged, голый хост) — ставим сами.
+    """
+    path = Path("/proc/sys") / key
+    name = key.replace("/", ".")
+    try:
+        cur = path.read_text(encoding="ascii").strip()
+    except OSError as e:
+        raise RuntimeError(f"sysctl {name}: cannot read ({e})") from e
+    if cur == value:
+        return
+    try:
+        path.write_text(value + "\n", encoding="ascii")
+    except OSError as e:
+        raise RuntimeError(
+            f"sysctl {name}={cur}, egress_mode=prefix needs {value}; /proc/sys is not writable here ({e.strerror}). "
+            f"Enable it on the host: `sysctl -w {name}={value}` and persist it with "
+            f"`echo {name}={value} > /etc/sysctl.d/90-weaver.conf`"
+        ) from e
+    print(f"[manager] sysctl {name}={value}")
+
+
+def _reconcile_local_routes(nets: List[ipa.IPv6Network]) -> None:
+    """
+    По local-маршруту на префикс группы; наши маршруты помечены
+    proto RTPROT_WEAVER, чужие (в т.ч. от адресов) не трогаем.
+    """
+    want = set(nets)
+    try:
+        have = {r.network for r in netlink.weaver_local_routes()}
+        to_add = sorted(want - have)
+        to_del = sorted(have - want)
+        if not to_add and not to_del:
+            print(f"[manager] local routes up to date ({len(have)} prefixes).")
+            return
+        res = netlink.batch_local_routes(LOCAL_ROUTE_DEV, add=to_add, delete=to_del)
+    except netlink.NetlinkUnavailable as e:
+        print(f"[manager] netlink unavailable ({e}), falling back to ip(8)")
+        proto = str(netlink.RTPROT_WEAVER)
+        out = sp.check_output(["ip", "-j", "-6", "route", "show", "table", "local", "proto", proto], text=True)
+        have = {ipa.IPv6Network(r["dst"], strict=False) for r in json.loads(out or "[]") if r.get("type") == "local"}
+        for n in sorted(want - have):
+            sp.run(["ip", "-6", "route", "replace", "local", str(n), "dev", LOCAL_ROUTE_DEV,
+                    "table", "local", "proto", proto], check=True)
+        for n in sorted(have - want):
+            sp.run(["ip", "-6", "route", "del", "local", str(n), "dev", LOCAL_ROUTE_DEV,
+                    "table", "local", "proto", proto], check=True)
+        print(f"[manager] local routes: +{len(want - have)} -{len(have - want)} (ip)")
+        return
+    except OSError as e:
+        raise RuntimeError(f"local routes: netlink batch failed: {e}") from e
+    print(f"[manager] local routes: +{res.added} -{res.deleted} in {res.elapsed:.3f}s (netlink)")
+    if not res.ok:
+        for n, err in sorted(res.failed.items()):
+            print(f"[manager]   {n}: {err}")
+        raise RuntimeError(f"{len(res.failed)} local route operations failed")
+
 
+def _apply_prefix_egress(g: GlobalConfig, nets: List[ipa.IPv6Network]) -> None:
+    """
+    egress_mode=prefix: весь префикс локален через один local-маршрут,
+    bind на любой его адрес разрешён ip_nonlocal_bind — 3proxy -e
+    работает без /128 на интерфейсе. Стоимость O(групп), не O(адресов).
+    /128, оставшиеся от режима addrs, снимаются (кроме pinned).
+    """
+    _require_sysctl(NONLOCAL_BIND_SYSCTL, "1")
+    _reconcile_local_routes(nets)
+    _reconcile_iface_ipv6(g.ipv6_interface, [], g.pinned_ipv6, nets)
 
-def _write_proxy_cfg(cfg_path: Path, content: str) -> None:
-    cfg_path.parent.mkdir(parents=True, exist_ok=True)
-    cfg_path.write_text(content, encoding="utf-8")
-    # пнуть 3proxy через 'monitor'
-    Path("/run/3proxy/3proxy.ver").write_text("reload\n", encoding="utf-8")
+
+def _build_assignments(cfg: Config, prev: State) -> Tuple[List[Assignment], AssignDiff]:
+    """
+    Привязки port -> ipv6 из prev сохраняются (allocator), новые берутся
+    из свободных; count/порядок групп не сдвигают уже выданные.
+    """
+    specs = [
+        GroupSpec(
+            name=g.name,
+            subnet=g.ipv6_subnet or "",
+            count=g.count,
+            port_start=g.port_range.start,
+            port_end=g.port_range.end,
+            proxy_type=g.proxy_type,
+            listen_stack=g.listen_stack,
+            nfqueue_num=g.nfqueue_num,
+            nfqueue_last=g.nfqueue_last,
+            addr_strategy=g.addr_strategy,
+            addr_stride=g.addr_stride,
+            prefixes=tuple(
+                PrefixSpec(p.prefix, weight=p.weight, capacity=p.capacity, split=p.split)
+                for p in g.ipv6_prefixes
+            ),
+        )
+        for g in cfg.proxy_groups
+    ]
+    try:
+        return allocate(specs, prev.assignments, reserved=[*cfg.global_.pinned_ipv6, *_dad_failed(prev)])
+    except AllocationError as e:
+        raise typer.BadParameter(str(e)) from e
 
 
-def _apply_nft(cfg: Config, assigns: List[Assignment]) -> None:
+def _write_proxy_cfg(cfg: Config, assigns: List[Assignment]) -> proxy_config.RenderResult:
+    """
+    Рендер потоком во временный файл; 3proxy пинается только если файл
+    на диске изменился: reload через monitor рвёт живые соединения.
+    Шарды сами стоят под monitor — их правка перезагружает 3proxy без .ver.
+    При нескольких экземплярах пинается .ver только тех, чей срез изменился.
+    """
+    g = cfg.global_
+    cfg_path = Path(g.proxy_config_path)
+    res = proxy_config.write_3proxy_cfg(
+        cfg_path, assigns, g.inbound_ipv4_address, g.egress_bind == "auto",
+        shard_by=g.proxy_shards, instances=g.proxy_instances, resolver=g.resolver.for_3proxy(),
+    )
+    if not res.changed:
+        print(f"[manager] {cfg_path.name} unchanged, 3proxy not signalled.")
+        return res
+    if g.proxy_instances > 1:
+        for i in res.instances_changed:
+            Path(proxy_config.instance_paths(cfg_path, i).monitor).write_text("reload\n", encoding="utf-8")
+        print(
+            f"[manager] 3proxy instances: signalled {','.join(map(str, res.instances_changed)) or '-'}"
+            f" of {g.proxy_instances}, removed {','.join(map(str, res.instances_removed)) or '-'}"
+        )
+        if res.main_removed or res.shards_removed:
+            print(f"[manager] {cfg_path.name} and its shards removed (proxy_instances > 1 uses the manifest).")
+        return res
+    if res.shards_changed or res.shards_removed:
+        print(
+            f"[manager] 3proxy shards: changed {','.join(res.shards_changed) or '-'}, "
+            f"removed {','.join(res.shards_removed) or '-'}"
+        )
+    if res.main_changed:
+        # пнуть 3proxy через 'monitor'
+        Path(proxy_config.VERSION_FILE).write_text("reload\n", encoding="utf-8")
+        print(f"[manager] {cfg_path.name} written, 3proxy signalled.")
+    return res
+
+
+def _apply_nft(cfg: Config, assigns: List[Assignment], want: Optional[nft.Ruleset] = None) -> None:
     """
-    Простейшие observe-правила: одна таблица, сеты портов по номерам NFQUEUE.
-    Без заморочек с флагами TCP, чтобы не ловить "No symbol type information".
+    Observe-правила: одна таблица inet weaver, сеты портов/адресов по номерам
+    NFQUEUE. Всё применяется одним `nft -f` — одной транзакцией ядра.
     """
     if not cfg.global_.observe_enabled:
         print("[manager] nft rules skipped (observe disabled).")
         return
 
-    # собираем порты по номеру очереди
-    by_q: Dict[int, Set[int]] = {}
-    for a in assigns:
-        if a.nfqueue_num is None:
-            continue
-        by_q.setdefault(a.nfqueue_num, set()).add(a.port)
-
-    # сначала снесём нашу таблицу (если была)
-    sp.run(["nft", "delete", "table", "inet", "weaver"], check=False)
-
-    if not by_q:
+    if not any(a.nfqueue_num is not None for a in assigns):
+        nft.delete_table()
         print("[manager] nft rules: no queues/ports to install.")
         return
 
-    lines: List[str] = ["table inet weaver {"]
-
-    # сеты портов
-    for q, ports in sorted(by_q.items()):
-        set_name = f"weaver_ports_{q}"
-        elems = ", ".join(str(p) for p in sorted(ports))
-        lines.append(f"  set {set_name} {{ type inet_service; elements = {{ {elems} }} }}")
-
-    # цепочка
-    lines.append("  chain input { type filter hook input priority 0;")
-    for q, _ in sorted(by_q.items()):
-        set_name = f"weaver_ports_{q}"
-        lines.append(f"    tcp dport @{set_name} queue num {q} bypass")
-    lines.append("  }")
-    lines.append("}")
-
-    script = "\n".join(lines) + "\n"
-    sp.run(["nft", "-f", "-"], input=script, text=True, check=True)
-    print("[manager] nft rules applied.")
+    res = nft.apply_ruleset(want if want is not None else nft.build_ruleset(assigns, _nflog_groups(cfg)))
+    if res.mode == "noop":
+        print("[manager] nft rules up to date.")
+    else:
+        print(f"[manager] nft rules applied ({res.mode}): +{res.added} -{res.removed} elements.")
 
 
 # =========================
@@ -310,33 +745,192 @@ def apply_cmd(
         "--addr-mode",
         help="manage|skip: управлять адресами /128 на интерфейсе или пропустить (Dev)",
     ),
+    force: bool = typer.Option(
+        False,
+        "--force",
+        help="Применить, даже если конфиг не менялся с прошлого apply",
+    ),
+    lock_timeout: float = typer.Option(
+        30.0,
+        "--lock-timeout",
+        help="Сколько секунд ждать state-lock параллельного apply",
+    ),
 ) -> None:
     cfg_path = Path(config)
     cfg = _load_config(cfg_path)
-    state_path = Path(cfg.global_.state_file_path)
-    prev = read_state(state_path)
+    cfg_hash = _config_hash(cfg, nft_mode, addr_mode)
+    store = _state_store(cfg, lock_timeout)
+
+    try:
+        with store.transaction() as txn:
+            prev = txn.state
+            if not force and prev.version and prev.config_hash == cfg_hash:
+                print(
+                    f"[manager] config unchanged since state v{prev.version} "
+                    f"({cfg_hash[:12]}), nothing to apply (--force to re-apply)."
+                )
+                return
 
-    assigns = _build_assignments(cfg, prev)
+            def mark_dirty() -> None:
+                txn.commit(_dirty_state(prev))
+
+            try:
+                assigns, stages = _apply(cfg, prev, nft_mode, addr_mode, force, mark_dirty)
+            except DadError as e:
+                # адреса сняты; запоминаем занятые на линке, чтобы следующий
+                # apply выдал вместо них другие, а не падал на них же
+                txn.commit(_dirty_state(prev, e.failed))
+                raise
+            st = txn.commit(State(assignments=assigns, config_hash=cfg_hash, stages=stages))
+    except state_io.StateError as e:
+        raise typer.BadParameter(f"state {store.path}: {e}") from e
+    except RuntimeError as e:
+        typer.echo(f"[manager] apply failed: {e}", err=True)
+        raise typer.Exit(1) from e
+    print(f"[manager] state v{st.version} saved ({len(assigns)} assignments, {cfg.global_.state_format}).")
+
+
+# стадии, описывающие адреса на интерфейсе: без них следующий apply
+# делает полный дамп интерфейса вместо диффа к прошлому state
+IFACE_STAGES = ("addrs", "addrs_env")
+
+
+def _dad_failed(prev: State) -> List[str]:
+    """Адреса, однажды не прошедшие DAD (кто-то на линке их занял): заново не раздаются."""
+    return [a for a in prev.stages.get("dad_failed", "").split(",") if a]
+
+
+def _dirty_state(prev: State, dad_failed: Iterable[str] = ()) -> State:
+    """
+    prev без отпечатков интерфейса и без config_hash: пишется до того,
+    как интерфейс разойдётся с prev. Упадёт apply дальше (DAD, netlink,
+    3proxy.cfg, nft) — следующий не поверит диффу и не пропустит конфиг.
+    """
+    stages = {k: v for k, v in prev.stages.items() if k not in IFACE_STAGES}
+    failed = sorted(set(_dad_failed(prev)) | set(dad_failed))
+    if failed:
+        stages["dad_failed"] = ",".join(failed)
+    return State(assignments=prev.assignments, config_hash="", stages=stages)
+
+
+def _apply(
+    cfg: Config,
+    prev: State,
+    nft_mode: str,
+    addr_mode: str,
+    force: bool = False,
+    mark_dirty: Optional[Callable[[], None]] = None,
+) -> Tuple[List[Assignment], Dict[str, str]]:
+    """
+    Стадии с отпечатками входа: стадия, чей отпечаток совпал с записанным
+    в прошлом state, пропускается. Возвращает assignments и новые отпечатки.
+    mark_dirty вызывается один раз, перед первой правкой интерфейса.
+    """
+    assigns, diff = _build_assignments(cfg, prev)
+    print(f"[manager] assignments: {diff.summary()} (added/removed/changed/kept)")
     nets = _weaver_subnets(cfg)
+    stages: Dict[str, str] = {}
+    if prev.stages.get("dad_failed"):
+        stages["dad_failed"] = prev.stages["dad_failed"]
+    # адреса и nft живут в ядре и не переживают перезагрузку
+    boot = _boot_id()
+
+    def unchanged(stage: str, fp: str) -> bool:
+        stages[stage] = fp
+        if not force and prev.stages.get(stage) == fp:
+            print(f"[manager] {stage}: inputs unchanged ({fp[:12]}), skipped.")
+            return True
+        return False
+
+    def iface_dirty() -> None:
+        nonlocal mark_dirty
+        if mark_dirty is not None:
+            mark_dirty()
+            mark_dirty = None
 
     # 1) IPv6 адреса на интерфейсе (безопасное reconcile)
-    if addr_mode == "manage":
-        _reconcile_iface_ipv6(cfg.global_.ipv6_interface, (a.ipv6 for a in assigns), cfg.global_.pinned_ipv6, nets)
+    g = cfg.global_
+    if addr_mode == "manage" and g.egress_mode == "prefix":
+        stages["egress"] = "prefix"
+        fp = _fingerprint(boot, "prefix", g.ipv6_interface, *sorted(g.pinned_ipv6), "|", *sorted(map(str, nets)))
+        if not unchanged("addrs", fp):
+            iface_dirty()
+            _apply_prefix_egress(g, nets)
+    elif addr_mode == "manage":
+        stages["egress"] = "addrs"
+        if prev.stages.get("egress") == "prefix":
+            # вернулись с prefix: наши local-маршруты больше не нужны
+            _reconcile_local_routes([])
+        want = sorted(a.ipv6 for a in assigns)
+        # env — всё, кроме набора адресов: совпал — интерфейс в том виде,
+        # в каком его оставил прошлый apply, и хватает диффа без дампа
+        env = _fingerprint(boot, g.ipv6_interface, *sorted(g.pinned_ipv6), "|", *sorted(map(str, nets)))
+        stages["addrs_env"] = env
+        fp = _fingerprint(env, *want)
+        if not unchanged("addrs", fp):
+            iface_dirty()
+            if not force and prev.stages.get("addrs_env") == env:
+                pin = set(g.pinned_ipv6)
+                to_add, to_del = diff.addrs()
+                to_del = [a for a in to_del if a not in pin]
+                if to_add or to_del:
+                    _change_iface_ipv6(g.ipv6_interface, to_add, to_del, g.addr_dad, g.dad_timeout_sec)
+            else:
+                _reconcile_iface_ipv6(
+                    g.ipv6_interface, want, g.pinned_ipv6, nets, g.addr_dad, g.dad_timeout_sec,
+                )
     else:
+        # интерфейс и маршруты не трогали — режим egress остаётся прежним,
+        # иначе после prefix -> skip -> addrs наши local-маршруты не снять
+        if "egress" in prev.stages:
+            stages["egress"] = prev.stages["egress"]
         print("[manager] iface IPv6 reconciliation skipped (--addr-mode=skip)")
 
-    # 2) 3proxy.cfg
-    _write_proxy_cfg(Path(cfg.global_.proxy_config_path), _render_3proxy_cfg(cfg, assigns))
+    # 2) 3proxy.cfg — сравнение с файлом на диске, reload только при отличии
+    stages["proxy_cfg"] = _write_proxy_cfg(cfg, assigns).digest
 
     # 3) nft (observe)
     if nft_mode == "auto" and cfg.global_.observe_enabled:
-        _apply_nft(cfg, assigns)
+        queued = any(a.nfqueue_num is not None for a in assigns)
+        want_rs = nft.build_ruleset(assigns, _nflog_groups(cfg)) if queued else None
+        fp = _fingerprint(boot, nft.render_ruleset(want_rs) if want_rs is not None else "")
+        if not unchanged("nft", fp):
+            _apply_nft(cfg, assigns, want_rs)
     else:
         print("[manager] nft rules skipped (observe disabled or nft_mode=none).")
 
-    # 4) сохранить состояние
-    write_state(state_path, State(assignments=assigns))
-    print("[manager] state.json updated.")
+    return assigns, stages
+
+
+@app.command("state-dump")
+def state_dump_cmd(
+    config: str = typer.Option("/app/config/config.yaml", "--config", "-c", help="Путь к YAML конфигурации"),
+    port: Optional[int] = typer.Option(None, "--port", min=1, max=65535, help="Только привязка этого порта"),
+    addr: Optional[str] = typer.Option(None, "--addr", help="Только привязка этого IPv6"),
+) -> None:
+    """Печатает state в JSON (в т.ч. бинарный); --port/--addr — одну привязку по индексу."""
+    cfg = _load_config(Path(config))
+    store = _state_store(cfg)
+    if port is not None and addr is not None:
+        raise typer.BadParameter("--port and --addr are mutually exclusive")
+    if addr is not None:
+        try:
+            addr = str(ipa.IPv6Address(addr.strip()))
+        except ValueError as e:
+            raise typer.BadParameter(f"--addr: {e}") from e
+    try:
+        with store.locked():
+            if port is None and addr is None:
+                typer.echo(state_io.to_json(store.load()))
+                return
+            found = state_io.lookup(store.path, port=port, addr=addr)
+    except (state_io.StateError, OSError) as e:
+        typer.echo(f"[manager] state {store.path}: {e}", err=True)
+        raise typer.Exit(1) from e
+    if found is None:
+        typer.echo(f"[manager] no assignment for {port if port is not None else addr}", err=True)
+        raise typer.Exit(1)
+    typer.echo(json.dumps(asdict(found), ensure_ascii=False, indent=2))
 
 
 if __name__ == "__main__":
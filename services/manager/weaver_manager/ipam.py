@@ -1,33 +1,343 @@
 from __future__ import annotations
 
+import bisect
+import hashlib
+import socket
+from array import array
 from ipaddress import IPv6Address, IPv6Network
-from typing import Iterable, List, Set
+from math import gcd
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+
+from weaver_manager.ranges import Interval, merge
+
+# IPAM поверх целых: подсеть — диапазон смещений [0, size), занятое —
+# отсортированные непересекающиеся интервалы (IntervalSet, bisect —
+# O(log n) на проверку/освобождение). Промежуточные адреса никогда не
+# материализуются: sequential идёт по свободным промежуткам, strided и
+# hashed — по биекции индекс -> смещение с пропуском занятого.
+# Bulk-выдача — AddrArray: база + смещения в array('Q') (для префиксов
+# короче /64 — ещё и старшие 64 бита отдельным массивом).
+
+STRATEGIES = ("sequential", "strided", "hashed")
+
+# ::0 — subnet-router anycast, ::1 — обычно шлюз
+DEFAULT_RESERVE_LOW = 2
+
+_MASK64 = (1 << 64) - 1
+
+
+class IpamError(ValueError):
+    pass
+
+
+class IntervalSet:
+    """Занятые смещения как отсортированные [lo, hi]."""
+
+    def __init__(self, intervals: Iterable[Interval] = ()) -> None:
+        merged = merge(intervals)
+        self._lo: List[int] = [lo for lo, _ in merged]
+        self._hi: List[int] = [hi for _, hi in merged]
+
+    def __contains__(self, x: int) -> bool:
+        i = bisect.bisect_right(self._lo, x) - 1
+        return i >= 0 and x <= self._hi[i]
+
+    def count(self) -> int:
+        # не __len__: в /48 занятого может быть больше sys.maxsize
+        return sum(h - l + 1 for l, h in zip(self._lo, self._hi))
+
+    def intervals(self) -> List[Interval]:
+        return list(zip(self._lo, self._hi))
+
+    def add(self, lo: int, hi: Optional[int] = None) -> None:
+        hi = lo if hi is None else hi
+        i = bisect.bisect_left(self._hi, lo - 1)
+        j = bisect.bisect_right(self._lo, hi + 1)
+        if i < j:
+            lo = min(lo, self._lo[i])
+            hi = max(hi, self._hi[j - 1])
+        self._lo[i:j] = [lo]
+        self._hi[i:j] = [hi]
+
+    def update(self, intervals: Iterable[Interval]) -> None:
+        """Массовое добавление: один merge вместо n вставок."""
+        merged = merge(list(zip(self._lo, self._hi)) + list(intervals))
+        self._lo = [lo for lo, _ in merged]
+        self._hi = [hi for _, hi in merged]
+
+    def discard(self, x: int) -> bool:
+        i = bisect.bisect_right(self._lo, x) - 1
+        if i < 0 or x > self._hi[i]:
+            return False
+        lo, hi = self._lo[i], self._hi[i]
+        parts = [(a, b) for a, b in ((lo, x - 1), (x + 1, hi)) if a <= b]
+        self._lo[i:i + 1] = [a for a, _ in parts]
+        self._hi[i:i + 1] = [b for _, b in parts]
+        return True
+
+    def gaps(self, lo: int, hi: int) -> Iterator[Interval]:
+        """Свободные промежутки внутри [lo, hi]."""
+        i = max(bisect.bisect_right(self._lo, lo) - 1, 0)
+        cur = lo
+        n = len(self._lo)
+        while i < n and self._lo[i] <= hi:
+            if self._hi[i] >= cur:
+                if self._lo[i] > cur:
+                    yield cur, min(self._lo[i] - 1, hi)
+                cur = self._hi[i] + 1
+            i += 1
+        if cur <= hi:
+            yield cur, hi
+
+
+class AddrArray:
+    """Компактный набор адресов: base + (hi << 64 | lo)."""
+
+    __slots__ = ("base", "lo", "hi")
+
+    def __init__(self, base: int, lo: array, hi: Optional[array] = None) -> None:
+        self.base = base
+        self.lo = lo
+        self.hi = hi
+
+    def __len__(self) -> int:
+        return len(self.lo)
+
+    def offset(self, i: int) -> int:
+        return self.lo[i] if self.hi is None else (self.hi[i] << 64) | self.lo[i]
+
+    def __getitem__(self, i: int) -> int:
+        return self.base + self.offset(i)
+
+    def __iter__(self) -> Iterator[int]:
+        base = self.base
+        if self.hi is None:
+            return (base + o for o in self.lo)
+        return (base + ((h << 64) | l) for h, l in zip(self.hi, self.lo))
+
+    def strs(self) -> Iterator[str]:
+        ntop, af = socket.inet_ntop, socket.AF_INET6
+        return (ntop(af, a.to_bytes(16, "big")) for a in self)
+
+    def offsets(self) -> Iterator[int]:
+        return (self.offset(i) for i in range(len(self.lo)))
+
+
+def _bits_for(n: int) -> int:
+    return max(1, (n - 1).bit_length())
+
+
+class _Scatter:
+    """
+    Биекция [0, 2^k) -> [0, 2^k): умножение на нечётное + xorshift,
+    ключ из seed. Значения вне [0, n) пропускаются (cycle walking),
+    так что это перестановка [0, n) без таблиц.
+    """
+
+    def __init__(self, n: int, seed: str) -> None:
+        self.n = n
+        self.k = _bits_for(n)
+        self.mask = (1 << self.k) - 1
+        d = hashlib.blake2b(seed.encode("utf-8"), digest_size=32).digest()
+        self.mul = [int.from_bytes(d[i:i + 8], "big") | 1 for i in (0, 8)]
+        self.add = [int.from_bytes(d[i:i + 8], "big") for i in (16, 24)]
+        self.shift = max(1, self.k // 2)
+
+    def _perm(self, x: int) -> int:
+        m, s = self.mask, self.shift
+        for mul, add in zip(self.mul, self.add):
+            x = (x * mul + add) & m
+            x ^= x >> s
+        return x
+
+    def __call__(self, i: int) -> int:
+        x = self._perm(i)
+        while x >= self.n:
+            x = self._perm(x)
+        return x
+
+
+class Pool:
+    """
+    Пул адресов одного префикса. Смещения считаются от network_address;
+    первые reserve_low не раздаются.
+    """
+
+    def __init__(self, network: Union[str, IPv6Network], reserve_low: int = DEFAULT_RESERVE_LOW) -> None:
+        self.net = network if isinstance(network, IPv6Network) else IPv6Network(network, strict=False)
+        self.base = int(self.net.network_address)
+        self.size = 1 << (128 - self.net.prefixlen)   # num_addresses заметно дороже
+        self.reserve_low = min(reserve_low, self.size)
+        self.used = IntervalSet([(0, self.reserve_low - 1)] if self.reserve_low else [])
+
+    def __contains__(self, addr: int) -> bool:
+        return 0 <= addr - self.base < self.size
+
+    @property
+    def free(self) -> int:
+        return self.size - self.used.count()
+
+    # ---- занятость ----
+
+    def reserve(self, addrs: Iterable[int]) -> int:
+        """Помечает занятыми адреса (int) из этого префикса; чужие игнорируются."""
+        base, size = self.base, self.size
+        offs = [a - base for a in addrs if 0 <= a - base < size]
+        self.used.update((o, o) for o in offs)
+        return len(offs)
+
+    def reserve_strs(self, addrs: Iterable[str]) -> int:
+        return self.reserve(int(IPv6Address(a)) for a in addrs)
+
+    def release(self, addrs: Iterable[int]) -> int:
+        n = 0
+        for a in addrs:
+            o = a - self.base
+            if o >= self.reserve_low and self.used.discard(o):
+                n += 1
+        return n
+
+    # ---- выдача ----
+
+    def _sequential(self, count: int) -> Iterator[int]:
+        left = count
+        for lo, hi in self.used.gaps(0, self.size - 1):
+            n = min(hi - lo + 1, left)
+            yield from range(lo, lo + n)
+            left -= n
+            if not left:
+                return
+
+    def _indexed(self, count: int, index_to_offset) -> Iterator[int]:
+        span = self.size - self.reserve_low
+        used = self.used
+        left = count
+        i = 0
+        while left and i < span:
+            o = self.reserve_low + index_to_offset(i)
+            i += 1
+            if o in used:
+                continue
+            yield o
+            left -= 1
+
+    def take(
+        self,
+        count: int,
+        strategy: str = "sequential",
+        stride: int = 1,
+        seed: str = "",
+    ) -> AddrArray:
+        """
+        sequential — по возрастанию из свободных промежутков;
+        strided — base, base+stride, ... по модулю размера (шаг делается
+        нечётным/взаимно простым, чтобы обойти весь префикс);
+        hashed — псевдослучайная перестановка префикса по seed.
+        """
+        if count < 0:
+            raise IpamError("count must be >= 0")
+        if count > self.free:
+            raise IpamError(f"{self.net}: {count} requested, {self.free} free")
+        span = self.size - self.reserve_low
+        if strategy == "sequential":
+            offs: Iterable[int] = self._sequential(count)
+        elif strategy == "strided":
+            step = _coprime_step(stride, span)
+            offs = self._indexed(count, lambda i: (i * step) % span)
+        elif strategy == "hashed":
+            offs = self._indexed(count, _Scatter(span, seed or str(self.net)))
+        else:
+            raise IpamError(f"unknown strategy {strategy!r}, expected one of {STRATEGIES}")
+
+        wide = self.size > (1 << 64)
+        lo = array("Q")
+        hi: Optional[array] = array("Q") if wide else None
+        taken: List[int] = []
+        for o in offs:
+            taken.append(o)
+            if hi is not None:
+                hi.append(o >> 64)
+                lo.append(o & _MASK64)
+            else:
+                lo.append(o)
+        if len(taken) < count:
+            raise IpamError(f"{self.net}: only {len(taken)} of {count} addresses free")
+        taken.sort()
+        self.used.update(_runs(taken))
+        return AddrArray(self.base, lo, hi)
+
+
+def _runs(sorted_offs: List[int]) -> Iterator[Interval]:
+    it = iter(sorted_offs)
+    try:
+        lo = hi = next(it)
+    except StopIteration:
+        return
+    for o in it:
+        if o == hi + 1:
+            hi = o
+        else:
+            yield lo, hi
+            lo = hi = o
+    yield lo, hi
+
+
+def _coprime_step(stride: int, span: int) -> int:
+    step = max(1, stride) % span or 1
+    while gcd(step, span) != 1:
+        step += 1
+    return step
+
+
+def weighted_split(total: int, weights: List[int], caps: List[int]) -> List[int]:
+    """
+    Делит total по весам (метод наибольших остатков) с потолком caps[i]:
+    упёршийся в потолок выбывает, его остаток делится между остальными.
+    Сумма результата — min(total, sum(caps)).
+    """
+    out = [0] * len(weights)
+    left = min(total, sum(caps))
+    active = [i for i, w in enumerate(weights) if w > 0 and caps[i] > 0]
+    while left and active:
+        wsum = sum(weights[i] for i in active)
+        shares = [(left * weights[i], i) for i in active]
+        give = {i: min(q // wsum, caps[i] - out[i]) for q, i in shares}
+        rest = left - sum(give.values())
+        # остатки — по убыванию дробной части, при равенстве по порядку
+        for _, i in sorted(((-(q % wsum), i) for q, i in shares)):
+            if not rest:
+                break
+            if give[i] < caps[i] - out[i]:
+                give[i] += 1
+                rest -= 1
+        for i, n in give.items():
+            out[i] += n
+            left -= n
+        active = [i for i in active if out[i] < caps[i]]
+    return out
+
+
+def take_addrs(
+    subnet: str,
+    count: int,
+    exclude: Iterable[str] = (),
+    strategy: str = "sequential",
+    stride: int = 1,
+    seed: str = "",
+    reserve_low: int = DEFAULT_RESERVE_LOW,
+) -> Tuple[Pool, AddrArray]:
+    pool = Pool(subnet, reserve_low)
+    pool.reserve_strs(exclude)
+    return pool, pool.take(count, strategy, stride, seed)
 
 
 def generate_ipv6_hosts(subnet: str, count: int, exclude: Iterable[str] = ()) -> List[str]:
     """
-    Детерминированная генерация первых N уникальных /128 из заданного /64.
+    Детерминированная генерация первых N уникальных /128 из заданного префикса.
     exclude: адреса, которые надо пропустить (например, pinned).
     """
-    net = IPv6Network(subnet, strict=False)
-    if net.prefixlen > 64:
-        # Разрешаем и другие размеры, но просто идём по available hosts
-        pass
-    ex: Set[IPv6Address] = {IPv6Address(x) for x in exclude}
-    res: List[str] = []
-    # Начинаем с первого адреса в подсети + 1 (пропустим network-address)
-    start = int(net.network_address)
-    # По /64 свободные 64 бита, но мы не мудрим: идём последовательно
-    i = 1
-    while len(res) < count:
-        addr = IPv6Address(start + i)
-        i += 1
-        if addr in ex:
-            continue
-        if addr not in net:
-            break
-        res.append(str(addr))
-    if len(res) < count:
-        raise ValueError(f"not enough addresses in {subnet} to allocate {count}")
-    return res
-
+    try:
+        _, arr = take_addrs(subnet, count, exclude, reserve_low=1)
+    except IpamError as e:
+        raise ValueError(f"not enough addresses in {subnet} to allocate {count}") from e
+    return list(arr.strs())
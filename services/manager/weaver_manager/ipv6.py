@@ -1,21 +1,26 @@
 from __future__ import annotations
 import subprocess
-from ipaddress import IPv6Network
+from ipaddress import IPv6Address, IPv6Network
 from typing import List
 
+from weaver_manager import ipam, netlink
+
 
 def generate_ipv6_addrs(subnet: str, count: int) -> List[str]:
-    net = IPv6Network(subnet, strict=False)
-    base = int(net.network_address)
-    addrs = []
     # пропускаем network ::, начинаем с +1
-    for i in range(1, count + 1):
-        addr_int = base + i
-        addrs.append(str(IPv6Network((addr_int, 128)).network_address))
-    return addrs
+    _, arr = ipam.take_addrs(subnet, count, reserve_low=1)
+    return list(arr.strs())
 
 
 def current_ipv6_addrs(iface: str) -> List[str]:
+    try:
+        return [
+            str(IPv6Address(a.addr))
+            for a in netlink.iter_ipv6_addrs(iface)
+            if a.prefixlen == 128
+        ]
+    except OSError:
+        pass
     out = subprocess.run(
         ["ip", "-6", "-o", "addr", "show", "dev", iface],
         check=False,
@@ -38,6 +43,16 @@ def ensure_ipv6_addrs(iface: str, desired: List[str]) -> None:
     want = set(desired)
     to_add = sorted(want - have)
     to_del = sorted(have - want)
+    try:
+        res = netlink.batch_ipv6_addrs(iface, add=to_add, delete=to_del)
+    except OSError:
+        res = None
+    if res is not None:
+        # del не критичен (как и раньше), add — критичен
+        failed_add = [ip for ip in to_add if ip in res.failed]
+        if failed_add:
+            raise RuntimeError(f"failed to add {len(failed_add)} IPv6 addrs: {res.failed[failed_add[0]]}")
+        return
     for ip in to_del:
         subprocess.run(["ip", "-6", "addr", "del", f"{ip}/128", "dev", iface], check=False)
     for ip in to_add:
@@ -0,0 +1,589 @@
+from __future__ import annotations
+
+import errno
+import ipaddress as ipa
+import os
+import select
+import socket
+import struct
+import time
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# rtnetlink: минимальный клиент без iproute2 (только stdlib)
+
+NETLINK_ROUTE = 0
+
+NLM_F_REQUEST = 0x001
+NLM_F_MULTI = 0x002
+NLM_F_ACK = 0x004
+NLM_F_ROOT = 0x100
+NLM_F_MATCH = 0x200
+NLM_F_DUMP = NLM_F_ROOT | NLM_F_MATCH
+NLM_F_REPLACE = 0x100
+NLM_F_EXCL = 0x200
+NLM_F_CREATE = 0x400
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+
+RTM_NEWADDR = 20
+RTM_DELADDR = 21
+RTM_GETADDR = 22
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+RTM_GETROUTE = 26
+
+IFA_ADDRESS = 1
+IFA_LOCAL = 2
+IFA_FLAGS = 8
+
+RTA_DST = 1
+RTA_OIF = 4
+RTA_TABLE = 15
+
+IFA_F_NODAD = 0x02
+IFA_F_DADFAILED = 0x08
+IFA_F_TENTATIVE = 0x40
+
+# multicast-группа RTNLGRP_IPV6_IFADDR (9) как битовая маска bind()
+RTMGRP_IPV6_IFADDR = 1 << (9 - 1)
+
+RT_SCOPE_UNIVERSE = 0  # "global" в терминах iproute2
+RT_SCOPE_HOST = 254
+RT_TABLE_LOCAL = 255
+RTN_LOCAL = 2
+# свой rtm_protocol: по нему находим свои маршруты при reconcile
+# (ядро значения >= RTPROT_STATIC не интерпретирует)
+RTPROT_WEAVER = 0x57
+
+_NLMSGHDR = struct.Struct("=IHHII")   # len, type, flags, seq, pid
+_IFADDRMSG = struct.Struct("=BBBBI")  # family, prefixlen, flags, scope, index
+_RTMSG = struct.Struct("=BBBBBBBBI")  # family, dst_len, src_len, tos, table, protocol, scope, type, flags
+_RTATTR = struct.Struct("=HH")        # len, type
+_NLMSGERR = struct.Struct("=i")
+_U32 = struct.Struct("=I")
+
+# сколько сообщений держим "в полёте" до чтения ACK-ов (сверху ограничено rcvbuf)
+DEFAULT_WINDOW = 1024
+# сколько байт отправляем одним send()
+DEFAULT_CHUNK = 64 * 1024
+SOCK_BUF = 4 * 1024 * 1024
+# во сколько rcvbuf обходится один ACK: skb целиком, а у ошибки ещё и
+# эхо запроса — считаем с запасом
+ACK_TRUESIZE = 1024
+# сколько раз досылать после ENOBUFS (потерянные ACK-и)
+ENOBUFS_RETRIES = 3
+
+
+class NetlinkUnavailable(OSError):
+    """Сокет NETLINK_ROUTE не создать/не привязать (нет AF_NETLINK или прав)."""
+
+
+def _open_socket(groups: int) -> socket.socket:
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    except OSError as e:
+        raise NetlinkUnavailable(e.errno, f"netlink socket: {e.strerror or e}") from e
+    # *BUFFORCE обходит net.core.[rw]mem_max (нужен CAP_NET_ADMIN)
+    for opt, force in (
+        (socket.SO_SNDBUF, getattr(socket, "SO_SNDBUFFORCE", 32)),
+        (socket.SO_RCVBUF, getattr(socket, "SO_RCVBUFFORCE", 33)),
+    ):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, force, SOCK_BUF)
+        except OSError:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, opt, SOCK_BUF)
+            except OSError:
+                pass
+    try:
+        sock.bind((0, groups))
+    except OSError as e:
+        sock.close()
+        raise NetlinkUnavailable(e.errno, f"netlink bind: {e.strerror or e}") from e
+    return sock
+
+
+def _align(n: int) -> int:
+    return (n + 3) & ~3
+
+
+def _rtattr(kind: int, payload: bytes) -> bytes:
+    ln = _RTATTR.size + len(payload)
+    return _RTATTR.pack(ln, kind) + payload + b"\0" * (_align(ln) - ln)
+
+
+def _addr_msg(
+    msg_type: int,
+    flags: int,
+    seq: int,
+    ifindex: int,
+    addr: bytes,
+    prefixlen: int = 128,
+    ifa_flags: int = 0,
+) -> bytes:
+    body = _IFADDRMSG.pack(socket.AF_INET6, prefixlen, ifa_flags & 0xFF, 0, ifindex)
+    body += _rtattr(IFA_LOCAL, addr) + _rtattr(IFA_ADDRESS, addr)
+    if ifa_flags:
+        body += _rtattr(IFA_FLAGS, _U32.pack(ifa_flags))
+    return _NLMSGHDR.pack(_NLMSGHDR.size + len(body), msg_type, flags, seq, 0) + body
+
+
+def _local_route_msg(msg_type: int, flags: int, seq: int, oif: int, net: ipa.IPv6Network) -> bytes:
+    # `ip -6 route replace local NET dev OIF table local proto 0x57`
+    body = _RTMSG.pack(
+        socket.AF_INET6, net.prefixlen, 0, 0, RT_TABLE_LOCAL, RTPROT_WEAVER, RT_SCOPE_HOST, RTN_LOCAL, 0,
+    )
+    body += _rtattr(RTA_DST, net.network_address.packed)
+    body += _rtattr(RTA_OIF, _U32.pack(oif))
+    body += _rtattr(RTA_TABLE, _U32.pack(RT_TABLE_LOCAL))
+    return _NLMSGHDR.pack(_NLMSGHDR.size + len(body), msg_type, flags, seq, 0) + body
+
+
+@dataclass(frozen=True)
+class Route:
+    dst: int           # 128-битное целое
+    dst_len: int
+    table: int
+    protocol: int
+    type: int
+    oif: int
+
+    @property
+    def network(self) -> ipa.IPv6Network:
+        return ipa.IPv6Network((self.dst, self.dst_len))
+
+
+@dataclass(frozen=True)
+class IfAddr:
+    index: int
+    addr: int          # 128-битное целое
+    prefixlen: int
+    scope: int
+    flags: int         # IFA_F_* (с учётом IFA_FLAGS)
+
+
+@dataclass
+class AddrBatchResult:
+    added: int = 0
+    deleted: int = 0
+    failed: Dict[str, str] = field(default_factory=dict)
+    elapsed: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed
+
+
+class RtNetlink:
+    """
+    Сокет NETLINK_ROUTE с пакетной отправкой RTM_NEWADDR/RTM_DELADDR.
+    Сообщения склеиваются в один send(), ACK-и вычитываются по мере прихода,
+    ошибки сопоставляются с адресом по seq.
+    """
+
+    def __init__(self, window: int = DEFAULT_WINDOW, chunk: int = DEFAULT_CHUNK) -> None:
+        self._sock = _open_socket(0)
+        # окно — сколько ACK-ов реально влезет в полученный rcvbuf
+        rcvbuf = self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        self._seq = int(time.time()) & 0x7FFFFFFF
+        self._window = max(1, min(window, rcvbuf // ACK_TRUESIZE))
+        self._chunk = max(4096, chunk)
+
+    def close(self) -> None:
+        self._sock.close()
+
+    def __enter__(self) -> "RtNetlink":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _next_seq(self) -> int:
+        self._seq = (self._seq + 1) & 0xFFFFFFFF
+        return self._seq
+
+    def _drain_acks(self, pending: Dict[int, Tuple[str, int]], res: AddrBatchResult, block: bool) -> None:
+        """
+        Читает всё, что уже пришло (или ждёт хотя бы одно сообщение, если block).
+        """
+        while pending:
+            if not block:
+                r, _, _ = select.select([self._sock], [], [], 0)
+                if not r:
+                    return
+            data = self._sock.recv(SOCK_BUF)
+            off = 0
+            while off + _NLMSGHDR.size <= len(data):
+                ln, mtype, _flags, seq, _pid = _NLMSGHDR.unpack_from(data, off)
+                if ln < _NLMSGHDR.size:
+                    break
+                if mtype == NLMSG_ERROR and seq in pending:
+                    (err,) = _NLMSGERR.unpack_from(data, off + _NLMSGHDR.size)
+                    addr, kind = pending.pop(seq)
+                    if err == 0:
+                        if kind in (RTM_NEWADDR, RTM_NEWROUTE):
+                            res.added += 1
+                        else:
+                            res.deleted += 1
+                    else:
+                        res.failed[addr] = os.strerror(-err)
+                off += _align(ln)
+            # после первого блокирующего чтения дочитываем без ожидания
+            block = False
+
+    def dump_ipv6_addrs(self, ifindex: int = 0) -> Iterator[IfAddr]:
+        """
+        Один RTM_GETADDR dump; адреса отдаются по мере разбора ответов,
+        без промежуточного списка. ifindex=0 — все интерфейсы.
+        """
+        body = _IFADDRMSG.pack(socket.AF_INET6, 0, 0, 0, 0)
+        for data, off, end in self._dump(RTM_GETADDR, body, RTM_NEWADDR):
+            a = _parse_ifaddr(data, off, end)
+            if a is not None and (not ifindex or a.index == ifindex):
+                yield a
+
+    def dump_ipv6_routes(self, table: Optional[int] = None) -> Iterator[Route]:
+        body = _RTMSG.pack(socket.AF_INET6, 0, 0, 0, 0, 0, 0, 0, 0)
+        for data, off, end in self._dump(RTM_GETROUTE, body, RTM_NEWROUTE):
+            r = _parse_route(data, off, end)
+            if r is not None and (table is None or r.table == table):
+                yield r
+
+    def _dump(self, req_type: int, body: bytes, resp_type: int) -> Iterator[Tuple[bytes, int, int]]:
+        """(буфер, начало тела, конец сообщения) для каждого ответа resp_type."""
+        seq = self._next_seq()
+        self._sock.sendall(
+            _NLMSGHDR.pack(_NLMSGHDR.size + len(body), req_type, NLM_F_REQUEST | NLM_F_DUMP, seq, 0) + body
+        )
+        while True:
+            data = self._sock.recv(SOCK_BUF)
+            off = 0
+            while off + _NLMSGHDR.size <= len(data):
+                ln, mtype, _flags, mseq, _pid = _NLMSGHDR.unpack_from(data, off)
+                if ln < _NLMSGHDR.size:
+                    return
+                if mseq != seq:
+                    off += _align(ln)
+                    continue
+                if mtype == NLMSG_DONE:
+                    return
+                if mtype == NLMSG_ERROR:
+                    (err,) = _NLMSGERR.unpack_from(data, off + _NLMSGHDR.size)
+                    if err:
+                        raise OSError(-err, os.strerror(-err))
+                    return
+                if mtype == resp_type:
+                    yield data, off + _NLMSGHDR.size, off + ln
+                off += _align(ln)
+
+    def batch_addrs(
+        self,
+        ifindex: int,
+        add: Iterable[str] = (),
+        delete: Iterable[str] = (),
+        nodad: bool = False,
+    ) -> AddrBatchResult:
+        """
+        add — через NLM_F_CREATE|NLM_F_REPLACE (семантика `ip addr replace`),
+        delete — RTM_DELADDR. Всё /128. nodad — добавить с IFA_F_NODAD:
+        адрес сразу пригоден, без tentative-фазы DAD.
+        """
+        t0 = time.monotonic()
+        res = AddrBatchResult()
+        todo: List[Tuple[int, str]] = [(RTM_DELADDR, a) for a in delete] + [(RTM_NEWADDR, a) for a in add]
+        for _ in range(ENOBUFS_RETRIES + 1):
+            pending: Dict[int, Tuple[str, int]] = {}
+            ops = iter(todo)
+            try:
+                self._send_addrs(ifindex, ops, nodad, pending, res)
+                todo = []
+                break
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+            self._window = max(1, self._window // 2)
+            # rcvbuf переполнился, часть ACK-ов потеряна. rtnetlink отвечает
+            # синхронно в send(), так что дошедшие уже в очереди: дочитываем,
+            # отправленное сверяем с дампом, недоделанное и неотправленное
+            # (хвост ops) досылаем
+            self._drain_acks(pending, res, block=False)
+            todo = self._unresolved(ifindex, pending, res) + list(ops)
+            if not todo:
+                break
+        for _mtype, a in todo:
+            res.failed[a] = os.strerror(errno.ENOBUFS)
+        res.elapsed = time.monotonic() - t0
+        return res
+
+    def _send_addrs(
+        self,
+        ifindex: int,
+        todo: Iterator[Tuple[int, str]],
+        nodad: bool,
+        pending: Dict[int, Tuple[str, int]],
+        res: AddrBatchResult,
+    ) -> None:
+        buf: List[bytes] = []
+        buf_len = 0
+
+        def flush() -> None:
+            nonlocal buf, buf_len
+            if buf:
+                self._sock.sendall(b"".join(buf))
+                buf, buf_len = [], 0
+
+        for mtype, a in todo:
+            if mtype == RTM_NEWADDR:
+                flags = NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE | NLM_F_REPLACE
+                ifa_flags = IFA_F_NODAD if nodad else 0
+            else:
+                flags, ifa_flags = NLM_F_REQUEST | NLM_F_ACK, 0
+            seq = self._next_seq()
+            msg = _addr_msg(mtype, flags, seq, ifindex, ipa.IPv6Address(a).packed, ifa_flags=ifa_flags)
+            pending[seq] = (a, mtype)
+            buf.append(msg)
+            buf_len += len(msg)
+            if buf_len >= self._chunk:
+                flush()
+                self._drain_acks(pending, res, block=False)
+            # не даём очереди ACK-ов переполнить rcvbuf
+            while len(pending) - len(buf) >= self._window:
+                flush()
+                self._drain_acks(pending, res, block=True)
+        flush()
+        while pending:
+            self._drain_acks(pending, res, block=True)
+
+    def _unresolved(
+        self, ifindex: int, pending: Dict[int, Tuple[str, int]], res: AddrBatchResult,
+    ) -> List[Tuple[int, str]]:
+        """Операции без ACK: уже применённые засчитываются по дампу, остальные — на повтор."""
+        if not pending:
+            return []
+        have = {a.addr for a in self.dump_ipv6_addrs(ifindex) if a.prefixlen == 128}
+        out: List[Tuple[int, str]] = []
+        for a, mtype in pending.values():
+            present = int(ipa.IPv6Address(a)) in have
+            if mtype == RTM_NEWADDR and present:
+                res.added += 1
+            elif mtype == RTM_DELADDR and not present:
+                res.deleted += 1
+            else:
+                out.append((mtype, a))
+        pending.clear()
+        return out
+
+    def batch_local_routes(
+        self,
+        oif: int,
+        add: Iterable[ipa.IPv6Network] = (),
+        delete: Iterable[ipa.IPv6Network] = (),
+    ) -> AddrBatchResult:
+        """
+        local-маршруты (AnyIP) на префиксы: маршрутов — по одному на
+        префикс, так что без окна и чанков, одним send().
+        """
+        t0 = time.monotonic()
+        res = AddrBatchResult()
+        pending: Dict[int, Tuple[str, int]] = {}
+        msgs: List[bytes] = []
+        for mtype, flags, nets in (
+            (RTM_DELROUTE, NLM_F_REQUEST | NLM_F_ACK, delete),
+            (RTM_NEWROUTE, NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE | NLM_F_REPLACE, add),
+        ):
+            for net in nets:
+                seq = self._next_seq()
+                pending[seq] = (str(net), mtype)
+                msgs.append(_local_route_msg(mtype, flags, seq, oif, net))
+        if msgs:
+            self._sock.sendall(b"".join(msgs))
+        while pending:
+            self._drain_acks(pending, res, block=True)
+        res.elapsed = time.monotonic() - t0
+        return res
+
+
+@dataclass
+class DadResult:
+    ready: int = 0
+    failed: List[str] = field(default_factory=list)     # DAD нашёл дубликат / адрес снят
+    pending: List[str] = field(default_factory=list)    # не дождались до таймаута
+    elapsed: float = 0.0
+
+    @property
+    def ok(self) -> bool:
+        return not (self.failed or self.pending)
+
+
+class AddrWatcher:
+    """
+    Подписка на RTNLGRP_IPV6_IFADDR. Создать ДО добавления адресов —
+    иначе события о конце DAD могут прийти раньше подписки:
+
+        with AddrWatcher() as w:
+            batch_ipv6_addrs(iface, add=addrs)
+            res = w.wait_usable(iface, addrs, timeout)
+    """
+
+    def __init__(self) -> None:
+        self._sock = _open_socket(RTMGRP_IPV6_IFADDR)
+        self._t0 = time.monotonic()
+
+    def close(self) -> None:
+        self._sock.close()
+
+    def __enter__(self) -> "AddrWatcher":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def wait_usable(self, iface: str, addrs: Iterable[str], timeout: float) -> DadResult:
+        """
+        Ждёт, пока у всех addrs снимется IFA_F_TENTATIVE. Начальное
+        состояние — dump после подписки: уже готовые (или интерфейс без
+        DAD) не ждём. elapsed — от создания watcher-а, т.е. от add.
+        """
+        idx = ifindex(iface)
+        waiting: Dict[int, str] = {int(ipa.IPv6Address(a)): a for a in addrs}
+        res = DadResult()
+
+        def seen(a: IfAddr, deleted: bool) -> None:
+            name = waiting.get(a.addr)
+            if name is None or a.index != idx:
+                return
+            if deleted or a.flags & IFA_F_DADFAILED:
+                res.failed.append(name)
+            elif a.flags & IFA_F_TENTATIVE:
+                return
+            else:
+                res.ready += 1
+            del waiting[a.addr]
+
+        def resync() -> None:
+            with RtNetlink() as nl:
+                for a in nl.dump_ipv6_addrs(idx):
+                    seen(a, False)
+
+        resync()
+        deadline = self._t0 + timeout
+        while waiting:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            r, _, _ = select.select([self._sock], [], [], left)
+            if not r:
+                break
+            try:
+                data = self._sock.recv(SOCK_BUF)
+            except OSError as e:
+                if e.errno != errno.ENOBUFS:
+                    raise
+                # rcvbuf переполнен (сотни тысяч событий) — часть потеряна,
+                # догоняем состояние дампом
+                resync()
+                continue
+            off = 0
+            while off + _NLMSGHDR.size <= len(data):
+                ln, mtype, _flags, _seq, _pid = _NLMSGHDR.unpack_from(data, off)
+                if ln < _NLMSGHDR.size:
+                    break
+                if mtype in (RTM_NEWADDR, RTM_DELADDR):
+                    a = _parse_ifaddr(data, off + _NLMSGHDR.size, off + ln)
+                    if a is not None:
+                        seen(a, mtype == RTM_DELADDR)
+                off += _align(ln)
+        res.pending = sorted(waiting.values())
+        res.elapsed = time.monotonic() - self._t0
+        return res
+
+
+def _parse_route(data: bytes, off: int, end: int) -> Optional[Route]:
+    family, dst_len, _src_len, _tos, table, proto, _scope, rtype, _flags = _RTMSG.unpack_from(data, off)
+    if family != socket.AF_INET6:
+        return None
+    dst = 0
+    oif = 0
+    off += _RTMSG.size
+    while off + _RTATTR.size <= end:
+        alen, kind = _RTATTR.unpack_from(data, off)
+        if alen < _RTATTR.size:
+            break
+        if kind == RTA_DST and alen - _RTATTR.size == 16:
+            dst = int.from_bytes(data[off + _RTATTR.size: off + alen], "big")
+        elif kind == RTA_OIF:
+            (oif,) = _U32.unpack_from(data, off + _RTATTR.size)
+        elif kind == RTA_TABLE:
+            (table,) = _U32.unpack_from(data, off + _RTATTR.size)
+        off += _align(alen)
+    return Route(dst=dst, dst_len=dst_len, table=table, protocol=proto, type=rtype, oif=oif)
+
+
+def _parse_ifaddr(data: bytes, off: int, end: int) -> Optional[IfAddr]:
+    family, plen, flags, scope, index = _IFADDRMSG.unpack_from(data, off)
+    if family != socket.AF_INET6:
+        return None
+    addr: Optional[bytes] = None
+    local: Optional[bytes] = None
+    off += _IFADDRMSG.size
+    while off + _RTATTR.size <= end:
+        alen, kind = _RTATTR.unpack_from(data, off)
+        if alen < _RTATTR.size:
+            break
+        if kind == IFA_ADDRESS:
+            addr = data[off + _RTATTR.size: off + alen]
+        elif kind == IFA_LOCAL:
+            local = data[off + _RTATTR.size: off + alen]
+        elif kind == IFA_FLAGS:
+            (flags,) = _U32.unpack_from(data, off + _RTATTR.size)
+        off += _align(alen)
+    raw = local or addr
+    if raw is None or len(raw) != 16:
+        return None
+    return IfAddr(index=index, addr=int.from_bytes(raw, "big"), prefixlen=plen, scope=scope, flags=flags)
+
+
+def ifindex(iface: str) -> int:
+    try:
+        return socket.if_nametoindex(iface)
+    except OSError as e:
+        raise OSError(errno.ENODEV, f"no such interface: {iface}") from e
+
+
+def batch_ipv6_addrs(
+    iface: str,
+    add: Iterable[str] = (),
+    delete: Iterable[str] = (),
+    window: Optional[int] = None,
+    nodad: bool = False,
+) -> AddrBatchResult:
+    idx = ifindex(iface)
+    with RtNetlink(window=window or DEFAULT_WINDOW) as nl:
+        return nl.batch_addrs(idx, add=add, delete=delete, nodad=nodad)
+
+
+def iter_ipv6_addrs(iface: str) -> Iterator[IfAddr]:
+    idx = ifindex(iface)
+    with RtNetlink() as nl:
+        yield from nl.dump_ipv6_addrs(idx)
+
+
+def weaver_local_routes() -> List[Route]:
+    """Наши local-маршруты (proto RTPROT_WEAVER) в таблице local."""
+    with RtNetlink() as nl:
+        return [
+            r for r in nl.dump_ipv6_routes(RT_TABLE_LOCAL)
+            if r.protocol == RTPROT_WEAVER and r.type == RTN_LOCAL
+        ]
+
+
+def batch_local_routes(
+    iface: str,
+    add: Iterable[ipa.IPv6Network] = (),
+    delete: Iterable[ipa.IPv6Network] = (),
+) -> AddrBatchResult:
+    idx = ifindex(iface)
+    with RtNetlink() as nl:
+        return nl.batch_local_routes(idx, add=add, delete=delete)
@@ -1,168 +1,401 @@
 from __future__ import annotations
 
+import ipaddress as ipa
+import json
 import subprocess as sp
 from collections import defaultdict
-from typing import Dict, Iterable, List, Set, Tuple
+from dataclasses import dataclass, field
+from typing import AbstractSet, Any, Dict, Iterable, List, Mapping, NamedTuple, Optional, Set, Tuple, Union
 
+from weaver_manager.ranges import Interval, collapse, prefix_bounds
 from weaver_manager.state_io import Assignment
 
+TABLE = "inet weaver"
+
+# SYN без ACK
+SYN_ONLY = "tcp flags & (syn | ack) == syn"
+
+# элемент сета/мапы: ([lo, hi], verdict); у обычного сета verdict == ""
+Element = Tuple[Interval, str]
+
 
 def run(cmd: List[str], check: bool = True) -> None:
     sp.run(cmd, check=check)
 
 
-def ensure_table_chains() -> None:
-    # inet weaver: chains in/out, policy accept
-    run(["nft", "add", "table", "inet", "weaver"], check=False)
-    run(
-        [
-            "nft",
-            "add",
-            "chain",
-            "inet",
-            "weaver",
-            "in",
-            "{",
-            "type",
-            "filter",
-            "hook",
-            "input",
-            "priority",
-            "0",
-            ";",
-            "policy",
-            "accept",
-            ";",
-            "}",
-        ]
-    , check=False)
-    run(
-        [
-            "nft",
-            "add",
-            "chain",
-            "inet",
-            "weaver",
-            "out",
-            "{",
-            "type",
-            "filter",
-            "hook",
-            "output",
-            "priority",
-            "0",
-            ";",
-            "policy",
-            "accept",
-            ";",
-            "}",
-        ]
-    , check=False)
-    # flush both
-    run(["nft", "flush", "chain", "inet", "weaver", "in"], check=True)
-    run(["nft", "flush", "chain", "inet", "weaver", "out"], check=True)
-
-
-def apply_nfqueue_rules(assignments: Iterable[Assignment]) -> None:
+def run_script(script: str, check: bool = True) -> None:
+    """
+    Весь скрипт — одна транзакция ядра: либо применяется целиком, либо никак.
+    """
+    sp.run(["nft", "-f", "-"], input=script, text=True, check=check)
+
+
+@dataclass
+class NftSet:
+    """
+    Интервальный сет или verdict-map: ключи — непересекающиеся [lo, hi];
+    порты рендерятся как `a-b`, адреса — как префикс, если серия выровнена,
+    иначе как `a-b`.
+    """
+    name: str
+    type: str
+    elements: Set[Element] = field(default_factory=set)
+    flags: Tuple[str, ...] = ("interval",)
+    map: str = ""              # "" — сет, "verdict" — vmap
+
+
+@dataclass
+class NftRule:
+    text: str
+    refs: Tuple[str, ...]      # на какие сеты/мапы ссылается (без '@')
+
+
+@dataclass
+class NftChain:
+    name: str
+    spec: str = ""             # "type filter hook ...;" — только у базовых цепочек
+    rules: List[NftRule] = field(default_factory=list)
+
+
+@dataclass
+class Ruleset:
+    table: str = TABLE
+    sets: Dict[str, NftSet] = field(default_factory=dict)
+    chains: Dict[str, NftChain] = field(default_factory=dict)
+
+    def signature(self) -> Tuple[Any, ...]:
+        """
+        Всё, кроме содержимого сетов: если совпадает с живой таблицей,
+        достаточно поменять элементы.
+        """
+        sets = tuple(sorted((s.name, s.type, s.map, s.flags) for s in self.sets.values()))
+        chains = tuple(sorted((c.name, tuple(r.refs for r in c.rules)) for c in self.chains.values()))
+        return sets, chains
+
+
+@dataclass
+class NftResult:
+    mode: str                  # full | incremental | noop
+    added: int = 0
+    removed: int = 0
+
+
+def _canon(set_type: str, value: Any) -> Interval:
+    """
+    Элемент из `nft -j` -> [lo, hi]. Одиночное значение, {"range": [a, b]}
+    и {"prefix": {"addr": ..., "len": ...}} сводятся к одному виду.
+    """
+    if isinstance(value, dict):
+        if "elem" in value:
+            return _canon(set_type, value["elem"]["val"])
+        if "range" in value:
+            lo, hi = value["range"]
+            return _canon(set_type, lo)[0], _canon(set_type, hi)[1]
+        if "prefix" in value:
+            net = _canon(set_type, value["prefix"]["addr"])[0]
+            return prefix_bounds(net, int(value["prefix"]["len"]))
+        raise ValueError(f"unsupported nft element: {value}")
+    v = int(ipa.IPv6Address(value)) if set_type == "ipv6_addr" else int(value)
+    return v, v
+
+
+def _canon_verdict(value: Any) -> str:
+    # {"goto": {"target": "weaver_q_10"}} -> "goto weaver_q_10"
+    if isinstance(value, dict) and len(value) == 1:
+        (kind, arg), = value.items()
+        if isinstance(arg, dict) and "target" in arg:
+            return f"{kind} {arg['target']}"
+        return str(kind)
+    return str(value)
+
+
+def _fmt(set_type: str, iv: Interval) -> str:
+    lo, hi = iv
+    if set_type == "ipv6_addr":
+        addr = str(ipa.IPv6Address(lo))
+        if lo == hi:
+            return addr
+        plen = 128 - (hi - lo + 1).bit_length() + 1
+        if prefix_bounds(lo, plen) == iv:
+            return f"{addr}/{plen}"
+        return f"{addr}-{ipa.IPv6Address(hi)}"
+    return str(lo) if lo == hi else f"{lo}-{hi}"
+
+
+def addr_intervals(addrs: Iterable[str]) -> List[Interval]:
+    """
+    Подряд идущие /128 (а _build_assignments выдаёт именно такие) схлопываются
+    в один интервал на серию: сет interval хранит `lo-hi` одним элементом,
+    дробить серию на выровненные префиксы незачем.
+    """
+    return collapse(int(ipa.IPv6Address(a)) for a in addrs)
+
+
+# =========================
+#   ДИСПЕТЧЕРИЗАЦИЯ ОЧЕРЕДЕЙ
+# =========================
+#
+# Вместо правила на каждую очередь — одно правило `... vmap @map`:
+# ключ (интервал портов/префикс) -> `goto weaver_q_N`, а в weaver_q_N лежит
+# единственное `queue num N bypass`. На пакет — один lookup в мапе
+# независимо от числа групп. Используется и менеджером, и portguard.
+
+NFLOG_SNAPLEN = 128
+
+
+class LogGroup(NamedTuple):
+    """Observe через NFLOG: вместо очереди — `log group N`, пакет не ждёт."""
+    group: int
+
+
+# очередь: номер или (first, last) для `queue num first-last fanout`,
+# либо LogGroup — та же диспетчеризация, но в цепочке log вместо queue
+QueueKey = Union[int, Tuple[int, int], LogGroup]
+
+
+def _qspec(q: QueueKey) -> Tuple[int, int]:
+    if isinstance(q, LogGroup):
+        return (q.group, q.group)
+    return (q, q) if isinstance(q, int) else (int(q[0]), int(q[1]))
+
+
+def queue_chain_name(q: QueueKey) -> str:
+    if isinstance(q, LogGroup):
+        return f"weaver_log_{q.group}"
+    first, last = _qspec(q)
+    return f"weaver_q_{first}" if first == last else f"weaver_q_{first}_{last}"
+
+
+def queue_chain(q: QueueKey) -> NftChain:
+    """
+    Одиночная очередь — `queue num N bypass`; диапазон — fanout: ядро
+    раскидывает потоки по очередям first..last (по CPU), т.е. по воркерам.
+    LogGroup — копия первых NFLOG_SNAPLEN байт в nflog и сразу accept.
+    """
+    if isinstance(q, LogGroup):
+        stmt = f"log group {q.group} snaplen {NFLOG_SNAPLEN} accept"
+        return NftChain(queue_chain_name(q), rules=[NftRule(stmt, ())])
+    first, last = _qspec(q)
+    if first == last:
+        stmt = f"queue num {first} bypass"
+    else:
+        stmt = f"queue num {first}-{last} fanout,bypass"
+    return NftChain(queue_chain_name(q), rules=[NftRule(stmt, ())])
+
+
+def dispatch_map(name: str, key_type: str, by_queue: Mapping[QueueKey, Iterable[Interval]]) -> NftSet:
+    """
+    verdict-map «интервал -> goto очередь». Ключи разных очередей
+    пересекаться не могут — это ошибка конфигурации.
+    """
+    elems: Set[Element] = set()
+    for q, ivs in by_queue.items():
+        verdict = f"goto {queue_chain_name(q)}"
+        elems.update((iv, verdict) for iv in ivs)
+    ordered = sorted(elems)
+    for (prev, pv), (cur, cv) in zip(ordered, ordered[1:]):
+        if cur[0] <= prev[1]:
+            raise ValueError(
+                f"{name}: {_fmt(key_type, prev)} ({pv}) overlaps {_fmt(key_type, cur)} ({cv})"
+            )
+    return NftSet(name, key_type, elems, map="verdict")
+
+
+def port_dispatch(
+    rs: Ruleset,
+    chain: str,
+    ranges_by_queue: Mapping[QueueKey, Iterable[Interval]],
+    match: str = SYN_ONLY,
+    name: str = "weaver_in_dispatch",
+) -> None:
+    """
+    Добавляет в rs цепочки очередей, мапу name и правило
+    `<match> tcp dport vmap @name` в chain.
+    """
+    for q in sorted(ranges_by_queue, key=_qspec):
+        rs.chains.setdefault(queue_chain_name(q), queue_chain(q))
+    rs.sets[name] = dispatch_map(name, "inet_service", ranges_by_queue)
+    rs.chains[chain].rules.append(NftRule(f"{match} tcp dport vmap @{name}", (name,)))
+
+
+def build_ruleset(assignments: Iterable[Assignment], nflog: AbstractSet[int] = frozenset()) -> Ruleset:
     """
     Inbound: по портам групп -> очередь.
     Outbound: по ip6 saddr (назначенным /128) -> очередь.
+    nflog — номера, которые у групп означают NFLOG log group, а не очередь.
     """
-    ensure_table_chains()
-
-    # inbound: queue per nfqueue_num -> set of ports
-    ports_by_q: Dict[int, Set[int]] = defaultdict(set)
+    # inbound: queue (или fanout-диапазон) -> set of ports
+    ports_by_q: Dict[QueueKey, Set[int]] = defaultdict(set)
     # outbound: queue -> set of ipv6 saddr
-    saddrs_by_q: Dict[int, Set[str]] = defaultdict(set)
+    saddrs_by_q: Dict[QueueKey, Set[str]] = defaultdict(set)
 
     for a in assignments:
         if a.nfqueue_num is None:
             continue
-        q = int(a.nfqueue_num)
+        first = int(a.nfqueue_num)
+        last = a.nfqueue_last
+        q: QueueKey
+        if first in nflog:
+            q = LogGroup(first)
+        else:
+            q = (first, first if last is None else int(last))
         ports_by_q[q].add(a.port)
         # только IPv6 исходники (egress bind) — используем для out
         saddrs_by_q[q].add(a.ipv6)
 
-    # создать наборы портов и правил inbound
-    for q, ports in ports_by_q.items():
-        set_name = f"weaver_in_ports_{q}"
-        # удалим, если был (чтобы тип/содержимое не конфликтовало)
-        run(["nft", "delete", "set", "inet", "weaver", set_name], check=False)
-        run(["nft", "add", "set", "inet", "weaver", set_name, "{", "type", "inet_service", ";", "}"])
-        # добавляем порты батчем
-        elems = ",".join(str(p) for p in sorted(ports))
-        if elems:
-            run(["nft", "add", "element", "inet", "weaver", set_name, "{", elems, "}"])
-        # правило на SYN без ACK в очередь q
-        run(
-            [
-                "nft",
-                "add",
-                "rule",
-                "inet",
-                "weaver",
-                "in",
-                "tcp",
-                "flags",
-                "&",
-                "syn",
-                "==",
-                "syn",
-                "and",
-                "tcp",
-                "flags",
-                "&",
-                "ack",
-                "==",
-                "0",
-                "and",
-                "tcp",
-                "dport",
-                "@"+set_name,
-                "queue",
-                "num",
-                str(q),
-                "bypass",
-            ]
-        )
-
-    # outbound: наборы ip6 saddr по очередям
-    for q, saddrs in saddrs_by_q.items():
-        set_name = f"weaver_out_s6_{q}"
-        run(["nft", "delete", "set", "inet", "weaver", set_name], check=False)
-        run(["nft", "add", "set", "inet", "weaver", set_name, "{", "type", "ipv6_addr", ";", "}"])
-        elems = ",".join(saddrs)
-        if elems:
-            run(["nft", "add", "element", "inet", "weaver", set_name, "{", elems, "}"])
-        run(
-            [
-                "nft",
-                "add",
-                "rule",
-                "inet",
-                "weaver",
-                "out",
-                "ip6",
-                "saddr",
-                "@"+set_name,
-                "and",
-                "tcp",
-                "flags",
-                "&",
-                "syn",
-                "==",
-                "syn",
-                "and",
-                "tcp",
-                "flags",
-                "&",
-                "ack",
-                "==",
-                "0",
-                "queue",
-                "num",
-                str(q),
-                "bypass",
-            ]
-        )
+    rs = Ruleset()
+    rs.chains["in"] = NftChain("in", "type filter hook input priority 0; policy accept;")
+    rs.chains["out"] = NftChain("out", "type filter hook output priority 0; policy accept;")
+    if ports_by_q:
+        port_dispatch(rs, "in", {q: collapse(p) for q, p in ports_by_q.items()})
+    if saddrs_by_q:
+        name = "weaver_out_dispatch"
+        for q in sorted(saddrs_by_q, key=_qspec):
+            rs.chains.setdefault(queue_chain_name(q), queue_chain(q))
+        rs.sets[name] = dispatch_map(name, "ipv6_addr", {q: addr_intervals(s) for q, s in saddrs_by_q.items()})
+        rs.chains["out"].rules.append(NftRule(f"{SYN_ONLY} ip6 saddr vmap @{name}", (name,)))
+    return rs
+
+
+def _elements(s: NftSet, items: Optional[Iterable[Element]] = None, keys_only: bool = False) -> str:
+    out: List[str] = []
+    for iv, verdict in sorted(s.elements if items is None else items):
+        key = _fmt(s.type, iv)
+        out.append(key if keys_only or not verdict else f"{key} : {verdict}")
+    return ", ".join(out)
+
+
+def render_ruleset(rs: Ruleset) -> str:
+    """
+    Таблица пересоздаётся внутри того же скрипта (add + delete + define),
+    так что пакеты видят либо старый набор правил, либо новый целиком.
+    """
+    lines: List[str] = [
+        # add + delete: delete не падает, если таблицы ещё не было
+        f"table {rs.table} {{}}",
+        f"delete table {rs.table}",
+        f"table {rs.table} {{",
+    ]
+    # цепочки-цели объявляем до мап, мапы — до правил, которые на них ссылаются
+    regular = [c for c in rs.chains.values() if not c.spec]
+    base = [c for c in rs.chains.values() if c.spec]
+    for c in regular:
+        lines.append(f"  chain {c.name} {{")
+        lines.extend(f"    {r.text}" for r in c.rules)
+        lines.append("  }")
+    for s in rs.sets.values():
+        kind = "map" if s.map else "set"
+        stype = f"{s.type} : {s.map}" if s.map else s.type
+        elems = _elements(s)
+        elems = f" elements = {{ {elems} }};" if elems else ""
+        flags = f" flags {', '.join(s.flags)};" if s.flags else ""
+        lines.append(f"  {kind} {s.name} {{ type {stype};{flags}{elems} }}")
+    for c in base:
+        lines.append(f"  chain {c.name} {{")
+        lines.append(f"    {c.spec}")
+        lines.extend(f"    {r.text}" for r in c.rules)
+        lines.append("  }")
+    lines.append("}")
+    return "\n".join(lines) + "\n"
+
+
+def _set_refs(node: Any, out: List[str]) -> None:
+    if isinstance(node, str):
+        if node.startswith("@"):
+            out.append(node[1:])
+    elif isinstance(node, dict):
+        for v in node.values():
+            _set_refs(v, out)
+    elif isinstance(node, list):
+        for v in node:
+            _set_refs(v, out)
+
+
+def parse_live(doc: Dict[str, Any], table: str = TABLE) -> Ruleset:
+    """
+    Разбор `nft -j list table ...` в ту же модель, что и build_ruleset.
+    Текст правил не восстанавливаем — для сравнения хватает ссылок на сеты.
+    """
+    rs = Ruleset(table=table)
+    for item in doc.get("nftables", []):
+        if "set" in item or "map" in item:
+            s = item.get("set") or item["map"]
+            st = s.get("type", "")
+            mt = s.get("map", "")
+            elems: Set[Element] = set()
+            for e in s.get("elem", []):
+                if mt and isinstance(e, list):
+                    elems.add((_canon(st, e[0]), _canon_verdict(e[1])))
+                else:
+                    elems.add((_canon(st, e), ""))
+            flags = s.get("flags", [])
+            flags = (flags,) if isinstance(flags, str) else tuple(sorted(flags))
+            rs.sets[s["name"]] = NftSet(s["name"], st, elems, flags, map=mt)
+        elif "chain" in item:
+            name = item["chain"]["name"]
+            rs.chains.setdefault(name, NftChain(name))
+        elif "rule" in item:
+            r = item["rule"]
+            refs: List[str] = []
+            _set_refs(r.get("expr", []), refs)
+            rs.chains.setdefault(r["chain"], NftChain(r["chain"])).rules.append(NftRule("", tuple(refs)))
+    return rs
+
+
+def read_live(table: str = TABLE) -> Optional[Ruleset]:
+    p = sp.run(
+        ["nft", "-j", "list", "table", *table.split()],
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if p.returncode != 0 or not p.stdout.strip():
+        return None
+    try:
+        return parse_live(json.loads(p.stdout), table)
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def render_diff(want: Ruleset, live: Ruleset) -> Tuple[str, int, int]:
+    """
+    Скрипт из одних `delete element` / `add element`. Удаления идут первыми,
+    всё — одной транзакцией.
+    """
+    dels: List[str] = []
+    adds: List[str] = []
+    added = removed = 0
+    for name, s in want.sets.items():
+        have = live.sets[name].elements
+        gone = have - s.elements
+        new = s.elements - have
+        if gone:
+            # у мап удаляем по ключу
+            dels.append(f"delete element {want.table} {name} {{ {_elements(s, gone, keys_only=True)} }}")
+            removed += len(gone)
+        if new:
+            adds.append(f"add element {want.table} {name} {{ {_elements(s, new)} }}")
+            added += len(new)
+    script = "\n".join(dels + adds)
+    return (script + "\n" if script else ""), added, removed
+
+
+def apply_ruleset(want: Ruleset) -> NftResult:
+    live = read_live(want.table)
+    if live is not None and live.signature() == want.signature():
+        script, added, removed = render_diff(want, live)
+        if not script:
+            return NftResult("noop")
+        run_script(script)
+        return NftResult("incremental", added=added, removed=removed)
+
+    run_script(render_ruleset(want))
+    return NftResult("full", added=sum(len(s.elements) for s in want.sets.values()))
+
+
+def apply_nfqueue_rules(assignments: Iterable[Assignment]) -> NftResult:
+    return apply_ruleset(build_ruleset(assignments))
+
 
+def delete_table(table: str = TABLE) -> None:
+    run_script(f"table {table} {{}}\ndelete table {table}\n")
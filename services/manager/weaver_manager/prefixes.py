@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import ipaddress as ipa
+from typing import Dict, Generic, Iterable, List, Optional, Tuple, TypeVar, Union
+
+T = TypeVar("T")
+
+_Net = Union[str, ipa.IPv6Network]
+
+
+class PrefixIndex(Generic[T]):
+    """
+    Скомпилированный индекс IPv6-префиксов для longest-prefix-match.
+
+    Префиксы раскладываются по длинам: для каждой длины L — dict
+    {старшие L бит: значение}. Поиск идёт от самой длинной длины к самой
+    короткой и стоит O(число различных длин) ≤ O(длина префикса); на
+    практике пулы — это /64 и /48, т.е. 1–2 dict-lookup на адрес вместо
+    `any(a in n for n in nets)` по всем группам.
+    """
+
+    __slots__ = ("_by_len", "_lens")
+
+    def __init__(self, items: Iterable[Tuple[_Net, T]] = ()) -> None:
+        self._by_len: Dict[int, Dict[int, T]] = {}
+        self._lens: Tuple[Tuple[int, Dict[int, T]], ...] = ()
+        for net, value in items:
+            self.add(net, value)
+
+    def add(self, net: _Net, value: T) -> None:
+        n = net if isinstance(net, ipa.IPv6Network) else ipa.IPv6Network(net, strict=False)
+        shift = 128 - n.prefixlen
+        # первый добавленный выигрывает — как в `any(...)` по порядку групп
+        self._by_len.setdefault(n.prefixlen, {}).setdefault(int(n.network_address) >> shift, value)
+        self._lens = tuple(
+            (128 - plen, self._by_len[plen]) for plen in sorted(self._by_len, reverse=True)
+        )
+
+    def lookup(self, addr: Union[int, str, ipa.IPv6Address]) -> Optional[T]:
+        a = addr if isinstance(addr, int) else int(ipa.IPv6Address(addr))
+        for shift, table in self._lens:
+            v = table.get(a >> shift)
+            if v is not None:
+                return v
+        return None
+
+    def __contains__(self, addr: Union[int, str, ipa.IPv6Address]) -> bool:
+        return self.lookup(addr) is not None
+
+    def __len__(self) -> int:
+        return sum(len(t) for t in self._by_len.values())
+
+    @classmethod
+    def from_networks(cls, nets: Iterable[_Net]) -> "PrefixIndex[ipa.IPv6Network]":
+        idx: PrefixIndex[ipa.IPv6Network] = PrefixIndex()
+        for n in nets:
+            net = n if isinstance(n, ipa.IPv6Network) else ipa.IPv6Network(n, strict=False)
+            idx.add(net, net)
+        return idx
+
+    def prefixes(self) -> List[Tuple[int, int, T]]:
+        """(network_int, prefixlen, value) — для отладки/вывода."""
+        out: List[Tuple[int, int, T]] = []
+        for plen, table in self._by_len.items():
+            for key, v in table.items():
+                out.append((key << (128 - plen), plen, v))
+        return sorted(out, key=lambda x: (x[0], x[1]))
@@ -1,39 +1,423 @@
 from __future__ import annotations
 
-from typing import Iterable, Literal, Tuple
+import hashlib
+import io
+import ipaddress
+import json
+import os
+import re
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import IO, Dict, Iterable, Iterator, List, Literal, Optional, Sequence, Tuple
+
+from weaver_manager.state_io import Assignment
 
 # binding: (port, ipv6, type, stack)
 Binding = Tuple[int, str, Literal["http", "socks5"], Literal["ipv4", "ipv6"]]
 
+# Рендер 3proxy.cfg потоком: строки идут сразу во временный файл рядом
+# с целевым (буфер на FLUSH_LINES строк), по ходу считается хэш. Файл
+# заменяется rename-ом только если хэш отличается от лежащего на диске —
+# иначе tmp удаляется и 3proxy не трогаем. При шардировании листенеры
+# каждой группы живут в своём файле, основной подключает их через
+# `$/path` (include в 3proxy) и ставит на каждый monitor: правка одной
+# группы переписывает только её шард.
+# Несколько экземпляров (instances > 1): листенеры режутся на срезы по
+# блокам портов, у экземпляра i свой <stem>-i.cfg, monitor, pidfile и лог
+# в RUN_DIR; состав экземпляров — в манифесте <stem>.instances (JSON),
+# по нему их запускает супервизор proxy-контейнера.
+
+RUN_DIR = "/run/3proxy"
+VERSION_FILE = f"{RUN_DIR}/3proxy.ver"
+FLUSH_LINES = 4096
+
+SHARD_MODES = ("none", "group")
+
+# порты срезаются блоками: группа растёт подряд идущими портами и
+# задевает один-два экземпляра, а не все сразу
+SLICE_PORTS = 64
+
+
+@dataclass(frozen=True)
+class Resolver:
+    """
+    DNS для 3proxy: nserver — "ip", "ip:port" или "[v6]:port", можно с
+    "/tcp"; cache/cache6 — размеры nscache/nscache6 (0 — строки нет).
+    С локальным резолвером (dnscache) servers — его адрес: upstream-запросы
+    и кэш общие для всех экземпляров 3proxy.
+    """
+
+    servers: Tuple[str, ...] = ("1.1.1.1", "2606:4700:4700::1111")
+    cache: int = 65536
+    cache6: int = 0
+    ipv6_first: bool = False           # -64: резолвить сначала в AAAA
+
+
+DEFAULT_RESOLVER = Resolver()
+
+
+def parse_nserver(s: str) -> Tuple[str, int, bool]:
+    """'ip[:port][/tcp]' или '[v6]:port' -> (ip, port, tcp); ValueError если не адрес."""
+    addr, _, proto = s.strip().partition("/")
+    if proto not in ("", "tcp", "udp"):
+        raise ValueError(f"nserver {s!r}: unknown protocol {proto!r}")
+    port = 53
+    if addr.startswith("["):
+        host, _, rest = addr[1:].partition("]")
+        if rest:
+            port = int(rest.lstrip(":"))
+    elif addr.count(":") == 1:
+        host, _, p = addr.partition(":")
+        port = int(p)
+    else:
+        host = addr
+    ipaddress.ip_address(host)
+    if not 0 < port < 65536:
+        raise ValueError(f"nserver {s!r}: bad port")
+    return host, port, proto == "tcp"
+
+
+def header_lines(
+    monitors: Sequence[str] = (VERSION_FILE,),
+    name: str = "3proxy",
+    resolver: Resolver = DEFAULT_RESOLVER,
+) -> Iterator[str]:
+    yield "# auto-generated by weaver_manager"
+    # НИКАКОГО 'daemon' — контейнер должен держать PID 1 занятым
+    yield f"pidfile {RUN_DIR}/{name}.pid"
+    for ns in resolver.servers:
+        yield f"nserver {ns}"
+    if resolver.cache:
+        yield f"nscache {resolver.cache}"
+    if resolver.cache6:
+        yield f"nscache6 {resolver.cache6}"
+    yield ""
+    yield "setgid 1337"
+    yield "setuid 1337"
+    for m in monitors:
+        yield f'monitor "{m}"'
+    yield f"log {RUN_DIR}/{name}.log D"
+    yield "rotate 10"
+    yield "flush"
+    yield ""
+    yield "auth none"
+    yield "allow *"
+    yield ""
+
+
+def listener_line(a: Assignment, inbound_ipv4: str, bind_egress: bool, ipv6_first: bool = False) -> str:
+    cmd = "proxy" if a.proxy_type.lower() == "http" else "socks"
+    if a.listen_stack == "ipv6":
+        parts = [cmd, "-6", f"-p{a.port}", "-i::", "-n", "-a"]
+    else:
+        parts = [cmd, f"-p{a.port}", f"-i{inbound_ipv4}", "-n", "-a"]
+        if ipv6_first:
+            parts.insert(1, "-64")
+    if bind_egress and a.ipv6:
+        # ВАЖНО: без пробела и без скобок
+        parts.append(f"-e{a.ipv6}")
+    return " ".join(parts)
+
+
+# =========================
+#     ATOMIC STREAMING
+# =========================
+
+def _file_digest(path: Path) -> Optional[bytes]:
+    h = hashlib.blake2b(digest_size=16)
+    try:
+        with path.open("rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    except FileNotFoundError:
+        return None
+    return h.digest()
+
+
+class AtomicWriter:
+    """
+    with AtomicWriter(path) as w:
+        w.lines(...)
+    w.changed — заменён ли файл. Исключение внутри with — tmp удаляется,
+    старый файл остаётся как был.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.changed = False
+        self.digest = b""
+        self._h = hashlib.blake2b(digest_size=16)
+        self._buf: List[str] = []
+        self._f: Optional[IO[bytes]] = None
+
+    def __enter__(self) -> "AtomicWriter":
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._f = tempfile.NamedTemporaryFile("wb", delete=False, dir=self.path.parent, prefix=f".{self.path.name}.")
+        # mkstemp создаёт 0600; 3proxy перечитывает конфиг уже после setuid
+        os.fchmod(self._f.fileno(), 0o644)
+        return self
+
+    def line(self, s: str) -> None:
+        self._buf.append(s)
+        if len(self._buf) >= FLUSH_LINES:
+            self._flush()
+
+    def lines(self, it: Iterable[str]) -> None:
+        for s in it:
+            self.line(s)
+
+    def _flush(self) -> None:
+        if not self._buf:
+            return
+        data = ("\n".join(self._buf) + "\n").encode("utf-8")
+        self._buf.clear()
+        self._h.update(data)
+        assert self._f is not None
+        self._f.write(data)
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        f = self._f
+        assert f is not None
+        try:
+            if exc_type is None:
+                self._flush()
+                f.flush()
+                self.digest = self._h.digest()
+                self.changed = _file_digest(self.path) != self.digest
+                if self.changed:
+                    os.fsync(f.fileno())
+        finally:
+            f.close()
+            self._f = None
+        if exc_type is not None or not self.changed:
+            os.unlink(f.name)
+            return
+        os.replace(f.name, self.path)
+        dfd = os.open(self.path.parent, os.O_RDONLY)
+        try:
+            os.fsync(dfd)
+        finally:
+            os.close(dfd)
+
+
+# =========================
+#        3PROXY CFG
+# =========================
+
+@dataclass
+class RenderResult:
+    main_changed: bool = False
+    main_removed: bool = False           # основной файл от прошлого режима (перешли на instances)
+    shards_changed: List[str] = field(default_factory=list)
+    shards_removed: List[str] = field(default_factory=list)
+    instances_changed: List[int] = field(default_factory=list)
+    instances_removed: List[int] = field(default_factory=list)
+    digest: str = ""                     # общий отпечаток всех файлов
+
+    @property
+    def changed(self) -> bool:
+        return self.main_changed or self.main_removed or bool(
+            self.shards_changed or self.shards_removed or self.instances_changed or self.instances_removed
+        )
+
+
+def shard_name(group: str) -> str:
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", group) or "_"
+
+
+def shard_dir(cfg_path: Path) -> Path:
+    return cfg_path.parent / f"{cfg_path.stem}.d"
+
+
+@dataclass(frozen=True)
+class Instance:
+    id: int
+    config: str
+    monitor: str
+    pidfile: str
+    log: str
+
+
+def instance_of(port: int, instances: int) -> int:
+    return (port // SLICE_PORTS) % instances
+
+
+def instance_paths(cfg_path: Path, i: int) -> Instance:
+    name = f"3proxy-{i}"
+    return Instance(
+        id=i,
+        config=str(cfg_path.parent / f"{cfg_path.stem}-{i}.cfg"),
+        monitor=f"{RUN_DIR}/{name}.ver",
+        pidfile=f"{RUN_DIR}/{name}.pid",
+        log=f"{RUN_DIR}/{name}.log",
+    )
+
+
+def manifest_path(cfg_path: Path) -> Path:
+    return cfg_path.parent / f"{cfg_path.stem}.instances"
+
+
+def read_manifest(path: Path) -> List[Dict[str, object]]:
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return []
+    return list(data.get("instances") or [])
+
+
+def write_3proxy_cfg(
+    cfg_path: Path,
+    assigns: Sequence[Assignment],
+    inbound_ipv4: str,
+    bind_egress: bool,
+    shard_by: str = "none",
+    instances: int = 1,
+    resolver: Resolver = DEFAULT_RESOLVER,
+) -> RenderResult:
+    """
+    shard_by="none" — один файл; "group" — <stem>.d/<группа>.cfg на
+    группу, подключённые из основного. Шарды удалённых групп стираются
+    после того, как основной файл перестал на них ссылаться.
+    instances > 1 — самостоятельные файлы экземпляров и манифест,
+    основной файл не пишется.
+    Файлы другого режима (основной, шарды, экземпляры, манифест) стираются
+    после публикации файлов текущего: ни супервизор, ни одиночный 3proxy
+    не подхватят устаревшие листенеры.
+    """
+    if shard_by not in SHARD_MODES:
+        raise ValueError(f"unknown shard mode {shard_by!r}, expected one of {SHARD_MODES}")
+    if instances < 1:
+        raise ValueError("instances must be >= 1")
+    if instances > 1:
+        if shard_by != "none":
+            raise ValueError("per-group shards and several 3proxy instances are mutually exclusive")
+        return _write_instances(cfg_path, assigns, inbound_ipv4, bind_egress, instances, resolver)
+    res = RenderResult()
+    h = hashlib.blake2b(digest_size=16)
+
+    if shard_by == "none":
+        with AtomicWriter(cfg_path) as w:
+            w.lines(header_lines(resolver=resolver))
+            w.lines(listener_line(a, inbound_ipv4, bind_egress, resolver.ipv6_first) for a in assigns)
+        res.main_changed = w.changed
+        res.digest = w.digest.hex()
+        _remove_shards(shard_dir(cfg_path), set(), res)
+        _remove_instances(cfg_path, 0, res)
+        return res
+
+    by_group: Dict[str, List[Assignment]] = {}
+    for a in assigns:
+        by_group.setdefault(a.group, []).append(a)
+    sdir = shard_dir(cfg_path)
+    paths: Dict[str, Path] = {}
+    for group, rows in by_group.items():
+        p = paths[group] = sdir / f"{shard_name(group)}.cfg"
+        with AtomicWriter(p) as w:
+            w.line(f"# group {group}: {len(rows)} listeners")
+            w.lines(listener_line(a, inbound_ipv4, bind_egress, resolver.ipv6_first) for a in rows)
+        if w.changed:
+            res.shards_changed.append(group)
+        h.update(w.digest)
+
+    with AtomicWriter(cfg_path) as w:
+        w.lines(header_lines((VERSION_FILE, *(str(p) for p in paths.values())), resolver=resolver))
+        for p in paths.values():
+            w.line(f"${p}")
+    res.main_changed = w.changed
+    h.update(w.digest)
+    res.digest = h.hexdigest()
+    _remove_shards(sdir, {p.name for p in paths.values()}, res)
+    _remove_instances(cfg_path, 0, res)
+    return res
+
+
+def _write_instances(
+    cfg_path: Path,
+    assigns: Sequence[Assignment],
+    inbound_ipv4: str,
+    bind_egress: bool,
+    instances: int,
+    resolver: Resolver,
+) -> RenderResult:
+    """
+    Срез экземпляра зависит только от порта, так что правка группы
+    переписывает файлы лишь тех экземпляров, чьи порты она задела.
+    Манифест пишется после файлов экземпляров, лишние файлы стираются
+    после манифеста: супервизор не увидит экземпляр без конфига.
+    """
+    res = RenderResult()
+    h = hashlib.blake2b(digest_size=16)
+    slices: List[List[Assignment]] = [[] for _ in range(instances)]
+    for a in assigns:
+        slices[instance_of(a.port, instances)].append(a)
+
+    entries: List[Dict[str, object]] = []
+    for i, rows in enumerate(slices):
+        inst = instance_paths(cfg_path, i)
+        with AtomicWriter(Path(inst.config)) as w:
+            w.lines(header_lines((inst.monitor,), name=f"3proxy-{i}", resolver=resolver))
+            w.line(f"# instance {i}/{instances}: {len(rows)} listeners")
+            w.lines(listener_line(a, inbound_ipv4, bind_egress, resolver.ipv6_first) for a in rows)
+        if w.changed:
+            res.instances_changed.append(i)
+        h.update(w.digest)
+        entries.append({**inst.__dict__, "listeners": len(rows)})
+
+    with AtomicWriter(manifest_path(cfg_path)) as w:
+        w.line(json.dumps({"instances": entries}, indent=1))
+    res.main_changed = w.changed
+    h.update(w.digest)
+    res.digest = h.hexdigest()
+
+    _remove_instances(cfg_path, instances, res)
+    # прошлый режим — один файл или шарды
+    _remove_shards(shard_dir(cfg_path), set(), res)
+    if cfg_path.exists():
+        cfg_path.unlink()
+        res.main_removed = True
+    return res
+
+
+def _remove_instances(cfg_path: Path, keep: int, res: RenderResult) -> None:
+    """
+    Файлы экземпляров с номером >= keep; keep=0 — ещё и манифест, первым:
+    супервизор гасит экземпляры раньше, чем пропадут их конфиги.
+    """
+    if not keep:
+        manifest_path(cfg_path).unlink(missing_ok=True)
+    for p in cfg_path.parent.glob(f"{cfg_path.stem}-*.cfg"):
+        tail = p.stem[len(cfg_path.stem) + 1:]
+        if tail.isdigit() and int(tail) >= keep:
+            p.unlink()
+            res.instances_removed.append(int(tail))
+    res.instances_removed.sort()
+
+
+def _remove_shards(sdir: Path, keep: set, res: RenderResult) -> None:
+    if not sdir.is_dir():
+        return
+    for p in sdir.glob("*.cfg"):
+        if p.name not in keep:
+            p.unlink()
+            res.shards_removed.append(p.stem)
+    if not keep:
+        try:
+            sdir.rmdir()
+        except OSError:
+            pass                         # чужие файлы в каталоге не трогаем
+
 
 def render_3proxy_cfg(
     inbound_ipv4: str,
     bindings: Iterable[Binding],
     bind_egress: bool,
+    resolver: Resolver = DEFAULT_RESOLVER,
 ) -> str:
-    lines: list[str] = []
-    lines.append("# auto-generated by weaver_manager")
-    # НИКАКОГО 'daemon' — контейнер должен держать PID 1 занятым
-    lines.append("pidfile /run/3proxy/3proxy.pid")
-    lines.append("nserver 1.1.1.1")
-    lines.append("nserver 2606:4700:4700::1111")
-    lines.append("nscache 65536")
-    lines.append("")
-    lines.append("setgid 1337")
-    lines.append("setuid 1337")
-    lines.append('monitor "/run/3proxy/3proxy.ver"')
-    lines.append("log /run/3proxy/3proxy.log D")
-    lines.append("rotate 10")
-    lines.append("flush")
-    lines.append("")
-
+    buf = io.StringIO()
+    for s in header_lines(resolver=resolver):
+        buf.write(s + "\n")
     for port, ip, ptype, stack in bindings:
-        cmd = "proxy" if ptype == "http" else "socks"
-        listen = f"-6 -p{port} -i:: -a" if stack == "ipv6" else f"-p{port} -i{inbound_ipv4} -a"
-        if bind_egress and ip:
-            listen = f"{listen} -e{ip}"
-        lines.append(f"{cmd} {listen}")
-
-    lines.append("")
-    return "\n".join(lines)
-
+        a = Assignment(group="", port=port, ipv6=ip, proxy_type=ptype, listen_stack=stack, nfqueue_num=None)
+        buf.write(listener_line(a, inbound_ipv4, bind_egress, resolver.ipv6_first) + "\n")
+    return buf.getvalue()
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+from typing import Iterable, Iterator, List, Tuple
+
+# Интервалы — замкнутые [lo, hi] на целых (порты, IPv6 как 128-битные int).
+Interval = Tuple[int, int]
+
+
+def collapse(values: Iterable[int]) -> List[Interval]:
+    """
+    Схлопывает целые в отсортированный список непересекающихся интервалов:
+    [1, 2, 3, 7, 9, 10] -> [(1, 3), (7, 7), (9, 10)].
+    """
+    out: List[Interval] = []
+    for v in sorted(set(values)):
+        if out and v == out[-1][1] + 1:
+            out[-1] = (out[-1][0], v)
+        else:
+            out.append((v, v))
+    return out
+
+
+def merge(intervals: Iterable[Interval]) -> List[Interval]:
+    """Объединяет пересекающиеся и смежные интервалы."""
+    out: List[Interval] = []
+    for lo, hi in sorted(intervals):
+        if out and lo <= out[-1][1] + 1:
+            if hi > out[-1][1]:
+                out[-1] = (out[-1][0], hi)
+        else:
+            out.append((lo, hi))
+    return out
+
+
+def to_prefixes(lo: int, hi: int, bits: int = 128) -> Iterator[Tuple[int, int]]:
+    """
+    Минимальное покрытие [lo, hi] выровненными префиксами: (network, prefixlen).
+    Для ::2..::101 это ::2/127, ::4/126, ... — O(bits) префиксов на интервал.
+    """
+    while lo <= hi:
+        # самый большой блок, выровненный по lo и не вылезающий за hi
+        size = (lo & -lo) if lo else 1 << bits
+        while size > hi - lo + 1:
+            size >>= 1
+        yield lo, bits - size.bit_length() + 1
+        lo += size
+
+
+def prefix_bounds(network: int, prefixlen: int, bits: int = 128) -> Interval:
+    span = 1 << (bits - prefixlen)
+    lo = network & ~(span - 1)
+    return lo, lo + span - 1
+
+
+def total(intervals: Iterable[Interval]) -> int:
+    return sum(hi - lo + 1 for lo, hi in intervals)
@@ -1,11 +1,22 @@
 from __future__ import annotations
 
+import bisect
+import contextlib
+import fcntl
+import hashlib
+import ipaddress
 import json
+import mmap
 import os
+import socket
+import struct
+import sys
 import tempfile
-from dataclasses import asdict, dataclass
+import time
+from array import array
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import Dict, Iterable, List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
 
 @dataclass(frozen=True)
@@ -16,17 +27,323 @@ class Assignment:
     proxy_type: str
     listen_stack: str
     nfqueue_num: Optional[int]
+    nfqueue_last: Optional[int] = None   # != None — fanout на nfqueue_num..nfqueue_last
 
 
 @dataclass
 class State:
     assignments: List[Assignment]
+    version: int = 0                     # растёт на 1 при каждой записи
+    config_hash: str = ""                # хэш конфига, из которого state построен
+    stages: Dict[str, str] = field(default_factory=dict)   # стадия apply -> отпечаток входа
 
 
-def read_state(path: Path) -> State:
-    if not path.exists():
-        return State(assignments=[])
-    data = json.loads(path.read_text(encoding="utf-8"))
+class StateError(RuntimeError):
+    pass
+
+
+class StateLockTimeout(StateError):
+    pass
+
+
+# =========================
+#    BINARY (COLUMNAR)
+# =========================
+#
+# Компактный формат для больших наборов: колонки фиксированной ширины,
+# строки (группы, proxy_type, listen_stack) интернированы в таблицу,
+# адрес — 16 байт в сетевом порядке. Два индекса — номера строк,
+# отсортированные по порту и по адресу, — позволяют StateView искать
+# прямо по mmap, не разбирая файл целиком.
+#
+#   header   "<4sHHIIQ32s32s" + NSECT * "II" (offset, length):
+#            magic, формат, flags, n, nstr, version, config_hash, content_hash
+#   strtab   u16 len + utf-8, подряд
+#   addr     n * 16
+#   port     n * u16
+#   group    n * u16   (индекс в strtab)
+#   ptype    n * u16
+#   stack    n * u16
+#   nfq      n * i32   (-1 — None)
+#   nfq_last n * i32
+#   by_port  n * u32   (номера строк по возрастанию порта)
+#   by_addr  n * u32   (по возрастанию адреса)
+#   meta     utf-8 JSON: {"stages": {...}}  (с формата 3)
+#
+# Числа little-endian; формат определяется по MAGIC, а не по имени файла.
+# content_hash — blake2b-256 по секциям (не по заголовку), один и тот же
+# для binary и json: им проверяется целостность при чтении.
+
+MAGIC = b"WVST"
+FORMAT_VERSION = 3
+
+_SECTIONS_V2 = ("strtab", "addr", "port", "group", "ptype", "stack", "nfq", "nfq_last", "by_port", "by_addr")
+_SECTIONS = _SECTIONS_V2 + ("meta",)
+_LAYOUTS = {
+    2: (_SECTIONS_V2, struct.Struct("<4sHHIIQ32s32s" + "II" * len(_SECTIONS_V2))),
+    3: (_SECTIONS, struct.Struct("<4sHHIIQ32s32s" + "II" * len(_SECTIONS))),
+}
+_HEADER = _LAYOUTS[FORMAT_VERSION][1]
+_PREFIX = struct.Struct("<4sH")
+_CODES = {"addr": "B", "port": "H", "group": "H", "ptype": "H", "stack": "H",
+          "nfq": "i", "nfq_last": "i", "by_port": "I", "by_addr": "I"}
+_ALIGN = 16
+_NONE = -1
+_LE = sys.byteorder == "little"
+
+
+def _col(code: str, data: Iterable[int]) -> bytes:
+    a = array(code, data)
+    if not _LE:
+        a.byteswap()
+    return a.tobytes()
+
+
+def _uncol(code: str, buf: bytes) -> array:
+    a = array(code)
+    a.frombytes(buf)
+    if not _LE:
+        a.byteswap()
+    return a
+
+
+def _encode_body(state: State) -> Tuple[int, List[int], bytes]:
+    """(nstr, таблица секций, тело) — всё после заголовка."""
+    assigns = state.assignments
+    n = len(assigns)
+
+    strings: List[str] = []
+    sid: Dict[str, int] = {}
+
+    def intern(s: str) -> int:
+        i = sid.get(s)
+        if i is None:
+            i = sid[s] = len(strings)
+            strings.append(s)
+        return i
+
+    addrs = [socket.inet_pton(socket.AF_INET6, a.ipv6) for a in assigns]
+    ports = [a.port for a in assigns]
+    cols: Dict[str, bytes] = {
+        "addr": b"".join(addrs),
+        "port": _col("H", ports),
+        "group": _col("H", (intern(a.group) for a in assigns)),
+        "ptype": _col("H", (intern(a.proxy_type) for a in assigns)),
+        "stack": _col("H", (intern(a.listen_stack) for a in assigns)),
+        "nfq": _col("i", (_NONE if a.nfqueue_num is None else a.nfqueue_num for a in assigns)),
+        "nfq_last": _col("i", (_NONE if a.nfqueue_last is None else a.nfqueue_last for a in assigns)),
+        "by_port": _col("I", sorted(range(n), key=ports.__getitem__)),
+        "by_addr": _col("I", sorted(range(n), key=addrs.__getitem__)),
+    }
+    if len(strings) > 0xFFFF:
+        raise ValueError("state: too many distinct strings for the binary format")
+    strtab = bytearray()
+    for s in strings:
+        b = s.encode("utf-8")
+        strtab += struct.pack("<H", len(b)) + b
+    cols["strtab"] = bytes(strtab)
+    cols["meta"] = json.dumps({"stages": state.stages}, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+    body = bytearray()
+    table: List[int] = []
+    off = _HEADER.size
+    for name in _SECTIONS:
+        pad = -off % _ALIGN
+        body += b"\0" * pad
+        off += pad
+        data = cols[name]
+        table += (off, len(data))
+        body += data
+        off += len(data)
+    return len(strings), table, bytes(body)
+
+
+def _digest(body: bytes) -> bytes:
+    return hashlib.blake2b(body, digest_size=32).digest()
+
+
+def content_hash(state: State) -> str:
+    return _digest(_encode_body(state)[2]).hex()
+
+
+def _hash_bytes(h: str) -> bytes:
+    return bytes.fromhex(h) if h else b"\0" * 32
+
+
+def encode_binary(state: State) -> bytes:
+    nstr, table, body = _encode_body(state)
+    return _HEADER.pack(
+        MAGIC, FORMAT_VERSION, 0, len(state.assignments), nstr,
+        state.version, _hash_bytes(state.config_hash), _digest(body), *table,
+    ) + body
+
+
+@dataclass(frozen=True)
+class _Header:
+    n: int
+    nstr: int
+    version: int
+    config_hash: str
+    content_hash: bytes
+    sections: Dict[str, Tuple[int, int]]
+    size: int                            # длина заголовка
+
+
+def _header(buf) -> _Header:
+    if len(buf) < _PREFIX.size:
+        raise StateError("state: truncated header")
+    magic, ver = _PREFIX.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise StateError("state: not a binary state file")
+    if ver not in _LAYOUTS:
+        raise StateError(f"state: unsupported binary format version {ver}")
+    names, hdr = _LAYOUTS[ver]
+    if len(buf) < hdr.size:
+        raise StateError("state: truncated header")
+    _magic, _ver, _flags, n, nstr, version, cfg_hash, digest, *table = hdr.unpack_from(buf, 0)
+    secs = {name: (table[2 * i], table[2 * i + 1]) for i, name in enumerate(names)}
+    for name, (off, ln) in secs.items():
+        if off + ln > len(buf):
+            raise StateError(f"state: section {name} out of bounds (torn file?)")
+    return _Header(n, nstr, version, cfg_hash.hex() if any(cfg_hash) else "", digest, secs, hdr.size)
+
+
+def _strtab(buf, off: int, ln: int, nstr: int) -> List[str]:
+    out: List[str] = []
+    p, end = off, off + ln
+    for _ in range(nstr):
+        (sl,) = struct.unpack_from("<H", buf, p)
+        p += 2
+        out.append(bytes(buf[p:p + sl]).decode("utf-8"))
+        p += sl
+    if p > end:
+        raise StateError("state: corrupt string table")
+    return out
+
+
+def decode_binary(buf: bytes) -> State:
+    h = _header(buf)
+    n, secs = h.n, h.sections
+    if _digest(buf[h.size:]) != h.content_hash:
+        raise StateError("state: content hash mismatch (torn or corrupt file)")
+    strings = _strtab(buf, *secs["strtab"], h.nstr)
+    c = {name: _uncol(code, buf[secs[name][0]:sum(secs[name])]) for name, code in _CODES.items() if name != "addr"}
+    a_off = secs["addr"][0]
+    ntop = socket.inet_ntop
+    af = socket.AF_INET6
+    port, group, ptype, stack, nfq, nfq_last = c["port"], c["group"], c["ptype"], c["stack"], c["nfq"], c["nfq_last"]
+    assigns = [
+        Assignment(
+            group=strings[group[i]],
+            port=port[i],
+            ipv6=ntop(af, buf[a_off + 16 * i: a_off + 16 * i + 16]),
+            proxy_type=strings[ptype[i]],
+            listen_stack=strings[stack[i]],
+            nfqueue_num=None if nfq[i] == _NONE else nfq[i],
+            nfqueue_last=None if nfq_last[i] == _NONE else nfq_last[i],
+        )
+        for i in range(n)
+    ]
+    stages: Dict[str, str] = {}
+    if "meta" in secs:
+        off, ln = secs["meta"]
+        stages = json.loads(bytes(buf[off:off + ln]).decode("utf-8")).get("stages", {})
+    return State(assignments=assigns, version=h.version, config_hash=h.config_hash, stages=stages)
+
+
+class StateView:
+    """
+    Только чтение, поверх mmap: поиск по порту/адресу — двоичный поиск по
+    индексам файла, разбирается только найденная строка.
+    """
+
+    def __init__(self, path: Path) -> None:
+        if not _LE:
+            raise OSError("StateView requires a little-endian host")
+        self._f = open(path, "rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self._mm)
+        h = _header(buf)
+        self._n, secs = h.n, h.sections
+        self.version = h.version
+        self.config_hash = h.config_hash
+        self._strings = _strtab(buf, *secs["strtab"], h.nstr)
+        self._addr = buf[secs["addr"][0]:sum(secs["addr"])]
+        self._c = {name: buf[secs[name][0]:sum(secs[name])].cast(code) for name, code in _CODES.items() if name != "addr"}
+
+    def __len__(self) -> int:
+        return self._n
+
+    def __enter__(self) -> "StateView":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for v in self._c.values():
+            v.release()
+        self._addr.release()
+        self._c = {}
+        self._mm.close()
+        self._f.close()
+
+    def _addr_at(self, row: int) -> bytes:
+        return bytes(self._addr[16 * row:16 * row + 16])
+
+    def row(self, i: int) -> Assignment:
+        c, s = self._c, self._strings
+        nfq, last = c["nfq"][i], c["nfq_last"][i]
+        return Assignment(
+            group=s[c["group"][i]],
+            port=c["port"][i],
+            ipv6=socket.inet_ntop(socket.AF_INET6, self._addr_at(i)),
+            proxy_type=s[c["ptype"][i]],
+            listen_stack=s[c["stack"][i]],
+            nfqueue_num=None if nfq == _NONE else nfq,
+            nfqueue_last=None if last == _NONE else last,
+        )
+
+    def __iter__(self) -> Iterator[Assignment]:
+        return (self.row(i) for i in range(self._n))
+
+    def by_port(self, port: int) -> Optional[Assignment]:
+        idx, col = self._c["by_port"], self._c["port"]
+        i = bisect.bisect_left(range(self._n), port, key=lambda k: col[idx[k]])
+        if i < self._n and col[idx[i]] == port:
+            return self.row(idx[i])
+        return None
+
+    def by_addr(self, addr: str) -> Optional[Assignment]:
+        want = socket.inet_pton(socket.AF_INET6, addr)
+        idx = self._c["by_addr"]
+        i = bisect.bisect_left(range(self._n), want, key=lambda k: self._addr_at(idx[k]))
+        if i < self._n and self._addr_at(idx[i]) == want:
+            return self.row(idx[i])
+        return None
+
+
+# =========================
+#        READ / WRITE
+# =========================
+
+def _from_json(data: dict) -> State:
+    try:
+        st = _rows_from_json(data)
+    except (KeyError, TypeError, ValueError) as e:
+        raise StateError(f"state: malformed JSON state ({type(e).__name__}: {e})") from e
+    want = data.get("content_hash")
+    if want and want != content_hash(st):
+        raise StateError("state: content hash mismatch (torn or corrupt file)")
+    return st
+
+
+def _rows_from_json(data: dict) -> State:
+    if "bindings" in data and "assignments" not in data:
+        # старый формат StateStore: только port/ipv6/group
+        rows = [dict(b, proxy_type="http") for b in data["bindings"]]
+    else:
+        rows = data.get("assignments", [])
     assigns = [
         Assignment(
             group=a["group"],
@@ -35,20 +352,164 @@ def read_state(path: Path) -> State:
             proxy_type=a["proxy_type"],
             listen_stack=a.get("listen_stack", "ipv4"),
             nfqueue_num=a.get("nfqueue_num"),
+            nfqueue_last=a.get("nfqueue_last"),
         )
-        for a in data.get("assignments", [])
+        for a in rows
     ]
-    return State(assignments=assigns)
+    return State(
+        assignments=assigns,
+        version=int(data.get("version", 0)),
+        config_hash=data.get("config_hash", ""),
+        stages=dict(data.get("stages") or {}),
+    )
 
 
-def write_state_atomic(path: Path, state: State) -> None:
-    tmp_dir = path.parent
-    os.makedirs(tmp_dir, exist_ok=True)
+def is_binary(path: Path) -> bool:
+    try:
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def read_state(path: Path) -> State:
+    """
+    Формат определяется по содержимому: старый JSON (в т.ч. `bindings`)
+    читается как есть, следующая запись мигрирует файл. Битый файл —
+    StateError, а не молча пустой state.
+    """
+    if not path.exists():
+        return State(assignments=[])
+    raw = path.read_bytes()
+    if raw[:len(MAGIC)] == MAGIC:
+        return decode_binary(raw)
+    try:
+        data = json.loads(raw.decode("utf-8"))
+    except (UnicodeDecodeError, ValueError) as e:
+        raise StateError(f"state: {path} is not valid JSON: {e}") from e
+    return _from_json(data)
+
+
+def lookup(path: Path, port: Optional[int] = None, addr: Optional[str] = None) -> Optional[Assignment]:
+    """
+    Одна строка по порту или адресу. Бинарный файл — через StateView
+    (индекс в mmap, без разбора всего state), JSON — полным чтением.
+    """
+    if (port is None) == (addr is None):
+        raise ValueError("lookup: exactly one of port/addr is required")
+    if is_binary(path) and _LE:
+        with StateView(path) as v:
+            return v.by_port(port) if port is not None else v.by_addr(addr)
+    want = ipaddress.IPv6Address(addr) if addr is not None else None
+    for a in read_state(path).assignments:
+        if (a.port == port) if want is None else (ipaddress.IPv6Address(a.ipv6) == want):
+            return a
+    return None
+
+
+def to_json(state: State) -> str:
     payload = {
+        "version": state.version,
+        "config_hash": state.config_hash,
+        "stages": state.stages,
+        "content_hash": content_hash(state),
         "assignments": [asdict(a) for a in state.assignments],
     }
-    with tempfile.NamedTemporaryFile("w", delete=False, dir=tmp_dir, encoding="utf-8") as f:
-        json.dump(payload, f, ensure_ascii=False, indent=2)
+    return json.dumps(payload, ensure_ascii=False, indent=2)
+
+
+def write_state_atomic(path: Path, state: State, format: str = "binary") -> None:
+    """tmp в том же каталоге -> fsync -> rename -> fsync каталога."""
+    if format not in ("binary", "json"):
+        raise ValueError(f"unknown state format: {format}")
+    tmp_dir = path.parent
+    os.makedirs(tmp_dir, exist_ok=True)
+    data = encode_binary(state) if format == "binary" else to_json(state).encode("utf-8")
+    with tempfile.NamedTemporaryFile("wb", delete=False, dir=tmp_dir, prefix=f".{path.name}.") as f:
+        try:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        except BaseException:
+            os.unlink(f.name)
+            raise
         tmp_name = f.name
     os.replace(tmp_name, path)
+    dfd = os.open(tmp_dir, os.O_RDONLY)
+    try:
+        os.fsync(dfd)
+    finally:
+        os.close(dfd)
+
+
+# =========================
+#          STORE
+# =========================
+
+class StateStore:
+    """
+    Единственная точка работы со state: блокирующий flock на
+    <path>.lock с таймаутом (параллельные `manager apply` ждут друг
+    друга, а не перетирают), версия +1 на каждую запись, атомарная
+    запись с fsync, content hash на чтении.
+
+        with store.transaction() as txn:
+            prev = txn.state
+            ...
+            txn.commit(State(assignments=..., config_hash=...))
+    """
+
+    def __init__(self, path: Path, format: str = "binary", lock_timeout: float = 30.0) -> None:
+        self.path = Path(path)
+        self.format = format
+        self.lock_timeout = lock_timeout
+
+    @property
+    def lock_path(self) -> Path:
+        return self.path.with_name(self.path.name + ".lock")
+
+    @contextlib.contextmanager
+    def locked(self, timeout: Optional[float] = None) -> Iterator[None]:
+        timeout = self.lock_timeout if timeout is None else timeout
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            deadline = time.monotonic() + timeout
+            delay = 0.01
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        raise StateLockTimeout(f"state lock {self.lock_path} busy for {timeout:.1f}s")
+                    time.sleep(delay)
+                    delay = min(delay * 2, 0.5)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def load(self) -> State:
+        return read_state(self.path)
+
+    @contextlib.contextmanager
+    def transaction(self, timeout: Optional[float] = None) -> Iterator["Transaction"]:
+        with self.locked(timeout):
+            yield Transaction(self, self.load())
+
+
+class Transaction:
+    def __init__(self, store: StateStore, state: State) -> None:
+        self.store = store
+        self.state = state
+        self.committed: Optional[State] = None
 
+    def commit(self, state: State) -> State:
+        # повторный commit в той же транзакции (checkpoint) — следующая версия
+        state.version = (self.committed or self.state).version + 1
+        write_state_atomic(self.store.path, state, self.store.format)
+        self.committed = state
+        return state
@@ -13,6 +13,12 @@ LISTEN_IP="${PROXY_LISTEN_IP:-::}"
 install -d -m 0775 -o 1337 -g 1337 "$RUN_DIR"
 rm -f "$PID"
 
+# несколько экземпляров: конфиги и манифест пишет manager (proxy_instances > 1)
+if [ -n "${PROXY_MANIFEST:-}" ]; then
+  echo "[proxy] starting 3proxy supervisor; manifest ${PROXY_MANIFEST}"
+  exec python3 /usr/local/bin/proxy-supervisor.py --manifest "$PROXY_MANIFEST"
+fi
+
 cat >"$CFG" <<'CFGEOF'
 setgid 1337
 setuid 1337
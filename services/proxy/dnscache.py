@@ -0,0 +1,421 @@
+from __future__ import annotations
+
+import argparse
+import asyncio
+import ipaddress
+import os
+import random
+import socket
+import struct
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import yaml
+
+from weaver_manager.proxy_config import DEFAULT_RESOLVER, parse_nserver
+
+# Локальный кэширующий резолвер для 3proxy (только stdlib, UDP).
+# Все экземпляры 3proxy ходят в него (nserver 127.0.0.1:5353), наружу
+# уходит один запрос на имя: одинаковые промахи склеиваются, горячие
+# имена (prefetch_hits обращений) обновляются заранее, в последней
+# prefetch_ratio доле TTL — клиент не ждёт upstream на истечении.
+# NXDOMAIN/NODATA кэшируются по SOA из authority (RFC 2308), не дольше
+# neg_ttl. hosts-файл отвечает локально; offline — наружу не ходим
+# вовсе, неизвестное — NXDOMAIN: стенд без сети.
+
+QTYPE_A = 1
+QTYPE_SOA = 6
+QTYPE_AAAA = 28
+QTYPE_OPT = 41
+
+RCODE_OK = 0
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+
+FLAG_QR = 0x8000
+FLAG_AA = 0x0400
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+FLAG_RA = 0x0080
+
+HOSTS_TTL = 60
+UPSTREAM_TIMEOUT = 2.0
+STATS_INTERVAL = 60.0
+
+_HDR = struct.Struct(">HHHHHH")
+_RR = struct.Struct(">HHIH")
+
+# (qname в нижнем регистре, wire-формат; qtype; qclass)
+Key = Tuple[bytes, int, int]
+
+
+# =========================
+#          WIRE
+# =========================
+
+def _skip_name(buf: bytes, off: int) -> int:
+    while True:
+        n = buf[off]
+        if n == 0:
+            return off + 1
+        if n & 0xC0 == 0xC0:
+            return off + 2
+        off += 1 + n
+
+
+def parse_question(buf: bytes) -> Tuple[Key, int]:
+    """(ключ, конец вопроса); IndexError/struct.error на мусоре."""
+    end = _skip_name(buf, _HDR.size)
+    qtype, qclass = struct.unpack_from(">HH", buf, end)
+    # байты длин меток < 64 — lower() их не трогает
+    return (bytes(buf[_HDR.size:end]).lower(), qtype, qclass), end + 4
+
+
+def qname_str(wire: bytes) -> str:
+    labels: List[str] = []
+    off = 0
+    while wire[off]:
+        n = wire[off]
+        labels.append(wire[off + 1:off + 1 + n].decode("ascii", "replace"))
+        off += 1 + n
+    return ".".join(labels)
+
+
+def scan_ttls(buf: bytes) -> Tuple[List[Tuple[int, int]], Optional[int], Optional[int]]:
+    """
+    ([(смещение TTL, TTL)], минимальный TTL записей, TTL негативного
+    ответа по SOA = min(TTL SOA, SOA.minimum)). OPT не трогаем.
+    """
+    _id, _fl, qd, an, ns, ar = _HDR.unpack_from(buf, 0)
+    off = _HDR.size
+    for _ in range(qd):
+        off = _skip_name(buf, off) + 4
+    ttls: List[Tuple[int, int]] = []
+    low: Optional[int] = None
+    neg: Optional[int] = None
+    for i in range(an + ns + ar):
+        off = _skip_name(buf, off)
+        rtype, _rclass, ttl, rdlen = _RR.unpack_from(buf, off)
+        if rtype != QTYPE_OPT:
+            ttls.append((off + 4, ttl))
+            if i < an + ns:
+                low = ttl if low is None else min(low, ttl)
+            if rtype == QTYPE_SOA and an <= i < an + ns:
+                rd = _skip_name(buf, _skip_name(buf, off + _RR.size))
+                minimum = struct.unpack_from(">I", buf, rd + 16)[0]
+                neg = min(ttl, minimum)
+        off += _RR.size + rdlen
+    return ttls, low, neg
+
+
+def error_reply(query: bytes, qend: int, rcode: int, aa: bool = False) -> bytes:
+    qid, flags = struct.unpack_from(">HH", query, 0)
+    flags = FLAG_QR | FLAG_RA | (flags & FLAG_RD) | (FLAG_AA if aa else 0) | rcode
+    return _HDR.pack(qid, flags, 1, 0, 0, 0) + query[_HDR.size:qend]
+
+
+def hosts_reply(query: bytes, qend: int, addrs: List[bytes]) -> bytes:
+    qid, flags = struct.unpack_from(">HH", query, 0)
+    flags = FLAG_QR | FLAG_AA | FLAG_RA | (flags & FLAG_RD)
+    out = bytearray(_HDR.pack(qid, flags, 1, len(addrs), 0, 0))
+    out += query[_HDR.size:qend]
+    for a in addrs:
+        rtype = QTYPE_AAAA if len(a) == 16 else QTYPE_A
+        out += struct.pack(">H", 0xC000 | _HDR.size)      # указатель на имя вопроса
+        out += _RR.pack(rtype, 1, HOSTS_TTL, len(a)) + a
+    return bytes(out)
+
+
+def load_hosts(path: str) -> Dict[str, List[bytes]]:
+    """hosts-формат: 'адрес имя [имя ...]', # — комментарий."""
+    out: Dict[str, List[bytes]] = {}
+    for line in Path(path).read_text(encoding="utf-8").splitlines():
+        cols = line.split("#", 1)[0].split()
+        if len(cols) < 2:
+            continue
+        packed = ipaddress.ip_address(cols[0]).packed
+        for name in cols[1:]:
+            out.setdefault(name.lower().rstrip("."), []).append(packed)
+    return out
+
+
+# =========================
+#          CACHE
+# =========================
+
+@dataclass
+class Entry:
+    wire: bytes
+    ttls: List[Tuple[int, int]]
+    stored: float
+    ttl: int
+    negative: bool
+    query: bytes                        # для prefetch: исходный запрос
+    hits: int = 0
+
+
+@dataclass
+class Settings:
+    upstreams: List[Tuple[str, int]] = field(default_factory=list)
+    listen: Tuple[str, int] = ("127.0.0.1", 5353)
+    cache_size: int = 10000
+    min_ttl: int = 0
+    max_ttl: int = 3600
+    neg_ttl: int = 300
+    prefetch_hits: int = 3
+    prefetch_ratio: float = 0.1
+    hosts: Optional[str] = None
+    offline: bool = False
+
+
+class DnsCache:
+    def __init__(self, st: Settings) -> None:
+        self.st = st
+        self.hosts: Dict[str, List[bytes]] = load_hosts(st.hosts) if st.hosts else {}
+        self.entries: "OrderedDict[Key, Entry]" = OrderedDict()
+        self.inflight: Dict[Key, "asyncio.Future[Optional[bytes]]"] = {}
+        self.upstreams: List[_Upstream] = []
+        self.stats: Dict[str, int] = {
+            "hits": 0, "negative_hits": 0, "misses": 0, "prefetched": 0,
+            "hosts": 0, "upstream_fail": 0, "uncacheable": 0,
+        }
+
+    async def start(self) -> None:
+        loop = asyncio.get_running_loop()
+        if self.st.offline:
+            return
+        for host, port in self.st.upstreams:
+            _t, proto = await loop.create_datagram_endpoint(_Upstream, remote_addr=(host, port))
+            self.upstreams.append(proto)
+
+    # ---- запрос ----
+
+    async def handle(self, query: bytes) -> Optional[bytes]:
+        try:
+            key, qend = parse_question(query)
+            if struct.unpack_from(">H", query, 2)[0] & FLAG_QR:
+                return None
+        except (IndexError, struct.error):
+            return None
+
+        addrs = self.hosts.get(qname_str(key[0])) if self.hosts else None
+        if addrs is not None:
+            # имя из hosts: A/AAAA своего семейства, прочие типы — NODATA
+            self.stats["hosts"] += 1
+            want = {QTYPE_A: 4, QTYPE_AAAA: 16}.get(key[1])
+            return hosts_reply(query, qend, [a for a in addrs if len(a) == want])
+
+        e = self.entries.get(key)
+        now = time.monotonic()
+        if e is not None:
+            age = now - e.stored
+            if age < e.ttl:
+                self.entries.move_to_end(key)
+                e.hits += 1
+                self.stats["negative_hits" if e.negative else "hits"] += 1
+                if (
+                    not e.negative
+                    and e.hits >= self.st.prefetch_hits
+                    and e.ttl - age <= e.ttl * self.st.prefetch_ratio
+                    and key not in self.inflight
+                ):
+                    self.stats["prefetched"] += 1
+                    self._fetch(key, e.query)
+                return self._from_cache(e, query, qend, int(age))
+            del self.entries[key]
+
+        if self.st.offline:
+            return error_reply(query, qend, RCODE_NXDOMAIN, aa=True)
+        self.stats["misses"] += 1
+        fut = self.inflight.get(key)
+        if fut is None:
+            fut = self._fetch(key, query)
+        resp = await asyncio.shield(fut)
+        if resp is None:
+            return error_reply(query, qend, RCODE_SERVFAIL)
+        # ответ мог прийти на чужой (склеенный) запрос: id и регистр — клиента
+        return query[:2] + resp[2:_HDR.size] + query[_HDR.size:qend] + resp[qend:]
+
+    def _from_cache(self, e: Entry, query: bytes, qend: int, age: int) -> bytes:
+        out = bytearray(e.wire)
+        out[0:2] = query[0:2]
+        out[_HDR.size:qend] = query[_HDR.size:qend]
+        for off, ttl in e.ttls:
+            struct.pack_into(">I", out, off, max(0, ttl - age))
+        return bytes(out)
+
+    # ---- upstream ----
+
+    def _fetch(self, key: Key, query: bytes) -> "asyncio.Future[Optional[bytes]]":
+        fut = asyncio.ensure_future(self._resolve(key, query))
+        self.inflight[key] = fut
+        fut.add_done_callback(lambda _f: self.inflight.pop(key, None))
+        return fut
+
+    async def _resolve(self, key: Key, query: bytes) -> Optional[bytes]:
+        for up in self.upstreams:
+            resp = await up.ask(query, key)
+            if resp is not None:
+                self._store(key, query, resp)
+                return resp
+        self.stats["upstream_fail"] += 1
+        return None
+
+    def _store(self, key: Key, query: bytes, resp: bytes) -> None:
+        st = self.st
+        _id, flags, _qd, an, _ns, _ar = _HDR.unpack_from(resp, 0)
+        rcode = flags & 0x000F
+        try:
+            ttls, low, neg = scan_ttls(resp)
+        except (IndexError, struct.error):
+            return
+        if flags & FLAG_TC:
+            ttl = 0
+        elif rcode == RCODE_OK and an:
+            ttl = min(max(low or 0, st.min_ttl), st.max_ttl)
+        elif rcode in (RCODE_OK, RCODE_NXDOMAIN) and neg is not None:
+            ttl = min(neg, st.neg_ttl)
+        else:
+            ttl = 0
+        if ttl <= 0:
+            self.stats["uncacheable"] += 1
+            return
+        old = self.entries.pop(key, None)
+        self.entries[key] = Entry(
+            wire=resp, ttls=ttls, stored=time.monotonic(), ttl=ttl,
+            negative=not (rcode == RCODE_OK and an), query=query,
+            hits=old.hits if old is not None else 0,
+        )
+        while len(self.entries) > st.cache_size:
+            self.entries.popitem(last=False)
+
+
+class _Upstream(asyncio.DatagramProtocol):
+    """Один connected UDP-сокет на upstream; ответы разбираются по id."""
+
+    def __init__(self) -> None:
+        self.transport: Optional[asyncio.DatagramTransport] = None
+        self.pending: Dict[int, Tuple[Key, "asyncio.Future[bytes]"]] = {}
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        if len(data) < _HDR.size:
+            return
+        qid = struct.unpack_from(">H", data, 0)[0]
+        item = self.pending.get(qid)
+        if item is None:
+            return
+        key, fut = item
+        try:
+            if parse_question(data)[0] != key:
+                return
+        except (IndexError, struct.error):
+            return
+        del self.pending[qid]
+        if not fut.done():
+            fut.set_result(data)
+
+    def error_received(self, exc) -> None:
+        pass
+
+    async def ask(self, query: bytes, key: Key) -> Optional[bytes]:
+        assert self.transport is not None
+        qid = random.getrandbits(16)
+        while qid in self.pending:
+            qid = random.getrandbits(16)
+        fut: "asyncio.Future[bytes]" = asyncio.get_running_loop().create_future()
+        self.pending[qid] = (key, fut)
+        try:
+            self.transport.sendto(struct.pack(">H", qid) + query[2:])
+            return await asyncio.wait_for(fut, UPSTREAM_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.pending.pop(qid, None)
+
+
+class _Server(asyncio.DatagramProtocol):
+    def __init__(self, cache: DnsCache) -> None:
+        self.cache = cache
+        self.transport: Optional[asyncio.DatagramTransport] = None
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        asyncio.ensure_future(self._answer(data, addr))
+
+    async def _answer(self, data: bytes, addr) -> None:
+        resp = await self.cache.handle(data)
+        if resp is not None and self.transport is not None:
+            self.transport.sendto(resp, addr)
+
+
+# =========================
+#          MAIN
+# =========================
+
+def load_settings(path: Optional[str]) -> Settings:
+    """global.resolver из config.yaml (как в GlobalConfig manager-а)."""
+    res: dict = {}
+    if path and Path(path).exists():
+        cfg = yaml.safe_load(Path(path).read_text(encoding="utf-8")) or {}
+        res = (cfg.get("global") or {}).get("resolver") or {}
+    local = res.get("local") or {}
+    st = Settings()
+    servers = res.get("servers", list(DEFAULT_RESOLVER.servers))
+    st.upstreams = [parse_nserver(s)[:2] for s in servers]
+    host, port, _tcp = parse_nserver(str(local.get("listen", "127.0.0.1:5353")))
+    st.listen = (host, port)
+    for k in ("cache_size", "min_ttl", "max_ttl", "neg_ttl", "prefetch_hits"):
+        if k in local:
+            setattr(st, k, int(local[k]))
+    if "prefetch_ratio" in local:
+        st.prefetch_ratio = float(local["prefetch_ratio"])
+    st.hosts = local.get("hosts") or None
+    st.offline = bool(local.get("offline", False))
+    return st
+
+
+async def serve(st: Settings) -> None:
+    cache = DnsCache(st)
+    await cache.start()
+    loop = asyncio.get_running_loop()
+    family = socket.AF_INET6 if ":" in st.listen[0] else socket.AF_INET
+    await loop.create_datagram_endpoint(lambda: _Server(cache), local_addr=st.listen, family=family)
+    ups = "offline" if st.offline else ",".join(f"{h}:{p}" for h, p in st.upstreams)
+    print(f"[resolver] listening {st.listen[0]}:{st.listen[1]}, upstreams {ups}, {len(cache.hosts)} hosts")
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        s = " ".join(f"{k}={v}" for k, v in cache.stats.items())
+        print(f"[resolver] entries={len(cache.entries)} {s}")
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--config", default=os.environ.get("WEAVER_CONFIG", "/app/config/config.yaml"))
+    ap.add_argument("--listen", help="ip:port, перекрывает resolver.local.listen")
+    ap.add_argument("--hosts", help="hosts-файл со статическими A/AAAA")
+    ap.add_argument("--offline", action="store_true", help="не ходить в upstream")
+    a = ap.parse_args()
+
+    st = load_settings(a.config)
+    if a.listen:
+        st.listen = parse_nserver(a.listen)[:2]
+    if a.hosts:
+        st.hosts = a.hosts
+    if a.offline:
+        st.offline = True
+    try:
+        asyncio.run(serve(st))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
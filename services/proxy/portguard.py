@@ -1,80 +1,126 @@
 from __future__ import annotations
 
 import argparse
-import subprocess
+import ipaddress as ipa
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
 import yaml
 
-
-def load_groups(path: str) -> List[Tuple[int, int, int | None]]:
+from weaver_manager.nft import (
+    SYN_ONLY,
+    LogGroup,
+    NftChain,
+    NftRule,
+    NftSet,
+    Ruleset,
+    QueueKey,
+    delete_table,
+    dispatch_map,
+    port_dispatch,
+    queue_chain,
+    queue_chain_name,
+    render_ruleset,
+    run_script,
+)
+from weaver_manager.ranges import Interval, merge
+
+TABLE = "inet weaver_proxy"
+
+
+class Group(NamedTuple):
+    start: int
+    end: int
+    queue: Optional[QueueKey]
+    prefixes: Tuple[Interval, ...]     # ipv6_subnet / ipv6_prefixes как [lo, hi]
+
+
+def _prefixes(g: dict) -> Tuple[Interval, ...]:
+    raw = [g["ipv6_subnet"]] if g.get("ipv6_subnet") else [p["prefix"] for p in g.get("ipv6_prefixes") or []]
+    nets = [ipa.IPv6Network(p, strict=False) for p in raw]
+    return tuple((int(n.network_address), int(n.broadcast_address)) for n in nets)
+
+
+def load_groups(path: str) -> List[Group]:
     p = Path(path)
     if p.is_dir():
         p = p / "config.yaml"
     cfg = yaml.safe_load(p.read_text(encoding="utf-8")) or {}
-    groups: List[Tuple[int, int, int | None]] = []
+    groups: List[Group] = []
     for g in cfg.get("proxy_groups", []) or []:
         pr = g.get("port_range") or {}
         s = int(pr.get("start", 0))
         e = int(pr.get("end", -1))
         qn = g.get("nfqueue_num")
+        qr = g.get("nfqueue_range") or {}
+        q: Optional[QueueKey]
+        if str(g.get("observe_backend") or "nfqueue").lower() == "nflog":
+            q = LogGroup(int(qn)) if qn is not None else None
+        elif qr:
+            q = (int(qr["start"]), int(qr["end"]))
+        else:
+            q = (int(qn), int(qn)) if qn is not None else None
         if s and e >= s:
-            groups.append((s, e, int(qn) if qn is not None else None))
+            groups.append(Group(s, e, q, _prefixes(g)))
     return groups
 
 
-def run(cmd: List[str], check: bool = True) -> subprocess.CompletedProcess:
-    return subprocess.run(cmd, check=check)
-
-
-def nft_open(groups: List[Tuple[int, int, int | None]]) -> None:
-    # Чистим прошлое
-    run(["nft", "delete", "table", "inet", "weaver_proxy"], check=False)
-
-    run(["nft", "add", "table", "inet", "weaver_proxy"])
-    run(["nft", "add", "set", "inet", "weaver_proxy", "weaver_ports", "{", "type", "inet_service", ";", "flags", "interval", ";", "}"])
-
-    if groups:
-        elements = [f"{s}-{e}" for (s, e, _qn) in groups]
-        run(["nft", "add", "element", "inet", "weaver_proxy", "weaver_ports", "{", ", ".join(elements), "}"])
-
-    # INPUT: только SYN‑only на наши порты -> NFQUEUE
-    run(["nft", "add", "chain", "inet", "weaver_proxy", "weaver_input", "{", "type", "filter", "hook", "input", "priority", "0", ";", "}"])
-    for s, e, qn in groups:
-        if qn is None:
-            continue
-        run([
-            "nft", "add", "rule", "inet", "weaver_proxy", "weaver_input",
-            "tcp", "dport", f"{s}-{e}",
-            "tcp", "flags", "&", "syn", "==", "syn",
-            "tcp", "flags", "&", "ack", "==", "0",
-            "queue", "num", str(qn), "bypass"
-        ])
-    run(["nft", "add", "rule", "inet", "weaver_proxy", "weaver_input", "tcp", "dport", "@weaver_ports", "accept"])
-
-    # OUTPUT: только SYN‑only от uid=1337 (3proxy) -> NFQUEUE
-    run(["nft", "add", "chain", "inet", "weaver_proxy", "weaver_output", "{", "type", "filter", "hook", "output", "priority", "0", ";", "}"])
-    for _s, _e, qn in groups:
-        if qn is None:
-            continue
-        run([
-            "nft", "add", "rule", "inet", "weaver_proxy", "weaver_output",
-            "meta", "skuid", "1337",
-            "tcp", "flags", "&", "syn", "==", "syn",
-            "tcp", "flags", "&", "ack", "==", "0",
-            "queue", "num", str(qn), "bypass"
-        ])
+def build_rules(groups: List[Group]) -> Ruleset:
+    rs = Ruleset(table=TABLE)
+    rs.chains["weaver_input"] = NftChain("weaver_input", "type filter hook input priority 0;")
+    rs.chains["weaver_output"] = NftChain("weaver_output", "type filter hook output priority 0;")
+    rs.sets["weaver_ports"] = NftSet(
+        "weaver_ports", "inet_service", {(iv, "") for iv in merge((g.start, g.end) for g in groups)}
+    )
+
+    # INPUT: только SYN‑only на наши порты -> NFQUEUE (одна мапа на все группы)
+    by_q: Dict[QueueKey, List[Tuple[int, int]]] = {}
+    for g in groups:
+        if g.queue is not None:
+            by_q.setdefault(g.queue, []).append((g.start, g.end))
+    if by_q:
+        port_dispatch(rs, "weaver_input", {q: merge(r) for q, r in by_q.items()})
+    rs.chains["weaver_input"].rules.append(NftRule("tcp dport @weaver_ports accept", ("weaver_ports",)))
+
+    # OUTPUT: только SYN‑only от uid=1337 (3proxy) -> NFQUEUE. По dport
+    # исходящий не разобрать: IPv6 разводим по ip6 saddr (префиксы групп),
+    # остальное (IPv4, адреса вне префиксов) — как раньше, в очередь
+    # первой по конфигу группы
+    out = rs.chains["weaver_output"]
+    queued = [g for g in groups if g.queue is not None]
+    saddr_by_q: Dict[QueueKey, List[Interval]] = {}
+    for g in queued:
+        saddr_by_q.setdefault(g.queue, []).extend(g.prefixes)
+    saddr_by_q = {q: merge(ivs) for q, ivs in saddr_by_q.items() if ivs}
+    if saddr_by_q:
+        name = "weaver_out_dispatch"
+        try:
+            rs.sets[name] = dispatch_map(name, "ipv6_addr", saddr_by_q)
+        except ValueError as e:
+            # префиксы разных очередей пересекаются — по saddr не развести
+            print(f"[proxy] portguard: egress saddr dispatch disabled: {e}")
+        else:
+            for q in saddr_by_q:
+                rs.chains.setdefault(queue_chain_name(q), queue_chain(q))
+            out.rules.append(NftRule(f"meta skuid 1337 {SYN_ONLY} ip6 saddr vmap @{name}", (name,)))
+    if queued:
+        out.rules.append(NftRule(f"meta skuid 1337 {SYN_ONLY} goto {queue_chain_name(queued[0].queue)}", ()))
+    return rs
+
+
+def nft_open(groups: List[Group]) -> None:
+    # Пересоздаём таблицу одной транзакцией
+    run_script(render_ruleset(build_rules(groups)))
 
 
 def nft_close() -> None:
-    run(["nft", "delete", "table", "inet", "weaver_proxy"], check=False)
+    delete_table(TABLE)
 
 
 def main() -> None:
     ap = argparse.ArgumentParser()
     ap.add_argument("action", choices=["open", "close"])
-    ap.add_argument("--config", required=True)
+    ap.add_argument("--config", default="/app/config/config.yaml")
     args = ap.parse_args()
 
     if args.action == "open":
@@ -0,0 +1,255 @@
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import signal
+import subprocess
+import threading
+import time
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from weaver_manager.proxy_config import read_manifest
+
+# Супервизор нескольких 3proxy: состав экземпляров берётся из манифеста,
+# который пишет manager (<cfg>.instances). Каждый экземпляр — свой конфиг,
+# свой monitor-файл и свой CPU; упавший перезапускается с backoff.
+# Манифест перечитывается по mtime (и по SIGHUP): новые экземпляры
+# стартуют, лишние гасятся, перезагрузку среза делает сам 3proxy по monitor.
+
+BACKOFF_MIN = 1.0
+BACKOFF_MAX = 30.0
+STABLE_SEC = 60.0          # проработал дольше — backoff сбрасывается
+STOP_GRACE = 10.0
+
+
+def parse_cpus(spec: str) -> List[int]:
+    """'0-3,6' -> [0, 1, 2, 3, 6]"""
+    out: List[int] = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        lo, _, hi = part.partition("-")
+        out.extend(range(int(lo), int(hi or lo) + 1))
+    return out
+
+
+@dataclass
+class Instance:
+    id: int
+    config: str
+    monitor: str
+    pidfile: str
+    cpu: int
+    listeners: int = 0
+    proc: Optional[subprocess.Popen] = None
+    started: float = 0.0
+    restarts: int = 0
+    last_exit: Optional[int] = None
+    last_error: Optional[str] = None
+    backoff: float = BACKOFF_MIN
+    next_start: float = 0.0
+
+    @property
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def status(self) -> Dict[str, object]:
+        try:
+            signalled = Path(self.monitor).stat().st_mtime
+        except OSError:
+            signalled = None
+        return {
+            "id": self.id,
+            "alive": self.alive,
+            "pid": self.proc.pid if self.alive and self.proc else None,
+            "cpu": self.cpu,
+            "listeners": self.listeners,
+            "uptime_sec": round(time.monotonic() - self.started, 1) if self.alive else 0.0,
+            "restarts": self.restarts,
+            "last_exit": self.last_exit,
+            "last_error": self.last_error,
+            "last_signal": signalled,
+            "config": self.config,
+        }
+
+
+class Supervisor:
+    def __init__(self, manifest: Path, binary: str, cpus: List[int]) -> None:
+        self.manifest = manifest
+        self.binary = binary
+        self.cpus = cpus
+        self.instances: Dict[int, Instance] = {}
+        self._mtime: Optional[float] = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._reload = threading.Event()
+
+    # ---- манифест ----
+
+    def _manifest_mtime(self) -> Optional[float]:
+        try:
+            return self.manifest.stat().st_mtime
+        except FileNotFoundError:
+            return None
+
+    def reconcile(self) -> None:
+        self._mtime = self._manifest_mtime()
+        want = {int(e["id"]): e for e in read_manifest(self.manifest)}
+        with self._lock:
+            for i in sorted(set(self.instances) - set(want)):
+                print(f"[proxy] instance {i}: removed from manifest, stopping")
+                self._stop_one(self.instances.pop(i))
+            for i, e in sorted(want.items()):
+                cur = self.instances.get(i)
+                if cur is not None and cur.config != e["config"]:
+                    self._stop_one(self.instances.pop(i))
+                    cur = None
+                if cur is None:
+                    cur = self.instances[i] = Instance(
+                        id=i,
+                        config=str(e["config"]),
+                        monitor=str(e["monitor"]),
+                        pidfile=str(e["pidfile"]),
+                        cpu=self.cpus[i % len(self.cpus)],
+                    )
+                cur.listeners = int(e.get("listeners") or 0)
+
+    # ---- процессы ----
+
+    def _spawn(self, inst: Instance) -> None:
+        if not Path(inst.config).exists():
+            return
+        Path(inst.monitor).touch(exist_ok=True)
+        Path(inst.pidfile).unlink(missing_ok=True)
+        # маска CPU наследуется от потока, который делает fork: ставим её
+        # себе на время Popen — без preexec_fn и без окна, когда 3proxy
+        # уже плодит потоки со старой маской
+        own = os.sched_getaffinity(0)
+        try:
+            os.sched_setaffinity(0, {inst.cpu})
+            inst.proc = subprocess.Popen([self.binary, inst.config])
+        except OSError as e:
+            # нет/не исполняется бинарь, ENOMEM, CPU пропал из маски: не роняем
+            # супервизор (и уже запущенные экземпляры), повторяем с backoff
+            inst.proc = None
+            self._schedule_restart(inst, time.monotonic(), None, f"spawn failed: {e}")
+            return
+        finally:
+            os.sched_setaffinity(0, own)
+        inst.started = time.monotonic()
+        print(f"[proxy] instance {inst.id}: pid {inst.proc.pid} on cpu {inst.cpu}, {inst.listeners} listeners")
+
+    def _stop_one(self, inst: Instance) -> None:
+        p = inst.proc
+        if p is None or p.poll() is not None:
+            return
+        p.terminate()
+        try:
+            p.wait(STOP_GRACE)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.wait()
+
+    def step(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            for inst in self.instances.values():
+                if inst.proc is not None:
+                    rc = inst.proc.poll()
+                    if rc is None:
+                        continue
+                    inst.proc = None
+                    if now - inst.started >= STABLE_SEC:
+                        inst.backoff = BACKOFF_MIN
+                    self._schedule_restart(inst, now, rc, f"exited rc={rc}")
+                if now >= inst.next_start:
+                    self._spawn(inst)
+
+    def _schedule_restart(self, inst: Instance, now: float, rc: Optional[int], why: str) -> None:
+        inst.last_exit = rc
+        inst.last_error = why
+        inst.restarts += 1
+        inst.next_start = now + inst.backoff
+        print(f"[proxy] instance {inst.id}: {why}, restart in {inst.backoff:.0f}s")
+        inst.backoff = min(inst.backoff * 2, BACKOFF_MAX)
+
+    def run(self, poll: float) -> None:
+        self.reconcile()
+        while not self._stop.is_set():
+            if self._reload.is_set() or self._manifest_mtime() != self._mtime:
+                self._reload.clear()
+                self.reconcile()
+            self.step()
+            self._stop.wait(poll)
+        with self._lock:
+            for inst in self.instances.values():
+                self._stop_one(inst)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def reload(self) -> None:
+        self._reload.set()
+
+    # ---- health ----
+
+    def health(self) -> Dict[str, object]:
+        with self._lock:
+            items = [self.instances[i].status() for i in sorted(self.instances)]
+        return {"ok": bool(items) and all(s["alive"] for s in items), "instances": items}
+
+
+def serve_health(sup: Supervisor, addr: str, port: int) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self) -> None:
+            if self.path.rstrip("/") not in ("", "/health"):
+                self.send_error(404)
+                return
+            h = sup.health()
+            body = json.dumps(h).encode("utf-8")
+            self.send_response(200 if h["ok"] else 503)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_args) -> None:
+            pass
+
+    srv = ThreadingHTTPServer((addr, port), Handler)
+    threading.Thread(target=srv.serve_forever, name="health", daemon=True).start()
+    return srv
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--manifest", default=os.environ.get("PROXY_MANIFEST", "/app/config/3proxy.instances"))
+    ap.add_argument("--bin", default="/usr/bin/3proxy")
+    ap.add_argument("--cpus", default=os.environ.get("PROXY_CPUS", ""), help="e.g. 0-3,6; default — all allowed")
+    ap.add_argument("--health-addr", default=os.environ.get("PROXY_HEALTH_ADDR", "127.0.0.1"))
+    ap.add_argument("--health-port", type=int, default=int(os.environ.get("PROXY_HEALTH_PORT", "9091")))
+    ap.add_argument("--poll", type=float, default=1.0)
+    a = ap.parse_args()
+
+    allowed = os.sched_getaffinity(0)
+    cpus = [c for c in parse_cpus(a.cpus) if c in allowed] if a.cpus else sorted(allowed)
+    if not cpus:
+        print(f"[proxy] none of cpus {a.cpus} is allowed, using {sorted(allowed)}")
+        cpus = sorted(allowed)
+    sup = Supervisor(Path(a.manifest), a.bin, cpus)
+    signal.signal(signal.SIGTERM, lambda *_: sup.stop())
+    signal.signal(signal.SIGINT, lambda *_: sup.stop())
+    signal.signal(signal.SIGHUP, lambda *_: sup.reload())
+    if a.health_port:
+        serve_health(sup, a.health_addr, a.health_port)
+    print(f"[proxy] supervisor: manifest {a.manifest}, cpus {','.join(map(str, cpus))}")
+    sup.run(a.poll)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# как в образе: скрипты proxy рядом, weaver_manager на PYTHONPATH
+_services = Path(__file__).resolve().parent.parent.parent
+sys.path.insert(0, str(_services / "proxy"))
+sys.path.insert(0, str(_services / "manager"))
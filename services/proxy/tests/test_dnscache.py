@@ -0,0 +1,144 @@
+import struct
+
+import pytest
+
+import dnscache
+from dnscache import (
+    FLAG_QR,
+    FLAG_RD,
+    FLAG_TC,
+    QTYPE_A,
+    QTYPE_AAAA,
+    QTYPE_SOA,
+    RCODE_NXDOMAIN,
+    RCODE_OK,
+    RCODE_SERVFAIL,
+    DnsCache,
+    Settings,
+    parse_question,
+)
+
+HDR = struct.Struct(">HHHHHH")
+RR = struct.Struct(">HHIH")
+NAME_PTR = struct.pack(">H", 0xC000 | HDR.size)
+
+
+def wire_name(name: str) -> bytes:
+    return b"".join(bytes([len(l)]) + l.encode() for l in name.split(".")) + b"\0"
+
+
+def query(name="Example.COM", qtype=QTYPE_A, qid=0x1234) -> bytes:
+    return HDR.pack(qid, FLAG_RD, 1, 0, 0, 0) + wire_name(name) + struct.pack(">HH", qtype, 1)
+
+
+def answer(q: bytes, ttls, rcode=RCODE_OK, flags=0) -> bytes:
+    """A-записи с заданными TTL на имя вопроса."""
+    qid = struct.unpack_from(">H", q)[0]
+    out = HDR.pack(qid, FLAG_QR | flags | rcode, 1, len(ttls), 0, 0) + q[HDR.size:]
+    for ttl in ttls:
+        out += NAME_PTR + RR.pack(QTYPE_A, 1, ttl, 4) + bytes([192, 0, 2, 1])
+    return out
+
+
+def negative(q: bytes, soa_ttl: int, minimum: int, rcode=RCODE_NXDOMAIN) -> bytes:
+    qid = struct.unpack_from(">H", q)[0]
+    rdata = wire_name("ns.example.com") + wire_name("host.example.com") + struct.pack(">IIIII", 1, 2, 3, 4, minimum)
+    return (
+        HDR.pack(qid, FLAG_QR | rcode, 1, 0, 1, 0) + q[HDR.size:]
+        + NAME_PTR + RR.pack(QTYPE_SOA, 1, soa_ttl, len(rdata)) + rdata
+    )
+
+
+def cache(**kw) -> DnsCache:
+    return DnsCache(Settings(upstreams=[("192.0.2.53", 53)], **kw))
+
+
+def test_parse_question_lowercases_name():
+    q = query("Example.COM", QTYPE_AAAA)
+    (name, qtype, qclass), end = parse_question(q)
+    assert name == wire_name("example.com")
+    assert (qtype, qclass, end) == (QTYPE_AAAA, 1, len(q))
+
+
+@pytest.mark.parametrize("buf", [b"", b"\0" * 12, query()[:-3]])
+def test_parse_question_garbage(buf):
+    with pytest.raises((IndexError, struct.error)):
+        parse_question(buf)
+
+
+def test_positive_ttl_is_min_record_ttl_clamped():
+    c = cache(min_ttl=30, max_ttl=100)
+    q = query()
+    key, _ = parse_question(q)
+    c._store(key, q, answer(q, [50, 20]))
+    assert c.entries[key].ttl == 30 and not c.entries[key].negative
+    c._store(key, q, answer(q, [500]))
+    assert c.entries[key].ttl == 100
+
+
+def test_negative_ttl_from_soa_capped_by_neg_ttl():
+    c = cache(neg_ttl=300)
+    q = query()
+    key, _ = parse_question(q)
+    c._store(key, q, negative(q, soa_ttl=900, minimum=120))
+    assert c.entries[key].ttl == 120 and c.entries[key].negative
+    c._store(key, q, negative(q, soa_ttl=900, minimum=3600))
+    assert c.entries[key].ttl == 300
+
+
+def test_nodata_is_cached_as_negative():
+    c = cache()
+    q = query(qtype=QTYPE_AAAA)
+    key, _ = parse_question(q)
+    c._store(key, q, negative(q, soa_ttl=60, minimum=60, rcode=RCODE_OK))
+    assert c.entries[key].negative
+
+
+@pytest.mark.parametrize("resp", [
+    lambda q: answer(q, [60], flags=FLAG_TC),
+    lambda q: answer(q, [], rcode=RCODE_SERVFAIL),
+    lambda q: answer(q, [0]),
+    lambda q: answer(q, [], rcode=RCODE_NXDOMAIN),     # без SOA — TTL не из чего взять
+])
+def test_uncacheable_responses(resp):
+    c = cache()
+    q = query()
+    key, _ = parse_question(q)
+    c._store(key, q, resp(q))
+    assert key not in c.entries
+    assert c.stats["uncacheable"] == 1
+
+
+def test_lru_eviction():
+    c = cache(cache_size=2)
+    keys = []
+    for name in ("a.test", "b.test", "c.test"):
+        q = query(name)
+        key, _ = parse_question(q)
+        keys.append(key)
+        c._store(key, q, answer(q, [60]))
+    assert list(c.entries) == keys[1:]
+
+
+def test_restore_keeps_hit_count():
+    c = cache()
+    q = query()
+    key, _ = parse_question(q)
+    c._store(key, q, answer(q, [60]))
+    c.entries[key].hits = 5
+    c._store(key, q, answer(q, [60]))
+    assert c.entries[key].hits == 5
+
+
+def test_cached_reply_ages_ttls_and_takes_client_id_and_case():
+    c = cache()
+    q = query("example.com", qid=1)
+    key, qend = parse_question(q)
+    c._store(key, q, answer(q, [60, 90]))
+    client = query("EXAMPLE.com", qid=7)
+    out = c._from_cache(c.entries[key], client, qend, age=10)
+    assert out[:2] == client[:2]
+    assert out[HDR.size:qend] == client[HDR.size:qend]
+    _ttls, low, _neg = dnscache.scan_ttls(out)
+    assert low == 50
+    assert [t for _, t in _ttls] == [50, 80]